@@ -0,0 +1,94 @@
+import os
+import time
+import subprocess
+import tarfile
+import cache
+import guest
+
+MESON_OPTIONS = '-Dlibdbus=enabled'
+# Added for --profile: debug info and frame pointers for perf call graphs.
+# Part of the artifact key, so profiling builds are cached separately
+PROFILE_MESON_OPTIONS = '-Dbuildtype=debugoptimized -Dc_args=-fno-omit-frame-pointer'
+ARTIFACT_STATE = 'artifacts.json'
+
+# Everything needed to compile and run tests against libcxlmi: headers under
+# src/ and ccan/, and the shared library under build/src/
+ARTIFACT_DIRS = ['src', 'ccan', 'build/src']
+
+def guest_toolchain(execute):
+    # Compiler, libc and arch of the guest; binaries are only reusable on a match
+    return execute('gcc -dumpfullversion; ldd --version | head -n1; uname -m').strip()
+
+def artifact_key(libcxlmi_rev, meson_options, toolchain):
+    return cache.hash_strings(libcxlmi_rev, ' '.join(meson_options.split()), toolchain)
+
+def lookup(key):
+    # Path of the cached build for this key, if there is one
+    entry = cache.load_json(ARTIFACT_STATE).get(key)
+    if entry and os.path.exists(entry['path']):
+        return entry['path']
+    return None
+
+def record(key, path, libcxlmi_rev, toolchain):
+    with cache.update_json(ARTIFACT_STATE) as state:
+        state[key] = {'path': path, 'rev': libcxlmi_rev, 'toolchain': toolchain, 'time': time.time()}
+
+def latest(libcxlmi_rev, meson_options):
+    """
+    Path of the most recently cached build of this revision and these meson
+    options for any guest toolchain, or None. Lets the host start building
+    tests before the VM is up to report its toolchain; install_libcxlmi()
+    still checks the real key.
+    """
+    # The state is saved with sorted keys, so its order says nothing about age
+    state = cache.load_json(ARTIFACT_STATE)
+    matches = [entry for key, entry in state.items()
+               if entry['rev'] == libcxlmi_rev and os.path.exists(entry['path'])
+               and artifact_key(libcxlmi_rev, meson_options, entry['toolchain']) == key]
+    if not matches:
+        return None
+    return max(matches, key=lambda entry: entry.get('time', 0))['path']
+
+def artifact_path(key):
+    return cache.cache_path('libcxlmi', key[:16] + '.tar.gz')
+
+def pack_source(libcxlmi_dir, dst, name='libcxlmi'):
+    """
+    Pack the tracked files of the host libcxlmi checkout (with any local
+    modifications) so the guest can build it without network access.
+    Returns False if libcxlmi_dir is not a libcxlmi git checkout.
+    """
+    if not os.path.exists(os.path.join(libcxlmi_dir, 'meson.build')):
+        return False
+    try:
+        files = subprocess.run(['git', '-C', libcxlmi_dir, 'ls-files', '-z'],
+                               capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return False
+
+    prefix = name
+    with tarfile.open(dst, 'w:gz') as tar:
+        for name in files.split('\0'):
+            path = os.path.join(libcxlmi_dir, name)
+            if name and os.path.isfile(path):
+                tar.add(path, arcname=os.path.join(prefix, name))
+    return True
+
+def pack_build_cmd(target_dir, remote_tar):
+    # Shell command run on the VM to pack a finished build for the cache
+    parent, name = os.path.split(os.path.normpath(target_dir))
+    dirs = ' '.join(os.path.join(name, d) for d in ARTIFACT_DIRS)
+    return f"tar -C {parent or '.'} --ignore-failed-read -czf {remote_tar} {dirs}"
+
+def unpack_cmd(remote_tar, target_dir):
+    parent = os.path.dirname(os.path.normpath(target_dir)) or '.'
+    return f"mkdir -p {parent} && tar -C {parent} -xzf {remote_tar} && rm -f {remote_tar}"
+
+def fetch_build(key, remote_tar, libcxlmi_rev, toolchain):
+    # Pull the packed build off the VM into the cache. Returns the cached path.
+    path = artifact_path(key)
+    if not guest.copy_from_remote(remote_tar, path):
+        print("WARN: Failed to copy libcxlmi build from VM, it will not be cached")
+        return None
+    record(key, path, libcxlmi_rev, toolchain)
+    return path
@@ -0,0 +1,93 @@
+"""
+Host-side build of the generated tests against a cached libcxlmi build (see
+artifacts.py). The binaries and libcxlmi.so are packed into one archive so
+they reach the VM in a single copy, and are linked with an $ORIGIN rpath so
+they run from wherever that archive is unpacked.
+
+The host compiler must produce binaries for the guest: set host_cc in
+.vars.config to a cross compiler or a container wrapper (for example
+"docker run --rm -v $PWD:$PWD -w $PWD guest-toolchain gcc"), and host_sysroot
+to the guest's sysroot if needed.
+"""
+import os
+import fcntl
+import shlex
+import shutil
+import tarfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+def extract_artifact(tarball):
+    # Unpack a cached libcxlmi build next to its tarball, once. The runners
+    # started by --jobs may all get here on a cold cache, so the check and
+    # the unpack happen under a lock on a sidecar file.
+    dst = tarball[:-len('.tar.gz')]
+    with open(dst + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.isdir(dst):
+            shutil.rmtree(dst + '.tmp', ignore_errors=True)
+            with tarfile.open(tarball, 'r:gz') as tar:
+                tar.extractall(dst + '.tmp')
+            os.replace(dst + '.tmp', dst)
+    return os.path.join(dst, os.listdir(dst)[0])
+
+def compile_cmd(c_file, binary, libcxlmi_dir, cc='gcc', sysroot=None, cflags=()):
+    cmd = shlex.split(os.path.expandvars(cc)) + list(cflags) + [c_file,
+                             f'-I{libcxlmi_dir}/src', f'-I{libcxlmi_dir}',
+                             f'-L{libcxlmi_dir}/build/src', '-lcxlmi', '-pthread',
+                             '-Wl,-rpath,$ORIGIN', '-o', binary]
+    if sysroot:
+        cmd.append(f'--sysroot={sysroot}')
+    return cmd
+
+def stamp_text(libcxlmi_dir, cflags=()):
+    return ' '.join([os.path.abspath(libcxlmi_dir)] + list(cflags))
+
+def up_to_date(c_file, binary, libcxlmi_dir, cflags=()):
+    """
+    A binary can be reused if it is newer than its source (which is only
+    rewritten when its inputs change, see generate_if_changed()) and was
+    built against the same libcxlmi build with the same flags, recorded in a
+    .stamp file.
+    """
+    stamp = binary + '.stamp'
+    if not os.path.exists(binary) or not os.path.exists(stamp):
+        return False
+    if os.path.getmtime(binary) < os.path.getmtime(c_file):
+        return False
+    with open(stamp, 'r') as f:
+        return f.read() == stamp_text(libcxlmi_dir, cflags)
+
+def build_tests(c_files, libcxlmi_dir, cc='gcc', sysroot=None, jobs=None, cflags=()):
+    """
+    Compile every generated test in parallel on the host, skipping those
+    whose binary is up to date.
+    Returns the list of binaries that are ready to ship.
+    """
+    def compile_one(c_file):
+        binary = c_file[:-2]
+        if up_to_date(c_file, binary, libcxlmi_dir, cflags):
+            return binary
+        proc = subprocess.run(compile_cmd(c_file, binary, libcxlmi_dir, cc, sysroot, cflags),
+                              capture_output=True, text=True)
+        if proc.returncode != 0:
+            print(f"ERROR: Failed to compile {c_file}:\n{proc.stderr}")
+            return None
+        with open(binary + '.stamp', 'w') as f:
+            f.write(stamp_text(libcxlmi_dir, cflags))
+        return binary
+
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        binaries = list(pool.map(compile_one, c_files))
+    return [binary for binary in binaries if binary is not None]
+
+def pack_tests(binaries, libcxlmi_dir, dst):
+    # One archive with every test binary plus the libcxlmi they link against
+    libdir = os.path.join(libcxlmi_dir, 'build', 'src')
+    with tarfile.open(dst, 'w:gz') as tar:
+        for binary in binaries:
+            tar.add(binary, arcname=os.path.basename(binary))
+        for name in os.listdir(libdir):
+            if name.startswith('libcxlmi.so'):
+                tar.add(os.path.join(libdir, name), arcname=name)
+    return dst
@@ -0,0 +1,87 @@
+import os
+import json
+import fcntl
+import hashlib
+import subprocess
+from contextlib import contextmanager
+
+# Host-side cache for state that survives between runs (snapshots, build
+# artifacts, parsed docs, ...). Unlike ./output it is never cleared.
+CACHE_DIR = './.cache'
+
+def cache_path(*parts):
+    path = os.path.join(CACHE_DIR, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+def hash_strings(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(str(part).encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def load_json(name, default=None):
+    path = cache_path(name)
+    if not os.path.exists(path):
+        return {} if default is None else default
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def save_json(name, data):
+    path = cache_path(name)
+    # Write then rename so an interrupted run never leaves a truncated file
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+@contextmanager
+def update_json(name):
+    """
+    Load a cached JSON file for changing and save it on exit, holding a lock
+    on a sidecar file throughout. The runners started by --jobs share the
+    cache, and without the lock one would drop the entries another added
+    between its load and save.
+    """
+    with open(cache_path(name + '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        data = load_json(name)
+        yield data
+        save_json(name, data)
+
+def hash_tree(path, skip=('.git', 'build')):
+    # Paths and contents of every file under path, in a stable order
+    h = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if d not in skip)
+        for name in sorted(files):
+            full_path = os.path.join(root, name)
+            if not os.path.isfile(full_path):
+                continue
+            h.update(os.path.relpath(full_path, path).encode() + b'\0')
+            h.update(hash_file(full_path).encode())
+    return h.hexdigest()
+
+def libcxlmi_revision(path):
+    """
+    Commit of the libcxlmi checkout. Local changes add a hash of the diff,
+    so two different dirty trees never share cached builds or snapshots.
+    A tree that is not a git checkout is named by a hash of its files.
+    """
+    try:
+        rev = subprocess.run(['git', '-C', path, 'rev-parse', 'HEAD'],
+                             capture_output=True, text=True, check=True).stdout.strip()
+        diff = subprocess.run(['git', '-C', path, 'diff', 'HEAD', '--binary'],
+                              capture_output=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        if not os.path.isdir(path):
+            return 'unknown'
+        return 'tree-' + hash_tree(path)[:16]
+    return rev + ('-dirty-' + hashlib.sha256(diff).hexdigest()[:16] if diff else '')
@@ -0,0 +1,280 @@
+"""
+Scale test generator: measures how endpoint discovery, opening and context
+handling in libcxlmi scale with the number of devices (see topo.scaled()).
+
+The program runs three phases against every endpoint of the VM:
+- discovery: cxlmi_scan_mctp() on a fresh context, then Identify (0001) on
+  every endpoint it found (cxlmi_for_each_endpoint_safe), and a scan of
+  /dev/cxl for the memdevs to open over ioctl
+- serial: one context, every endpoint opened and identified in turn
+- concurrent: one thread per endpoint, each with its own context (a context
+  is not shared between threads), all released at once
+
+It prints one SCALE_EP line per endpoint and phase with its context, open
+and Identify cost, and one SCALE line per phase with the totals and the
+fan-out time (wall clock from the first open to the last Identify). MCTP
+endpoints are taken from the nid:eid arguments, or default to consecutive
+EIDs from the topology's first one.
+"""
+import sys
+import cache
+import topo
+import generate_tests
+from generate_tests import PREFIX
+from parse_docs import generate_default_opcode_map
+
+# Part of the manifest hash, so editing this module regenerates the program
+GENERATOR_HASH = cache.hash_file(__file__)
+
+IDENTIFY_OPCODE = '0001'
+
+SCALE_HELPERS = """
+#include <pthread.h>
+#include <dirent.h>
+
+#define EXPECTED_MCTP {expected_mctp}
+#define EXPECTED_IOCTL {expected_ioctl}
+#define MAX_TARGETS 1024
+#define MAX_NAME 32
+
+struct target {{
+	int mctp;
+	unsigned int nid;
+	unsigned int eid;
+	char name[MAX_NAME];
+	pthread_t thread;
+	struct cxlmi_ctx *ctx;
+	struct cxlmi_endpoint *ep;
+	uint64_t ctx_ns, open_ns, identify_ns;
+	int rc;
+}};
+
+static struct target targets[MAX_TARGETS];
+static int ntargets;
+static pthread_barrier_t start_barrier;
+
+static int identify(struct cxlmi_endpoint *ep)
+{{
+	{rsp} rsp;
+
+	memset(&rsp, 0, sizeof(rsp));
+	return {func}(ep, NULL, &rsp);
+}}
+
+static void add_target(int mctp, unsigned int nid, unsigned int eid, const char *devname)
+{{
+	struct target *t = &targets[ntargets++];
+
+	assert(ntargets <= MAX_TARGETS);
+	t->mctp = mctp;
+	t->nid = nid;
+	t->eid = eid;
+	if (mctp)
+		snprintf(t->name, MAX_NAME, "%u:%u", nid, eid);
+	else
+		snprintf(t->name, MAX_NAME, "%s", devname);
+}}
+
+/* Open and identify one endpoint, timing both */
+static void run_target(struct cxlmi_ctx *ctx, struct target *t)
+{{
+	uint64_t start = now_ns();
+
+	t->ep = t->mctp ? cxlmi_open_mctp(ctx, t->nid, t->eid) : cxlmi_open(ctx, t->name);
+	t->open_ns = now_ns() - start;
+	if (!t->ep) {{
+		t->rc = -1;
+		return;
+	}}
+	start = now_ns();
+	t->rc = identify(t->ep);
+	t->identify_ns = now_ns() - start;
+}}
+
+static void *concurrent_worker(void *arg)
+{{
+	struct target *t = arg;
+	uint64_t start;
+
+	pthread_barrier_wait(&start_barrier);
+	start = now_ns();
+	t->ctx = cxlmi_new_ctx(stdout, DEFAULT_LOGLEVEL);
+	t->ctx_ns = now_ns() - start;
+	if (!t->ctx) {{
+		t->rc = -1;
+		return NULL;
+	}}
+	run_target(t->ctx, t);
+	return NULL;
+}}
+
+/* One SCALE_EP line per endpoint and the SCALE totals of a phase. Returns the errors */
+static int report_phase(const char *mode, uint64_t ctx_ns, uint64_t fanout_ns)
+{{
+	uint64_t open_ns = 0, open_max_ns = 0, identify_ns = 0, identify_max_ns = 0;
+	int errors = 0;
+
+	for (int i = 0; i < ntargets; i++) {{
+		struct target *t = &targets[i];
+
+		printf("SCALE_EP mode=%s transport=%s target=%s ctx_ns=%llu open_ns=%llu identify_ns=%llu rc=%d\\n",
+		       mode, t->mctp ? "mctp" : "ioctl", t->name, (unsigned long long)t->ctx_ns,
+		       (unsigned long long)t->open_ns, (unsigned long long)t->identify_ns, t->rc);
+		open_ns += t->open_ns;
+		identify_ns += t->identify_ns;
+		open_max_ns = MAX_SIZE(open_max_ns, t->open_ns);
+		identify_max_ns = MAX_SIZE(identify_max_ns, t->identify_ns);
+		if (t->rc != 0)
+			errors++;
+	}}
+	printf("SCALE mode=%s endpoints=%d errors=%d ctx_ns=%llu open_ns=%llu open_max_ns=%llu "
+	       "identify_ns=%llu identify_max_ns=%llu fanout_ns=%llu\\n",
+	       mode, ntargets, errors, (unsigned long long)ctx_ns, (unsigned long long)open_ns,
+	       (unsigned long long)open_max_ns, (unsigned long long)identify_ns,
+	       (unsigned long long)identify_max_ns, (unsigned long long)fanout_ns);
+	return errors;
+}}
+
+static void reset_targets(void)
+{{
+	for (int i = 0; i < ntargets; i++) {{
+		struct target *t = &targets[i];
+
+		if (t->ep)
+			cxlmi_close(t->ep);
+		if (t->ctx)
+			cxlmi_free_ctx(t->ctx);
+		t->ep = NULL;
+		t->ctx = NULL;
+		t->ctx_ns = t->open_ns = t->identify_ns = 0;
+		t->rc = 0;
+	}}
+}}
+"""
+
+SCALE_MAIN = """
+int main(int argc, char **argv) {{
+    struct cxlmi_ctx *ctx;
+    struct cxlmi_endpoint *ep, *tmp;
+    struct dirent *entry;
+    DIR *dir;
+    uint64_t start, ctx_ns, scan_ns, scan_identify_ns, readdir_ns;
+    int scanned = 0, scan_errors = 0, nmctp, errors = 0, i;
+
+    setvbuf(stdout, NULL, _IOLBF, 0);
+
+    /* Discovery: what a host that knows nothing about its devices does */
+    ctx = cxlmi_new_ctx(stdout, DEFAULT_LOGLEVEL);
+    assert(ctx != NULL);
+    start = now_ns();
+    if (cxlmi_scan_mctp(ctx) < 0)
+        printf("MCTP scan failed\\n");
+    scan_ns = now_ns() - start;
+    start = now_ns();
+    cxlmi_for_each_endpoint_safe(ctx, ep, tmp) {{
+        scanned++;
+        if (identify(ep) != 0)
+            scan_errors++;
+        cxlmi_close(ep);
+    }}
+    scan_identify_ns = now_ns() - start;
+    cxlmi_free_ctx(ctx);
+
+    for (i = 1; i < argc; i++) {{
+        unsigned int nid, eid;
+
+        if (sscanf(argv[i], "%u:%u", &nid, &eid) != 2) {{
+            printf("Invalid MCTP endpoint %s, expected nid:eid\\n", argv[i]);
+            return EXIT_FAILURE;
+        }}
+        add_target(1, nid, eid, NULL);
+    }}
+    for (i = 0; argc == 1 && i < EXPECTED_MCTP; i++)
+        add_target(1, {nid}, {eid} + i, NULL);
+    nmctp = ntargets;
+
+    start = now_ns();
+    dir = opendir("/dev/cxl");
+    while (dir && (entry = readdir(dir)) != NULL)
+        if (strncmp(entry->d_name, "mem", 3) == 0)
+            add_target(0, 0, 0, entry->d_name);
+    if (dir)
+        closedir(dir);
+    readdir_ns = now_ns() - start;
+
+    printf("SCALE mode=discovery mctp_found=%d mctp_expected=%d scan_ns=%llu scan_identify_ns=%llu "
+           "scan_errors=%d ioctl_found=%d ioctl_expected=%d readdir_ns=%llu\\n",
+           scanned, EXPECTED_MCTP, (unsigned long long)scan_ns, (unsigned long long)scan_identify_ns,
+           scan_errors, ntargets - nmctp, EXPECTED_IOCTL, (unsigned long long)readdir_ns);
+    if (scanned != EXPECTED_MCTP || scan_errors || ntargets - nmctp != EXPECTED_IOCTL)
+        errors++;
+
+    /* Serial: one context, one endpoint after the other */
+    start = now_ns();
+    ctx = cxlmi_new_ctx(stdout, DEFAULT_LOGLEVEL);
+    assert(ctx != NULL);
+    ctx_ns = now_ns() - start;
+    start = now_ns();
+    for (i = 0; i < ntargets; i++)
+        run_target(ctx, &targets[i]);
+    errors += report_phase("serial", ctx_ns, now_ns() - start);
+    reset_targets();
+    cxlmi_free_ctx(ctx);
+
+    /* Concurrent: a thread and a context per endpoint */
+    if (pthread_barrier_init(&start_barrier, NULL, ntargets + 1) != 0) {{
+        printf("Failed to set up the start barrier\\n");
+        fprintf(stdout, "Tests failed\\n");
+        return EXIT_FAILURE;
+    }}
+    for (i = 0; i < ntargets; i++) {{
+        if (pthread_create(&targets[i].thread, NULL, concurrent_worker, &targets[i]) != 0) {{
+            /* The started threads wait on the barrier for the missing ones */
+            printf("Failed to start the thread of %s\\n", targets[i].name);
+            fprintf(stdout, "Tests failed\\n");
+            return EXIT_FAILURE;
+        }}
+    }}
+    pthread_barrier_wait(&start_barrier);
+    start = now_ns();
+    for (i = 0; i < ntargets; i++)
+        pthread_join(targets[i].thread, NULL);
+    ctx_ns = 0;
+    for (i = 0; i < ntargets; i++)
+        ctx_ns += targets[i].ctx_ns;
+    errors += report_phase("concurrent", ctx_ns, now_ns() - start);
+    reset_targets();
+    pthread_barrier_destroy(&start_barrier);
+
+    if (errors) {{
+        fprintf(stdout, "Tests failed\\n");
+        return EXIT_FAILURE;
+    }}
+    printf("All tests passed\\n");
+    return 0;
+}}
+"""
+
+def expected_endpoints(suite_info):
+    # (MCTP endpoints, ioctl memdevs) the topology was built with
+    params = topo.params(suite_info)
+    return params['mctp_endpoints'], params['type3'] + params['dcds']
+
+def mctp_addresses(suite_info):
+    # i2c addresses of the MCTP endpoints, the first one is set up by mctp.sh
+    params = topo.params(suite_info)
+    return [params['i2c_address'] + i for i in range(params['mctp_endpoints'])]
+
+def generate_scale_file(output_name, suite_info, opcode_map):
+    mapping = opcode_map[IDENTIFY_OPCODE]
+    expected_mctp, expected_ioctl = expected_endpoints(suite_info)
+    nid, eid = suite_info['mctp']
+    with open(generate_tests.OUTPUT_DIR + "/" + output_name, 'w', newline='') as f:
+        f.write(PREFIX + "\n")
+        f.write(SCALE_HELPERS.format(expected_mctp=expected_mctp, expected_ioctl=expected_ioctl,
+                                     rsp=mapping['rsp'], func=mapping['function']))
+        f.write(SCALE_MAIN.format(nid=nid, eid=eid))
+
+if __name__ == "__main__":
+    topo.rebuild(**topo.parse_params(sys.argv[1:]))
+    generate_scale_file("scale.c", topo.SCALE, generate_default_opcode_map())
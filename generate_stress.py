@@ -0,0 +1,401 @@
+"""
+Stress test generator: runs a weighted mix of the suite's commands on K
+threads for a fixed duration, either sharing one endpoint (and context) per
+transport or with a context and endpoint per thread. Threads are spread over
+the given transports, so a suite with both an MCTP and an ioctl endpoint can
+hit the MCTP path and the mailbox at the same time.
+
+The program prints one STRESS line with the aggregate throughput, latency
+distribution, rc errors and response mismatches, and one STRESS_CMD line per
+command in the mix. It exits non-zero if any command failed or mismatched.
+"""
+import io
+import sys
+import cache
+import topo
+import generate_tests
+from generate_tests import (PREFIX, VERIFY_HELPERS, generate_struct_code, generate_function_call,
+                            is_idempotent, iter_commands, tunnel_code, response_size, write_struct_code,
+                            write_check_table)
+from parse_docs import generate_default_opcode_map
+
+# Part of the manifest hash, so editing this module regenerates the programs
+GENERATOR_HASH = cache.hash_file(__file__)
+
+STRESS_HELPERS = """
+#include <pthread.h>
+
+#define NUM_THREADS {threads}
+#define DURATION_NS ({duration_ms}ULL * 1000000ULL)
+#define SHARED_ENDPOINTS {shared}
+#define NUM_TRANSPORTS {num_transports}
+#define NUM_CMDS {num_cmds}
+/*
+ * Latency samples kept per thread. Past this, each thread keeps a uniform
+ * random sample of all its ops (reservoir sampling), so the percentiles
+ * cover the whole run and not only its start
+ */
+#define MAX_SAMPLES 100000
+
+typedef int (*stress_fn)(struct cxlmi_endpoint *ep, void *buf, int *mismatch);
+
+struct stress_cmd {{
+	const char *opcode;
+	const char *func;
+	stress_fn fn;
+}};
+
+struct worker {{
+	pthread_t thread;
+	struct cxlmi_ctx *ctx;
+	struct cxlmi_endpoint *ep;
+	unsigned int seed;
+	uint64_t ops, errors, mismatches;
+	uint64_t cmd_ops[NUM_CMDS], cmd_errors[NUM_CMDS], cmd_mismatches[NUM_CMDS];
+	uint64_t *samples;
+	size_t nsamples;
+	uint64_t min_ns, max_ns;
+}};
+
+/* A sample standing for `weight` ops of its thread, for merging reservoirs */
+struct weighted {{
+	uint64_t ns;
+	double weight;
+}};
+
+static uint64_t deadline_ns;
+
+static int cmp_weighted(const void *a, const void *b)
+{{
+	uint64_t x = ((const struct weighted *)a)->ns, y = ((const struct weighted *)b)->ns;
+
+	return (x > y) - (x < y);
+}}
+
+/* Latency at or below which a fraction q of the ops fell, from sorted samples */
+static uint64_t percentile(const struct weighted *samples, size_t n, double total, double q)
+{{
+	double seen = 0;
+	size_t i;
+
+	for (i = 0; i < n; i++) {{
+		seen += samples[i].weight;
+		if (seen >= q * total)
+			return samples[i].ns;
+	}}
+	return n ? samples[n - 1].ns : 0;
+}}
+"""
+
+STRESS_WORKER = """
+static void *stress_worker(void *arg)
+{
+	struct worker *w = arg;
+	void *buf = calloc(1, STRESS_BUF_SIZE);
+
+	assert(buf != NULL);
+	while (now_ns() < deadline_ns) {
+		int c = schedule[rand_r(&w->seed) % SCHEDULE_LEN];
+		int mismatch = 0;
+		uint64_t start = now_ns();
+		int rc = cmds[c].fn(w->ep, buf, &mismatch);
+		uint64_t elapsed = now_ns() - start;
+
+		w->ops++;
+		w->cmd_ops[c]++;
+		if (rc != 0) {
+			w->errors++;
+			w->cmd_errors[c]++;
+		} else if (mismatch) {
+			w->mismatches++;
+			w->cmd_mismatches[c]++;
+		}
+		if (elapsed < w->min_ns)
+			w->min_ns = elapsed;
+		if (elapsed > w->max_ns)
+			w->max_ns = elapsed;
+		if (w->nsamples < MAX_SAMPLES) {
+			w->samples[w->nsamples++] = elapsed;
+		} else {
+			/* Replace a kept sample with probability MAX_SAMPLES / ops */
+			uint64_t j = (((uint64_t)rand_r(&w->seed) << 31) | rand_r(&w->seed)) % w->ops;
+
+			if (j < MAX_SAMPLES)
+				w->samples[j] = elapsed;
+		}
+	}
+	free(buf);
+	return NULL;
+}
+"""
+
+STRESS_MAIN = """
+int main() {
+    struct cxlmi_ctx *ctx;
+    struct cxlmi_endpoint *eps[NUM_TRANSPORTS] = { NULL };
+    struct worker workers[NUM_THREADS];
+    uint64_t ops = 0, errors = 0, mismatches = 0, min_ns = UINT64_MAX, max_ns = 0;
+    struct weighted *samples;
+    size_t nsamples = 0, s;
+    int i, c, t, rc = EXIT_FAILURE;
+
+    memset(workers, 0, sizeof(workers));
+    ctx = cxlmi_new_ctx(stdout, DEFAULT_LOGLEVEL);
+    assert(ctx != NULL);
+
+    for (t = 0; SHARED_ENDPOINTS && t < NUM_TRANSPORTS; t++) {
+        eps[t] = open_endpoint(ctx, t);
+        if (!eps[t]) {
+            printf("Failed to open %s endpoint\\n", transports[t]);
+            goto cleanup;
+        }
+    }
+
+    for (i = 0; i < NUM_THREADS; i++) {
+        struct worker *w = &workers[i];
+
+        w->seed = i + 1;
+        w->min_ns = UINT64_MAX;
+        w->samples = calloc(MAX_SAMPLES, sizeof(uint64_t));
+        assert(w->samples != NULL);
+        if (SHARED_ENDPOINTS) {
+            w->ep = eps[i % NUM_TRANSPORTS];
+        } else {
+            w->ctx = cxlmi_new_ctx(stdout, DEFAULT_LOGLEVEL);
+            assert(w->ctx != NULL);
+            w->ep = open_endpoint(w->ctx, i % NUM_TRANSPORTS);
+            if (!w->ep) {
+                printf("Thread %d failed to open %s endpoint\\n", i, transports[i % NUM_TRANSPORTS]);
+                goto cleanup;
+            }
+        }
+    }
+
+    uint64_t start_ns = now_ns();
+    deadline_ns = start_ns + DURATION_NS;
+    for (i = 0; i < NUM_THREADS; i++) {
+        if (pthread_create(&workers[i].thread, NULL, stress_worker, &workers[i]) != 0) {
+            printf("Failed to start thread %d\\n", i);
+            /* Stop the threads already running before bailing out */
+            deadline_ns = 0;
+            break;
+        }
+    }
+    for (t = 0; t < i; t++)
+        pthread_join(workers[t].thread, NULL);
+    if (i < NUM_THREADS)
+        goto cleanup;
+    uint64_t total_ns = now_ns() - start_ns;
+
+    /*
+     * A thread's samples each stand for ops / nsamples of its ops, so busier
+     * threads count for more in the percentiles. min and max are exact
+     */
+    samples = calloc((size_t)NUM_THREADS * MAX_SAMPLES, sizeof(*samples));
+    assert(samples != NULL);
+    for (i = 0; i < NUM_THREADS; i++) {
+        struct worker *w = &workers[i];
+
+        ops += w->ops;
+        errors += w->errors;
+        mismatches += w->mismatches;
+        if (w->min_ns < min_ns)
+            min_ns = w->min_ns;
+        if (w->max_ns > max_ns)
+            max_ns = w->max_ns;
+        for (s = 0; s < w->nsamples; s++) {
+            samples[nsamples].ns = w->samples[s];
+            samples[nsamples++].weight = (double)w->ops / w->nsamples;
+        }
+    }
+    qsort(samples, nsamples, sizeof(*samples), cmp_weighted);
+
+    printf("STRESS threads=%d endpoints=%s transports=%s duration_ms=%llu ops=%llu errors=%llu "
+           "mismatches=%llu ops_per_sec=%.1f samples=%zu dropped=%llu "
+           "min_ns=%llu p50_ns=%llu p99_ns=%llu max_ns=%llu\\n",
+           NUM_THREADS, SHARED_ENDPOINTS ? "shared" : "per-thread", TRANSPORT_NAMES,
+           (unsigned long long)(total_ns / 1000000), (unsigned long long)ops,
+           (unsigned long long)errors, (unsigned long long)mismatches,
+           ops * 1e9 / total_ns, nsamples, (unsigned long long)(ops - nsamples),
+           (unsigned long long)(ops ? min_ns : 0),
+           (unsigned long long)percentile(samples, nsamples, ops, 0.50),
+           (unsigned long long)percentile(samples, nsamples, ops, 0.99),
+           (unsigned long long)max_ns);
+    free(samples);
+
+    for (c = 0; c < NUM_CMDS; c++) {
+        uint64_t cmd_ops = 0, cmd_errors = 0, cmd_mismatches = 0;
+
+        for (i = 0; i < NUM_THREADS; i++) {
+            cmd_ops += workers[i].cmd_ops[c];
+            cmd_errors += workers[i].cmd_errors[c];
+            cmd_mismatches += workers[i].cmd_mismatches[c];
+        }
+        printf("STRESS_CMD opcode=%s function=%s ops=%llu errors=%llu mismatches=%llu\\n",
+               cmds[c].opcode, cmds[c].func, (unsigned long long)cmd_ops,
+               (unsigned long long)cmd_errors, (unsigned long long)cmd_mismatches);
+    }
+    rc = (ops == 0 || errors || mismatches) ? EXIT_FAILURE : 0;
+
+cleanup:
+    for (i = 0; i < NUM_THREADS; i++) {
+        if (!SHARED_ENDPOINTS && workers[i].ep)
+            cxlmi_close(workers[i].ep);
+        if (workers[i].ctx)
+            cxlmi_free_ctx(workers[i].ctx);
+        free(workers[i].samples);
+    }
+    for (t = 0; t < NUM_TRANSPORTS; t++)
+        if (eps[t])
+            cxlmi_close(eps[t]);
+    cxlmi_free_ctx(ctx);
+    if (rc != 0) {
+        fprintf(stdout, "Tests failed\\n");
+    } else {
+        printf("All tests passed\\n");
+    }
+    return rc;
+}
+"""
+
+def parse_mix(mix):
+    """
+    Parse a mix like "0001:3,0500" into {opcode: weight}. Opcodes without a
+    weight get 1. Returns None for an empty mix. Raises ValueError for a
+    malformed item or a weight below 1, which would leave commands out of
+    the schedule (or the schedule empty).
+    """
+    if not mix:
+        return None
+    weights = {}
+    for item in mix.split(','):
+        opcode, _, weight = item.partition(':')
+        weight = weight.strip() or '1'
+        if not opcode.strip() or not weight.isdigit() or int(weight) < 1:
+            raise ValueError(f"Invalid --mix item '{item}', expected opcode[:weight] with a weight of at least 1")
+        weights[opcode.strip()] = int(weight)
+    return weights
+
+def generate_open_endpoint(suite_info, transports):
+    # open_endpoint(ctx, t) opens transport t (an index into transports[])
+    cases = ""
+    for t, transport in enumerate(transports):
+        if transport == 'mctp':
+            nid, eid = suite_info['mctp']
+            cases += f"\tcase {t}:\n\t\treturn cxlmi_open_mctp(ctx, {nid}, {eid});\n"
+        else:
+            cases += f"\tcase {t}:\n\t\treturn cxlmi_open(ctx, \"{suite_info['ioctl']}\");\n"
+    names = ', '.join(f'"{transport}"' for transport in transports)
+    return f"""
+static const char *transports[NUM_TRANSPORTS] = {{ {names} }};
+#define TRANSPORT_NAMES "{','.join(transports)}"
+
+static struct cxlmi_endpoint *open_endpoint(struct cxlmi_ctx *ctx, int t)
+{{
+	switch (t) {{
+{cases}\
+	}}
+	return NULL;
+}}
+"""
+
+def generate_stress_cmd(command, mapping):
+    """
+    Generate one command as a function run by the workers. The expected
+    response is static const so it is built once and shared by all threads.
+    """
+    n = generate_tests.G_COUNT
+    request = command.find("request")
+    response = command.find("response")
+
+    req_code, expected_code, checks = "", "", ""
+    if request is not None:
+        req_code, _ = generate_struct_code(generate_tests.get_req_str(), mapping['req'], request,
+                                           indent_level=1)
+    if response is not None:
+        # Same field table as the tests (see write_check_table()), but the
+        # mismatches are only counted: there can be millions
+        out, fields = io.StringIO(), []
+        write_struct_code(out, generate_tests.get_expected_str(), "static const " + mapping['rsp'],
+                          response, indent_level=1, fields=fields)
+        if fields:
+            write_check_table(out, mapping['rsp'], fields, 1)
+            checks = (f"        *mismatch = count_mismatches(&{generate_tests.get_expected_str()}, "
+                      f"{generate_tests.get_actual_str()}, checks_{generate_tests.G_COUNT}, "
+                      f"ARRAY_SIZE(checks_{generate_tests.G_COUNT})) > 0;\n")
+        expected_code = out.getvalue()
+    tunnel_decl, tunnel_info, _ = tunnel_code(command, indent="    ")
+    cast_rsp, function_call = generate_function_call(mapping, request is not None,
+                                                     response is not None, tunnel_info)
+    return f"""
+static int stress_cmd_{n}(struct cxlmi_endpoint *ep, void *buf, int *mismatch)
+{{
+{tunnel_decl}{req_code}{expected_code}\
+    {cast_rsp}
+    int rc = {function_call};
+
+    if (rc == 0) {{
+{checks}\
+    }}
+    return rc;
+}}
+"""
+
+def generate_stress_file(output_name, commands, suite_info, opcode_map, transports,
+                         threads=4, duration_s=10, shared=True, mix=None):
+    """
+    Generate the stress program. mix maps opcode -> weight; by default every
+    idempotent command of the suite runs with weight 1. commands is read
+    once, so it can be a stream (see generate_tests.iter_commands()).
+    """
+    selected = [command for command in commands
+                if (is_idempotent(command) if mix is None else command.attrib['opcode'] in mix)
+                and command.attrib['opcode'] in opcode_map]
+    if mix is None:
+        mix = {command.attrib['opcode']: 1 for command in selected}
+    if not selected:
+        raise ValueError("No commands selected for the stress mix")
+
+    generate_tests.TUNNEL = suite_info.get('tunnel')
+    with open(generate_tests.OUTPUT_DIR + "/" + output_name, 'w', newline='') as f:
+        f.write(PREFIX + "\n")
+        f.write(VERIFY_HELPERS)
+        f.write(STRESS_HELPERS.format(threads=threads, duration_ms=int(duration_s * 1000),
+                                      shared=1 if shared else 0,
+                                      num_transports=len(transports),
+                                      num_cmds=len(selected)))
+        f.write(generate_open_endpoint(suite_info, transports))
+
+        table, schedule, buf_size = "", [], "MAX_PAYLOAD_SIZE"
+        for i, command in enumerate(selected):
+            opcode = command.attrib['opcode']
+            mapping = opcode_map[opcode]
+            f.write(generate_stress_cmd(command, mapping))
+            table += f'\t{{ "{opcode}", "{mapping["function"]}", stress_cmd_{generate_tests.G_COUNT} }},\n'
+            schedule += [str(i)] * mix[opcode]
+            if command.find("response") is not None:
+                buf_size = f"MAX_SIZE({buf_size}, {response_size(command, mapping)})"
+            generate_tests.G_COUNT += 1
+        generate_tests.G_COUNT = 1
+
+        f.write(f"\nstatic const struct stress_cmd cmds[NUM_CMDS] = {{\n{table}}};\n")
+        f.write(f"\n/* Weighted mix: each entry is an index into cmds[] */\n"
+                f"static const int schedule[] = {{ {', '.join(schedule)} }};\n"
+                f"#define SCHEDULE_LEN (sizeof(schedule) / sizeof(schedule[0]))\n"
+                f"\n/* Each worker's response buffer fits the largest response in the mix */\n"
+                f"#define STRESS_BUF_SIZE {buf_size}\n")
+        f.write(STRESS_WORKER)
+        f.write(STRESS_MAIN)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python generate_stress.py <suite> [threads] [duration_s] [mix]")
+        sys.exit(1)
+
+    suite = topo.SUITES[sys.argv[1].upper()]
+    transports = [t for t in ('mctp', 'ioctl') if suite[t] is not None]
+    generate_stress_file(f"stress-{sys.argv[1].lower()}.c", iter_commands(suite['input']), suite,
+                         generate_default_opcode_map(), transports,
+                         threads=int(sys.argv[2]) if len(sys.argv) > 2 else 4,
+                         duration_s=float(sys.argv[3]) if len(sys.argv) > 3 else 10,
+                         mix=parse_mix(sys.argv[4]) if len(sys.argv) > 4 else None)
@@ -1,20 +1,122 @@
+import os
 import sys
+import io
+import json
+import textwrap
 import topo
+import cache
 from parse_docs import generate_default_opcode_map, print_opcode_map
 import xml.etree.ElementTree as ET
 
 PREFIX = """#include <stdio.h>
 #include <stdlib.h>
+#include <string.h>
 #include <assert.h>
+#include <stdint.h>
+#include <stddef.h>
+#include <time.h>
+#include <signal.h>
+#include <unistd.h>
 #include <libcxlmi.h>
 
+#ifndef CMD_TIMEOUT_S
+#define CMD_TIMEOUT_S 0
+#endif
+
+/* Initial size of the response buffer, grown by rsp_buf() as needed */
 #define MAX_PAYLOAD_SIZE 4096
+#define MAX_SIZE(a, b) ((a) > (b) ? (a) : (b))
 
 static inline void freep(void *p)
 {
 	free(*(void **)p);
 }
 #define _cleanup_free_ __attribute__((cleanup(freep)))
+/* Helpers every generated program gets but not every program calls */
+#define _maybe_unused_ __attribute__((unused))
+
+/*
+ * Make the response buffer at least size bytes and clear it. *buf_size
+ * tracks its current size.
+ */
+_maybe_unused_ static void *rsp_buf(void *buf, size_t *buf_size, size_t size)
+{
+	if (size > *buf_size) {
+		buf = realloc(buf, size);
+		assert(buf != NULL);
+		*buf_size = size;
+	}
+	memset(buf, 0, *buf_size);
+	return buf;
+}
+
+static inline uint64_t now_ns(void)
+{
+	struct timespec ts;
+
+	clock_gettime(CLOCK_MONOTONIC, &ts);
+	return (uint64_t)ts.tv_sec * 1000000000ULL + ts.tv_nsec;
+}
+
+/*
+ * One machine-readable line per command, parsed by run_tests.py.
+ * ns is the time spent in the cxlmi_cmd_*() call, or -1 if not timed.
+ * tunnel is the number of tunnel levels the command went through.
+ */
+_maybe_unused_ static void report_result(const char *opcode, const char *func, int rc, long long ns,
+					  int tunnel)
+{
+	printf("RESULT opcode=%s function=%s status=%s rc=%d",
+	       opcode, func, rc ? "FAIL" : "PASS", rc);
+	if (ns >= 0)
+		printf(" ns=%lld", ns);
+	if (tunnel > 0)
+		printf(" tunnel=%d", tunnel);
+	printf("\\n");
+}
+
+/*
+ * Per-command watchdog: a command still running after CMD_TIMEOUT_S
+ * seconds is reported as timed out and the test exits, so one wedged
+ * device does not hang the run. 0 disables it.
+ */
+static const char *watchdog_opcode = "", *watchdog_func = "";
+
+#define WATCHDOG_STR_(x) #x
+#define WATCHDOG_STR(x) WATCHDOG_STR_(x)
+
+/* Only write() and strlen() here, the alarm may interrupt stdio or malloc */
+_maybe_unused_ static void watchdog_write(const char *s)
+{
+	write(STDOUT_FILENO, s, strlen(s));
+}
+
+_maybe_unused_ static void watchdog_fired(int sig)
+{
+	watchdog_write("RESULT opcode=");
+	watchdog_write(watchdog_opcode);
+	watchdog_write(" function=");
+	watchdog_write(watchdog_func);
+	watchdog_write(" status=TIMEOUT rc=-1\\nError: Function ");
+	watchdog_write(watchdog_func);
+	watchdog_write(" (");
+	watchdog_write(watchdog_opcode);
+	watchdog_write("h) timed out after " WATCHDOG_STR(CMD_TIMEOUT_S) " s\\n");
+	_exit(124);
+}
+
+_maybe_unused_ static void watchdog_arm(const char *opcode, const char *func)
+{
+	watchdog_opcode = opcode;
+	watchdog_func = func;
+	signal(SIGALRM, watchdog_fired);
+	alarm(CMD_TIMEOUT_S);
+}
+
+_maybe_unused_ static void watchdog_cancel(void)
+{
+	alarm(0);
+}
 """
 
 ASSERT_MACRO = """
@@ -27,18 +129,130 @@ ASSERT_MACRO = """
     }
 """
 
+VERIFY_HELPERS = """
+#include <stddef.h>
+
+#define ARRAY_SIZE(a) (sizeof(a) / sizeof((a)[0]))
+
+/* One response field to verify: where it is, how big, which bits count */
+struct field_check {
+	const char *name;
+	size_t offset;
+	size_t size;
+	uint64_t mask;
+};
+
+#define FIELD_CHECK(type, member, mask) \\
+	{ #member, offsetof(type, member), sizeof(((type *)0)->member), mask }
+
+/*
+ * Whether one field differs between the expected and actual response (its
+ * values are left in *ev and *av). Fields of up to 8 bytes are compared as
+ * (little-endian) integers under their mask, larger ones (arrays) byte by
+ * byte.
+ */
+_maybe_unused_ static int field_differs(const void *expected, const void *actual,
+					const struct field_check *check, uint64_t *ev, uint64_t *av)
+{
+	const uint8_t *e = (const uint8_t *)expected + check->offset;
+	const uint8_t *a = (const uint8_t *)actual + check->offset;
+
+	if (check->size > sizeof(uint64_t))
+		return memcmp(e, a, check->size) != 0;
+	*ev = *av = 0;
+	memcpy(ev, e, check->size);
+	memcpy(av, a, check->size);
+	return ((*ev ^ *av) & check->mask) != 0;
+}
+
+/*
+ * Compare the fields listed in checks between the expected and actual
+ * response and print every mismatch. Returns the number of mismatches.
+ */
+_maybe_unused_ static int verify_fields(const void *expected, const void *actual,
+					const struct field_check *checks, size_t n)
+{
+	int mismatches = 0;
+
+	for (size_t i = 0; i < n; i++) {
+		uint64_t ev, av;
+
+		if (!field_differs(expected, actual, &checks[i], &ev, &av))
+			continue;
+		if (checks[i].size <= sizeof(uint64_t))
+			printf("Assertion failed: %s = %llu, expected %llu\\n", checks[i].name,
+			       (unsigned long long)(av & checks[i].mask),
+			       (unsigned long long)(ev & checks[i].mask));
+		else
+			printf("Assertion failed: %s (%zu bytes) differs\\n",
+			       checks[i].name, checks[i].size);
+		mismatches++;
+	}
+	return mismatches;
+}
+
+/* verify_fields() without the printing, for callers that run millions of checks */
+_maybe_unused_ static int count_mismatches(const void *expected, const void *actual,
+					   const struct field_check *checks, size_t n)
+{
+	int mismatches = 0;
+
+	for (size_t i = 0; i < n; i++) {
+		uint64_t ev, av;
+
+		mismatches += field_differs(expected, actual, &checks[i], &ev, &av);
+	}
+	return mismatches;
+}
+"""
+
 MAIN = """
 int main() {
     struct cxlmi_ctx *ctx;
     struct cxlmi_endpoint *ep, *tmp;
     void *buf = calloc(1, MAX_PAYLOAD_SIZE);
+    size_t buf_size = MAX_PAYLOAD_SIZE;
     int rc = EXIT_FAILURE;
 
     assert(buf != NULL);
+    /* Line buffered so run_tests.py can stream the results as they come */
+    setvbuf(stdout, NULL, _IOLBF, 0);
     ctx = cxlmi_new_ctx(stdout, DEFAULT_LOGLEVEL);
     assert(ctx != NULL);
 """
 
+BATCH_DECLS = """    int failures = 0;
+"""
+
+BATCH_SUMMARY = """
+    printf("%d of %d commands failed\\n", failures, {count});
+    rc = failures ? EXIT_FAILURE : 0;
+"""
+
+BENCH_HELPERS = """
+static int cmp_u64(const void *a, const void *b)
+{
+	uint64_t x = *(const uint64_t *)a, y = *(const uint64_t *)b;
+
+	return (x > y) - (x < y);
+}
+
+/* Sorts the samples. One BENCH line per command, parsed by run_tests.py */
+static void report_bench(const char *opcode, const char *func, const char *transport,
+			 uint64_t *samples, int n, int errors, uint64_t total_ns, int tunnel)
+{
+	qsort(samples, n, sizeof(*samples), cmp_u64);
+	printf("BENCH opcode=%s function=%s transport=%s tunnel=%d iterations=%d errors=%d "
+	       "min_ns=%llu p50_ns=%llu p99_ns=%llu max_ns=%llu ops_per_sec=%.1f\\n",
+	       opcode, func, transport, tunnel, n, errors,
+	       (unsigned long long)samples[0],
+	       (unsigned long long)samples[n / 2],
+	       (unsigned long long)samples[n * 99 / 100],
+	       (unsigned long long)samples[n - 1],
+	       n * 1e9 / total_ns);
+}
+"""
+
 FOOTER = """
 cleanup:
     cxlmi_close(ep);
@@ -60,6 +274,24 @@ G_INDENT_LEVEL = 2
 ASSERT_INDENT = "    " * G_INDENT_LEVEL
 ASSERT_TYPE = "ASSERT_EQUAL"
 TUNNEL_INFO = "NULL"
+# Tunnel spec of the suite being generated (see parse_tunnel()), set by
+# write_header(). A <command tunnel="..."> overrides it for that command
+TUNNEL = None
+# kind: (libcxlmi macro, number of arguments, tunnel levels)
+TUNNEL_MACROS = {
+    'switch-local': ('DEFINE_CXLMI_TUNNEL_SWITCH_LOCAL', 0, 1),
+    'switch': ('DEFINE_CXLMI_TUNNEL_SWITCH', 1, 1),
+    'mld': ('DEFINE_CXLMI_TUNNEL_MLD', 1, 1),
+    'switch-mld': ('DEFINE_CXLMI_TUNNEL_SWITCH_MLD', 2, 2),
+}
+OUTPUT_DIR = "./output"
+# Wrap each command call in monotonic timestamps and report the elapsed time
+TIMED = False
+# Seconds a single command may take before the test gives up (0: no limit)
+CMD_TIMEOUT = 0
+# How responses are checked: 'table' (one field_check table per response and
+# one compare loop) or 'assert' (one ASSERT_EQUAL per field)
+VERIFY = 'table'
 
 def get_expected_str():
     return 'expected_' + str(G_COUNT)
@@ -70,10 +302,44 @@ def get_actual_str():
 def get_req_str():
     return 'request_' + str(G_COUNT)
 
-def generate_struct_body(element, indent_level=0, expected_name="expected_rsp", actual_name="actual"):
+def parse_tunnel(spec):
+    """
+    Parse a tunnel spec "kind[:arg[:arg]]" with a kind from TUNNEL_MACROS,
+    e.g. "mld:0" (LD 0), "switch:2" (downstream port 2) or "switch-mld:2:0".
+    Returns (macro, args, levels), or None for "none" or no spec (direct).
+    """
+    if not spec or spec == 'none':
+        return None
+    kind, *args = spec.split(':')
+    if kind not in TUNNEL_MACROS or len(args) != TUNNEL_MACROS[kind][1] or \
+            not all(arg.isdigit() for arg in args):
+        raise ValueError(f"Invalid tunnel {spec}, expected one of "
+                         "switch-local, switch:PORT, mld:LD, switch-mld:PORT:LD or none")
+    macro, _, levels = TUNNEL_MACROS[kind]
+    return macro, args, levels
+
+def tunnel_code(command, indent=ASSERT_INDENT):
+    """
+    Return the declaration of the command's tunnel info (or ""), the pointer
+    to pass to its cxlmi_cmd_*() and its number of tunnel levels.
+    """
+    tunnel = parse_tunnel(command.attrib.get('tunnel', TUNNEL))
+    if tunnel is None:
+        return "", TUNNEL_INFO, 0
+    macro, args, levels = tunnel
+    name = f"tunnel_{G_COUNT}"
+    return f"{indent}{macro}({', '.join([name] + args)});\n", f"&{name}", levels
+
+def write_struct_body(out, element, indent_level, expected_name, actual_name, assert_type, assertions,
+                      fields=None):
+    """
+    Write the initializer of element to the stream out, depth first, and
+    append its assertions to the list assertions (and, if given, each scalar
+    field's path and mask attribute to fields). Nothing is built up by
+    concatenation, so time and memory stay linear in the size of the XML.
+    """
     indent = "    " * indent_level
-    struct_body = "{\n"
-    assertions = ""
+    out.write("{\n")
 
     for child in element:
         field_name = child.tag
@@ -81,39 +347,72 @@ def generate_struct_body(element, indent_level=0, expected_name="expected_rsp",
 
         # Case: Array of structs
         if len(child_elements) > 1 and all(e.tag == child_elements[0].tag for e in child_elements):
-            struct_body += f"{indent}    .{field_name} = {{\n"
+            out.write(f"{indent}    .{field_name} = {{\n")
             for i, entry in enumerate(child_elements):
-                nested_body, nested_assertions = generate_struct_body(
-                    entry,
-                    indent_level + 2,
-                    f"{expected_name}.{field_name}[{i}]",
-                    f"&{actual_name}->{field_name}[{i}]"
-                )
-                struct_body += f"{indent}        {nested_body},\n"
-                assertions += nested_assertions
-            struct_body += f"{indent}    }},\n"
+                out.write(f"{indent}        ")
+                write_struct_body(out, entry, indent_level + 2,
+                                  f"{expected_name}.{field_name}[{i}]",
+                                  f"&{actual_name}->{field_name}[{i}]",
+                                  assert_type, assertions, fields)
+                out.write(",\n")
+            out.write(f"{indent}    }},\n")
 
         # Case: Nested struct
         elif len(child_elements) > 0:
-            nested_body, nested_assertions = generate_struct_body(
-                child,
-                indent_level + 1,
-                f"{expected_name}.{field_name}",
-                f"{actual_name}->{field_name}"
-            )
-            struct_body += f"{indent}    .{field_name} = {nested_body},\n"
-            assertions += nested_assertions
+            out.write(f"{indent}    .{field_name} = ")
+            write_struct_body(out, child, indent_level + 1,
+                              f"{expected_name}.{field_name}",
+                              f"{actual_name}->{field_name}",
+                              assert_type, assertions, fields)
+            out.write(",\n")
 
         # Case: Scalar field
         else:
-            struct_body += f"{indent}    .{field_name} = {child.text},\n"
-            assertions += f"{ASSERT_INDENT}{ASSERT_TYPE}({expected_name}, {actual_name}, {field_name});\n"
-
-    struct_body += f"{indent}}}"
-    return struct_body, assertions
+            out.write(f"{indent}    .{field_name} = {child.text},\n")
+            assertions.append(f"{ASSERT_INDENT}{assert_type}({expected_name}, {actual_name}, {field_name});\n")
+            if fields is not None:
+                fields.append((f"{expected_name}.{field_name}", child.attrib.get('mask')))
+
+    out.write(f"{indent}}}")
+
+def generate_struct_body(element, indent_level=0, expected_name="expected_rsp", actual_name="actual",
+                         assert_type=ASSERT_TYPE):
+    out, assertions = io.StringIO(), []
+    write_struct_body(out, element, indent_level, expected_name, actual_name, assert_type, assertions)
+    return out.getvalue(), "".join(assertions)
+
+def write_struct_code(out, var_name, struct_name, element, indent_level=0, assert_type=ASSERT_TYPE,
+                      fields=None):
+    # Stream version of generate_struct_code(). Returns the assertions
+    assertions = []
+    if len(element) == 0:
+        return assertions
 
+    indent = "    " * indent_level
+    out.write(f"{indent}{struct_name} {var_name} = ")
+    write_struct_body(out, element, indent_level, get_expected_str(), get_actual_str(),
+                      assert_type, assertions, fields)
+    out.write(";\n\n")
+    return assertions
 
-def generate_struct_code(var_name, struct_name, element, indent_level=0):
+def write_check_table(out, struct_name, fields, indent_level):
+    """
+    Write the field_check table of an expected response, one line per field
+    the XML sets (the rest are not checked), and return the code that
+    verifies the actual response against it.
+    """
+    indent = "    " * indent_level
+    expected, actual, checks = get_expected_str(), get_actual_str(), f"checks_{G_COUNT}"
+    out.write(f"{indent}static const struct field_check {checks}[] = {{\n")
+    for path, mask in fields:
+        # Member designator relative to the struct, e.g. entries[1].feature_id
+        member = path[len(expected) + 1:]
+        out.write(f"{indent}    FIELD_CHECK({struct_name}, {member}, {mask or '~0ULL'}),\n")
+    out.write(f"{indent}}};\n\n")
+    return [f"{ASSERT_INDENT}if (verify_fields(&{expected}, {actual}, {checks}, ARRAY_SIZE({checks})))\n",
+            f"{ASSERT_INDENT}    rc = EXIT_FAILURE;\n"]
+
+def generate_struct_code(var_name, struct_name, element, indent_level=0, assert_type=ASSERT_TYPE):
     """
     Recursively generate C code for requests/expected responses from the
     given XML node.
@@ -124,6 +423,7 @@ def generate_struct_code(var_name, struct_name, element, indent_level=0):
         - struct_name: name of the struct (ex: cxlmi_cmd_XXX_req/cxlmi_cmd_XXX_rsp)
         - element: corresponding XML node
         - indent_level: indent level
+        - assert_type: macro used for the assertions (ASSERT_EQUAL by default)
 
     Requests are generated in the following format. :
         struct cxlmi_cmd_XXX_req expected_1 = {
@@ -143,78 +443,180 @@ def generate_struct_code(var_name, struct_name, element, indent_level=0):
 
      OR if the response node is empty, return ""
     """
-    if len(element) == 0:
-        return "", ""
-
-    struct_body, assertions = generate_struct_body(element,
-                                                   indent_level,
-                                                   expected_name=get_expected_str(),
-                                                   actual_name=get_actual_str())
-    indent = "    " * indent_level
-    code = f"{indent}{struct_name} {var_name} = {struct_body};\n\n"
-    return code, assertions
-
-# Generate code for 1 command (create req payload, send the command, then check rsp payload)
-def generate_c_code(command, opcode_map):
+    out = io.StringIO()
+    assertions = write_struct_code(out, var_name, struct_name, element, indent_level, assert_type)
+    return out.getvalue(), "".join(assertions)
+
+def generate_c_code(command, opcode_map, batch=False):
+    out = io.StringIO()
+    write_c_code(out, command, opcode_map, batch)
+    return out.getvalue()
+
+# Write code for 1 command (create req payload, send the command, then check rsp payload)
+# In batch mode the command is wrapped in its own block and a failure is
+# counted instead of jumping to cleanup, so the following commands still run
+def write_c_code(out, command, opcode_map, batch=False):
     opcode = command.attrib['opcode']
     if opcode not in opcode_map:
-        return f"// Unknown opcode {opcode}\n"
+        out.write(f"// Unknown opcode {opcode}\n")
+        return
 
     mapping = opcode_map[opcode]
     func = mapping['function']
     request = command.find("request")
     response = command.find("response")
 
-    req_str = get_req_str()
-    actual = get_actual_str()
-    expected = get_expected_str()
-
-    req_code, expected_rsp_code, assertions = "", "", ""
+    if batch:
+        out.write("    {\n")
 
+    tunnel_decl, tunnel_info, levels = tunnel_code(command)
+    out.write(tunnel_decl)
     if request is not None:
-        req_struct = mapping['req']
-        # Generate req struct initialization. generate_struct_code always generates
+        # Write req struct initialization. write_struct_code always generates
         # assertions, but ASSERT_EQUAL() don't apply to requests, so throw them away
-        req_code, _ = generate_struct_code(req_str,
-                                           req_struct,
-                                           request,
-                                           indent_level=G_INDENT_LEVEL)
+        write_struct_code(out, get_req_str(), mapping['req'], request, indent_level=G_INDENT_LEVEL)
 
+    assertions = []
     if response is not None:
-        rsp_struct = mapping['rsp']
-        # Generate expected rsp struct initialization and checks
-        expected_rsp_code, assertions = generate_struct_code(expected,
-                                                         rsp_struct,
-                                                         response,
-                                                         indent_level=G_INDENT_LEVEL)
+        # Write expected rsp struct initialization and collect its checks. It
+        # is static so it is built at compile time and can hold flexible arrays
+        fields = [] if VERIFY == 'table' else None
+        assertions = write_struct_code(out, get_expected_str(), "static const " + mapping['rsp'], response,
+                                       indent_level=G_INDENT_LEVEL, fields=fields)
+        if fields:
+            assertions = write_check_table(out, mapping['rsp'], fields, G_INDENT_LEVEL)
 
-    function_call = ""
-    cast_rsp = ""
+    cast_rsp, function_call = generate_function_call(
+        mapping, request is not None, response is not None, tunnel_info,
+        response_size(command, mapping) if response is not None else None)
 
-    if response is not None:
-        cast_rsp = f"{rsp_struct} *{actual} = ({rsp_struct} *) buf;"
-        if request is not None:
-            function_call = f"{func}(ep, {TUNNEL_INFO}, &{req_str}, {actual})"
-        else:
-            function_call = f"{func}(ep, {TUNNEL_INFO}, {actual})"
-    elif request is not None:
-        function_call = f"{func}(ep, {TUNNEL_INFO}, &{req_str})"
-    else:
-        function_call = f"{func}(ep, {TUNNEL_INFO})"
+    if batch:
+        out.write(generate_batch_call(opcode, func, function_call, cast_rsp, "".join(assertions),
+                                      levels))
+        return
+
+    call, elapsed = generate_call(function_call, opcode, func)
 
     # Allocate and call the function
-    alloc_and_call = f"""\
+    out.write(f"""\
         {cast_rsp}
 
-        rc = {function_call};
+{call}\
         if (rc != 0) {{
             fprintf(stdout, "Error: Function {func} ({opcode}h) returned non-zero rc: %d\\n", rc);
+            report_result("{opcode}", "{func}", rc, {elapsed}, {levels});
             goto cleanup;
         }}
 
+    """)
+    out.writelines(assertions)
+    out.write(f"""{ASSERT_INDENT}report_result("{opcode}", "{func}", rc, {elapsed}, {levels});\n\n""")
+
+def generate_function_call(mapping, has_request, has_response, tunnel_info=TUNNEL_INFO, rsp_size=None):
+    """
+    Return the declaration of the response pointer into buf (or "") and the
+    call of the command's cxlmi_cmd_*() function for the current G_COUNT.
+    tunnel_info is the C expression passed as its cxlmi_tunnel_info. With
+    rsp_size (see response_size()), buf is first grown to hold the response.
+    """
+    func = mapping['function']
+    req_str = get_req_str()
+    actual = get_actual_str()
+    cast_rsp = ""
+
+    if has_response:
+        rsp_struct = mapping['rsp']
+        cast_rsp = f"{rsp_struct} *{actual} = ({rsp_struct} *) buf;"
+        if rsp_size is not None:
+            cast_rsp = f"buf = rsp_buf(buf, &buf_size, {rsp_size});\n{ASSERT_INDENT}{cast_rsp}"
+        if has_request:
+            function_call = f"{func}(ep, {tunnel_info}, &{req_str}, {actual})"
+        else:
+            function_call = f"{func}(ep, {tunnel_info}, {actual})"
+    elif has_request:
+        function_call = f"{func}(ep, {tunnel_info}, &{req_str})"
+    else:
+        function_call = f"{func}(ep, {tunnel_info})"
+
+    return cast_rsp, function_call
+
+def array_sizes(element, struct_name, path=""):
+    # Bytes up to the end of each array of structs the XML lists under element
+    for child in element:
+        child_elements = list(child)
+        member = f"{path}.{child.tag}" if path else child.tag
+        if len(child_elements) > 1 and all(e.tag == child_elements[0].tag for e in child_elements):
+            yield (f"offsetof({struct_name}, {member}) + "
+                   f"{len(child_elements)} * sizeof((({struct_name} *)0)->{member}[0])")
+            for i, entry in enumerate(child_elements):
+                yield from array_sizes(entry, struct_name, f"{member}[{i}]")
+        elif child_elements:
+            yield from array_sizes(child, struct_name, member)
+
+def response_size(command, mapping):
+    """
+    C constant expression for the bytes a command's response needs: its
+    struct, every array of structs the XML lists in it (a flexible array
+    needs room for all its entries) and <response payload="..."> bytes past
+    the struct, given as a number or as the request field that holds it
+    (e.g. payload="count" for Get Feature).
+    """
+    response = command.find("response")
+    rsp_struct = mapping['rsp']
+    terms = [f"sizeof({rsp_struct})"] + list(array_sizes(response, rsp_struct))
+    payload = response.attrib.get('payload')
+    if payload is not None:
+        request = command.find("request")
+        field = request.find(payload) if request is not None and not payload.strip().isdigit() else None
+        if field is not None:
+            payload = field.text
+        terms.append(f"sizeof({rsp_struct}) + {int(payload.strip(), 0)}")
+
+    size = terms[0]
+    for term in terms[1:]:
+        size = f"MAX_SIZE({size}, {term})"
+    return size
+
+def generate_call(function_call, opcode, func):
+    """
+    Return the code calling the command under the watchdog and the C
+    expression for its latency in ns (-1 unless TIMED).
     """
+    arm = f"""{ASSERT_INDENT}watchdog_arm("{opcode}", "{func}");\n"""
+    cancel = f"{ASSERT_INDENT}watchdog_cancel();\n"
+    if not TIMED:
+        return f"{arm}{ASSERT_INDENT}rc = {function_call};\n{cancel}", "-1"
+
+    start, elapsed = f"start_{G_COUNT}", f"elapsed_{G_COUNT}"
+    call = f"""\
+{arm}\
+{ASSERT_INDENT}uint64_t {start} = now_ns();
+{ASSERT_INDENT}rc = {function_call};
+{ASSERT_INDENT}long long {elapsed} = now_ns() - {start};
+{cancel}\
+"""
+    return call, elapsed
+
+def generate_batch_call(opcode, func, function_call, cast_rsp, assertions, levels=0):
+    # Rest of the command's block, after its payload (see write_c_code())
+    call, elapsed = generate_call(function_call, opcode, func)
+
+    # Assertions only run when the command succeeded; they set rc on mismatch
+    return f"""\
+        {cast_rsp}
+
+{call}\
+        if (rc != 0) {{
+            fprintf(stdout, "Error: Function {func} ({opcode}h) returned non-zero rc: %d\\n", rc);
+        }} else {{
+{textwrap.indent(assertions, "    ")}\
+        }}
+        report_result("{opcode}", "{func}", rc, {elapsed}, {levels});
+        if (rc != 0)
+            failures++;
+    }}
 
-    return req_code + expected_rsp_code + alloc_and_call + assertions +"\n"
+"""
 
 def generate_ioctl_code(devname='mem0'):
     return f"""
@@ -241,36 +643,51 @@ def generate_mctp_code(nid=0, eid=0):
 
     """
 
+def write_header(f, suite_info, decls="", transport=None, helpers=""):
+    # Commands written after the header are tunneled like the suite's
+    global TUNNEL
+    TUNNEL = suite_info.get('tunnel')
+
+    # Write the prefix (C file header) to the file
+    f.write(f"#define CMD_TIMEOUT_S {CMD_TIMEOUT}\n")
+    f.write(PREFIX + "\n")
+
+    # Write the generated assert macro to the file with explicit newlines
+    f.write(ASSERT_MACRO)
+    if VERIFY == 'table':
+        f.write(VERIFY_HELPERS)
+    f.write(helpers)
+
+    f.write(MAIN)
+    f.write(decls)
+
+    # Default to the suite's MCTP endpoint if it has one
+    if transport is None:
+        transport = 'mctp' if suite_info['mctp'] is not None else 'ioctl'
+
+    if transport == 'mctp':
+        nid, eid = suite_info['mctp']
+        f.write(generate_mctp_code(nid, eid))
+    else:
+        f.write(generate_ioctl_code(suite_info['ioctl']))
+
 # Generate test file for a single command
 def generate_test_file(output_name, command, suite_info, opcode_map):
     if not opcode_map:
         opcode_map = generate_default_opcode_map()
-        print_opcode_map(opcode_map)
+        print_opcode_map(opcode_map, OUTPUT_DIR + '/opcode_map.txt')
 
-    output_name = "./output/" + output_name
+    output_name = OUTPUT_DIR + "/" + output_name
     # Step 2: Open output file in write mode to clear the file
     with open(output_name, 'w') as f:
         pass
 
     # Step 3: Open output file in append mode to add the content
     with open(output_name, 'a', newline='') as f:
-        # Write the prefix (C file header) to the file
-        f.write(PREFIX + "\n")
-
-        # Write the generated assert macro to the file with explicit newlines
-        f.write(ASSERT_MACRO)
-
-        f.write(MAIN)
-
-        print(suite_info)
-        if (ep := suite_info['mctp']) is not None:
-            nid, eid = ep
-            f.write(generate_mctp_code(nid, eid))
-        else:
-            f.write(generate_ioctl_code(suite_info['ioctl']))
+        write_header(f, suite_info)
 
         # Generate and write the C code for each command
-        f.write(generate_c_code(command, opcode_map))
+        write_c_code(f, command, opcode_map)
         global G_COUNT
         G_COUNT += 1
 
@@ -278,19 +695,179 @@ def generate_test_file(output_name, command, suite_info, opcode_map):
         f.write(FOOTER)
         G_COUNT = 1  # Reset the global counter for the next topo
 
+# Generate one test file that opens the endpoint once and runs every command
+# in sequence. A failing command is reported and counted, and the rest still run.
+# commands can be any iterable (e.g. iter_commands()), it is only walked once
+def generate_suite_file(output_name, commands, suite_info, opcode_map):
+    if not opcode_map:
+        opcode_map = generate_default_opcode_map()
+        print_opcode_map(opcode_map, OUTPUT_DIR + '/opcode_map.txt')
+
+    global G_COUNT
+    count = 0
+    with open(OUTPUT_DIR + "/" + output_name, 'w', newline='') as f:
+        write_header(f, suite_info, BATCH_DECLS)
+
+        for command in commands:
+            write_c_code(f, command, opcode_map, batch=True)
+            G_COUNT += 1
+            count += 1
+
+        f.write(BATCH_SUMMARY.format(count=count))
+        f.write(FOOTER)
+    G_COUNT = 1
+
+# <--------------- Benchmarks ------------------------------>
+
+def is_idempotent(command):
+    # Only commands marked <command idempotent="true"> are safe to repeat
+    return command.attrib.get('idempotent', 'false').lower() == 'true'
+
+def generate_bench_code(command, opcode_map, transport, iterations, warmup):
+    # Warm up, then time `iterations` calls of one command. Responses are not
+    # checked here (that is what the tests are for), only the rc
+    opcode = command.attrib['opcode']
+    mapping = opcode_map[opcode]
+    func = mapping['function']
+    request = command.find("request")
+    response = command.find("response")
+
+    req_code = ""
+    if request is not None:
+        req_code, _ = generate_struct_code(get_req_str(), mapping['req'], request,
+                                           indent_level=G_INDENT_LEVEL)
+    tunnel_decl, tunnel_info, levels = tunnel_code(command)
+    cast_rsp, function_call = generate_function_call(
+        mapping, request is not None, response is not None, tunnel_info,
+        response_size(command, mapping) if response is not None else None)
+    n = G_COUNT
+    return f"""\
+    {{
+{tunnel_decl}{req_code}\
+        {cast_rsp}
+        uint64_t *samples_{n} = calloc({iterations}, sizeof(uint64_t));
+        int errors_{n} = 0;
+
+        assert(samples_{n} != NULL);
+        for (int i = 0; i < {warmup}; i++)
+            {function_call};
+
+        uint64_t bench_start_{n} = now_ns();
+        for (int i = 0; i < {iterations}; i++) {{
+            uint64_t start = now_ns();
+
+            if ({function_call} != 0)
+                errors_{n}++;
+            samples_{n}[i] = now_ns() - start;
+        }}
+        report_bench("{opcode}", "{func}", "{transport}", samples_{n}, {iterations},
+                     errors_{n}, now_ns() - bench_start_{n}, {levels});
+        free(samples_{n});
+    }}
+
+"""
+
+# Generate a benchmark of every idempotent command over one transport
+# ('mctp' or 'ioctl') of the suite
+def generate_bench_file(output_name, commands, suite_info, opcode_map,
+                        transport, iterations=1000, warmup=10):
+    global G_COUNT
+    with open(OUTPUT_DIR + "/" + output_name, 'w', newline='') as f:
+        write_header(f, suite_info, transport=transport, helpers=BENCH_HELPERS)
+        for command in commands:
+            if not is_idempotent(command) or command.attrib['opcode'] not in opcode_map:
+                continue
+            f.write(generate_bench_code(command, opcode_map, transport, iterations, warmup))
+            G_COUNT += 1
+        f.write("    rc = 0;\n")
+        f.write(FOOTER)
+    G_COUNT = 1
+
+# <--------------- Incremental generation ------------------------------>
+"""
+output/manifest.json maps each generated file to a hash of everything its
+code depends on: the XML <command> node(s), their opcode map entries, the
+endpoint it opens and this module's source (which holds the PREFIX,
+ASSERT_MACRO, MAIN and FOOTER templates). A file whose hash is unchanged is
+not rewritten, so its mtime (and the host-built binary) stays valid.
+"""
+MANIFEST = "manifest.json"
+GENERATOR_HASH = cache.hash_file(__file__)
+
+def command_hash(command, opcode_map):
+    opcode = command.attrib.get('opcode')
+    return cache.hash_strings(ET.tostring(command).decode().strip(),
+                              json.dumps(opcode_map.get(opcode), sort_keys=True))
+
+def file_hash(commands, suite_info, opcode_map, extra=()):
+    return cache.hash_strings(GENERATOR_HASH, suite_info['mctp'], suite_info['ioctl'],
+                              suite_info.get('tunnel'), TIMED, CMD_TIMEOUT, VERIFY, *extra,
+                              *[command_hash(command, opcode_map) for command in commands])
+
+def load_manifest():
+    path = OUTPUT_DIR + "/" + MANIFEST
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def save_manifest(manifest):
+    with open(OUTPUT_DIR + "/" + MANIFEST, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+def generate_if_changed(output_name, commands, suite_info, opcode_map, generate, extra=()):
+    """
+    Call generate() to (re)write output_name only if its inputs changed since
+    it was last generated. extra holds any other generation parameters.
+    Returns True if the file was regenerated.
+    """
+    manifest = load_manifest()
+    input_hash = file_hash(commands, suite_info, opcode_map, extra)
+    if manifest.get(output_name) == input_hash and os.path.exists(OUTPUT_DIR + "/" + output_name):
+        print(f"{output_name} is up to date")
+        return False
+
+    generate()
+    manifest[output_name] = input_hash
+    save_manifest(manifest)
+    return True
+
 def load_xml(file_path):
     tree = ET.parse(file_path)
     return tree.getroot()
 
+def iter_commands(file_path):
+    """
+    Yield the top-level elements (<command>s) of an input file one at a
+    time. Each is dropped from the tree once the caller moves on, so only
+    one command is in memory however large the file is.
+    """
+    context = ET.iterparse(file_path, events=('start', 'end'))
+    _, root = next(context)
+    depth = 0
+    for event, element in context:
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 0:
+            yield element
+            root.clear()
+
+def find_command(file_path, opcode):
+    return next((command for command in iter_commands(file_path)
+                 if command.attrib.get('opcode') == opcode), None)
+
 if __name__ == "__main__":
     if len(sys.argv) != 2:
         print("Usage: python generate_tests.py <suite>")
         sys.exit(1)
 
     suite = topo.SUITES[sys.argv[1].upper()]
-    root = load_xml(suite['input'])
     opcode_map = generate_default_opcode_map()
 
-    for command in root:
-        output = f"test-{command.get("opcode")}.c"
-        generate_test_file(output, command, suite, opcode_map)
\ No newline at end of file
+    for command in iter_commands(suite['input']):
+        output = f"test-{command.get('opcode')}.c"
+        generate_test_file(output, command, suite, opcode_map)
+
+    generate_suite_file(f"test-{sys.argv[1].lower()}.c", iter_commands(suite['input']), suite, opcode_map)
\ No newline at end of file
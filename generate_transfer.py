@@ -0,0 +1,241 @@
+"""
+Transfer benchmark generator: reads large payloads in chunks and sweeps the
+response message limit (Set Response Message Limit, 0004) to find good chunk
+sizes for each transport.
+
+Commands opt in with attributes on their <command>:
+- transfer-offset, transfer-count: the request fields that select the chunk
+- transfer-size: how much there is to read, in bytes (or entries)
+- transfer-array: the response array the chunk is returned in, if the
+  offset and count are in its entries rather than in bytes
+
+For every limit the program sets the limit, then reads sizes of up to
+transfer-size in as many round trips as the granted limit requires. It prints
+one TRANSFER line per command, limit and size with the bytes per second and
+the round trips per transfer, or one line with set_rc if the limit was
+refused. A command that never needed more than one round trip is reported
+with a WARN line, as its transfer-size is too small to measure chunking. The
+limits are set through the suite's tunnel, and the device's limit is put back
+(Get Response Message Limit, 0003) at the end.
+"""
+import sys
+import xml.etree.ElementTree as ET
+import cache
+import topo
+import generate_tests
+from generate_tests import (FOOTER, generate_struct_code, iter_commands, tunnel_code,
+                            write_header)
+from parse_docs import generate_default_opcode_map
+
+# Part of the manifest hash, so editing this module regenerates the programs
+GENERATOR_HASH = cache.hash_file(__file__)
+
+GET_LIMIT_OPCODE = '0003'
+SET_LIMIT_OPCODE = '0004'
+# Valid Set Response Message Limit values: log2 of the limit in bytes
+MIN_LIMIT, MAX_LIMIT = 8, 20
+DEFAULT_LIMITS = (8, 9, 10, 11, 12)
+# Transfer sizes swept below the full transfer-size, in its units
+SIZES = (16, 64, 256, 1024, 4096, 16384, 65536)
+
+TRANSFER_HELPERS = """
+#define TRANSFER_ITERATIONS {iterations}
+#define TRANSFER_WARMUP {warmup}
+#define NUM_LIMITS {num_limits}
+#define NUM_TRANSFERS {num_transfers}
+/* Largest response any limit allows, plus room for the response header */
+#define TRANSFER_BUF_SIZE (((size_t)1 << {max_limit}) + MAX_PAYLOAD_SIZE)
+
+static const unsigned int limits[NUM_LIMITS] = {{ {limits} }};
+
+/* Read size units in chunks that fit limit_bytes, counting round trips */
+typedef int (*transfer_fn)(struct cxlmi_endpoint *ep, void *buf, size_t limit_bytes,
+			   size_t size, unsigned int *round_trips);
+
+struct transfer_cmd {{
+	const char *opcode;
+	const char *func;
+	transfer_fn fn;
+	size_t unit;
+	const size_t *sizes;
+	int nsizes;
+}};
+"""
+
+TRANSFER_MAIN = """
+    buf = rsp_buf(buf, &buf_size, TRANSFER_BUF_SIZE);
+    rc = {get_limit_func}(ep, {tunnel_info}, &original);
+    if (rc != 0) {{
+        printf("Failed to get the response message limit: rc=%d\\n", rc);
+        goto cleanup;
+    }}
+    for (int c = 0; c < NUM_TRANSFERS; c++) {{
+        const struct transfer_cmd *t = &transfers[c];
+        unsigned int max_round_trips = 0;
+
+        for (int l = 0; l < NUM_LIMITS; l++) {{
+            {limit_struct} limit_req = {{ .limit = limits[l] }};
+            {limit_rsp_struct} granted;
+
+            rc = {limit_func}(ep, {tunnel_info}, &limit_req, &granted);
+            if (rc != 0) {{
+                printf("TRANSFER opcode=%s function=%s transport={transport} limit=%u set_rc=%d\\n",
+                       t->opcode, t->func, limits[l], rc);
+                continue;
+            }}
+
+            size_t limit_bytes = (size_t)1 << granted.limit;
+            for (int s = 0; s < t->nsizes; s++) {{
+                unsigned int round_trips = 0;
+                int errors = 0;
+
+                for (int i = 0; i < TRANSFER_WARMUP; i++)
+                    t->fn(ep, buf, limit_bytes, t->sizes[s], &round_trips);
+
+                uint64_t start = now_ns();
+                for (int i = 0; i < TRANSFER_ITERATIONS; i++) {{
+                    round_trips = 0;
+                    if (t->fn(ep, buf, limit_bytes, t->sizes[s], &round_trips) != 0)
+                        errors++;
+                }}
+                uint64_t total_ns = now_ns() - start;
+                size_t bytes = t->sizes[s] * t->unit;
+
+                if (round_trips > max_round_trips)
+                    max_round_trips = round_trips;
+
+                printf("TRANSFER opcode=%s function=%s transport={transport} limit=%u limit_bytes=%zu "
+                       "size=%zu round_trips=%u iterations=%d errors=%d ns_per_transfer=%llu "
+                       "bytes_per_sec=%.1f\\n",
+                       t->opcode, t->func, granted.limit, limit_bytes, bytes, round_trips,
+                       TRANSFER_ITERATIONS, errors,
+                       (unsigned long long)(total_ns / TRANSFER_ITERATIONS),
+                       bytes * (double)TRANSFER_ITERATIONS * 1e9 / total_ns);
+            }}
+        }}
+        if (max_round_trips <= 1)
+            printf("WARN: %s never took more than one round trip, its transfer-size fits in every limit\\n",
+                   t->opcode);
+    }}
+
+    /* Later programs on this endpoint expect the device's own limit, a failed restore fails the program */
+    restore.limit = original.limit;
+    rc = {limit_func}(ep, {tunnel_info}, &restore, &restored);
+    if (rc != 0) {{
+        printf("Failed to restore the response message limit %u: rc=%d\\n", (unsigned int)original.limit, rc);
+        rc = EXIT_FAILURE;
+    }}
+"""
+
+def parse_limits(limits):
+    # "8,10,12" -> (8, 10, 12)
+    if not limits:
+        return DEFAULT_LIMITS
+    values = tuple(int(limit) for limit in limits.split(','))
+    if not all(MIN_LIMIT <= limit <= MAX_LIMIT for limit in values):
+        raise ValueError(f"Response message limits must be in [{MIN_LIMIT}, {MAX_LIMIT}] (log2 of bytes)")
+    return values
+
+def is_transfer(command):
+    return 'transfer-size' in command.attrib
+
+def transfer_sizes(total):
+    return [size for size in SIZES if size < total] + [total]
+
+def generate_transfer_cmd(command, mapping):
+    # One command as a chunked reader (see transfer_fn)
+    n = generate_tests.G_COUNT
+    offset, count = command.attrib['transfer-offset'], command.attrib['transfer-count']
+    rsp_struct, req = mapping['rsp'], generate_tests.get_req_str()
+    array = command.attrib.get('transfer-array')
+    unit = f"sizeof((({rsp_struct} *)0)->{array}[0])" if array else "1"
+
+    tunnel_decl, tunnel_info, _ = tunnel_code(command, indent="    ")
+    req_code, _ = generate_struct_code(req, mapping['req'], command.find("request"), indent_level=1)
+    return f"""
+static int transfer_{n}(struct cxlmi_endpoint *ep, void *buf, size_t limit_bytes,
+\t\t\t size_t size, unsigned int *round_trips)
+{{
+{tunnel_decl}{req_code}\
+    {rsp_struct} *rsp = ({rsp_struct} *) buf;
+    size_t count_max = sizeof({req}.{count}) >= sizeof(size_t) ? SIZE_MAX :
+                       ((size_t)1 << (8 * sizeof({req}.{count}))) - 1;
+    size_t per_trip = limit_bytes > sizeof(*rsp) ? (limit_bytes - sizeof(*rsp)) / {unit} : 0;
+    size_t done = 0;
+
+    if (per_trip == 0)
+        return -1;
+    if (per_trip > count_max)
+        per_trip = count_max;
+    while (done < size) {{
+        size_t chunk = size - done < per_trip ? size - done : per_trip;
+        int rc;
+
+        {req}.{offset} = done;
+        {req}.{count} = chunk;
+        rc = {mapping['function']}(ep, {tunnel_info}, &{req}, rsp);
+        (*round_trips)++;
+        if (rc != 0)
+            return rc;
+        done += chunk;
+    }}
+    return 0;
+}}
+
+static const size_t transfer_sizes_{n}[] = {{ {', '.join(map(str, transfer_sizes(int(command.attrib['transfer-size'], 0))))} }};
+"""
+
+def generate_transfer_file(output_name, commands, suite_info, opcode_map, transport,
+                           limits=DEFAULT_LIMITS, iterations=50, warmup=2):
+    """
+    Generate the transfer benchmark of the suite's transfer commands over one
+    transport ('mctp' or 'ioctl').
+    """
+    selected = [command for command in commands
+                if is_transfer(command) and command.attrib['opcode'] in opcode_map]
+    if not selected:
+        raise ValueError("No transfer commands in the suite")
+    get_limit, set_limit = opcode_map[GET_LIMIT_OPCODE], opcode_map[SET_LIMIT_OPCODE]
+    # The readers are generated before the header, tunnel them like the suite
+    generate_tests.TUNNEL = suite_info.get('tunnel')
+    # The limit commands go to the same device as the readers
+    tunnel_decl, tunnel_info, _ = tunnel_code(ET.Element('command', opcode=SET_LIMIT_OPCODE), indent="    ")
+    decls = (f"{tunnel_decl}    {get_limit['rsp']} original;\n"
+             f"    {set_limit['req']} restore;\n"
+             f"    {set_limit['rsp']} restored;\n")
+
+    functions, table = "", ""
+    for command in selected:
+        mapping = opcode_map[command.attrib['opcode']]
+        array = command.attrib.get('transfer-array')
+        n = generate_tests.G_COUNT
+        functions += generate_transfer_cmd(command, mapping)
+        unit = f"sizeof((({mapping['rsp']} *)0)->{array}[0])" if array else "1"
+        table += (f'\t{{ "{command.attrib["opcode"]}", "{mapping["function"]}", transfer_{n}, {unit}, '
+                  f'transfer_sizes_{n}, sizeof(transfer_sizes_{n}) / sizeof(size_t) }},\n')
+        generate_tests.G_COUNT += 1
+    generate_tests.G_COUNT = 1
+
+    helpers = TRANSFER_HELPERS.format(iterations=iterations, warmup=warmup, num_limits=len(limits),
+                                      num_transfers=len(selected), max_limit=max(limits),
+                                      limits=', '.join(map(str, limits)))
+    helpers += functions
+    helpers += f"\nstatic const struct transfer_cmd transfers[NUM_TRANSFERS] = {{\n{table}}};\n"
+
+    with open(generate_tests.OUTPUT_DIR + "/" + output_name, 'w', newline='') as f:
+        write_header(f, suite_info, decls=decls, transport=transport, helpers=helpers)
+        f.write(TRANSFER_MAIN.format(transport=transport, limit_struct=set_limit['req'],
+                                     limit_rsp_struct=set_limit['rsp'],
+                                     limit_func=set_limit['function'], get_limit_func=get_limit['function'],
+                                     tunnel_info=tunnel_info))
+        f.write(FOOTER)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: python generate_transfer.py <suite> <mctp|ioctl> [limits]")
+        sys.exit(1)
+
+    suite = topo.SUITES[sys.argv[1].upper()]
+    generate_transfer_file(f"transfer-{sys.argv[1].lower()}-{sys.argv[2]}.c",
+                           iter_commands(suite['input']), suite, generate_default_opcode_map(),
+                           sys.argv[2], parse_limits(sys.argv[3] if len(sys.argv) > 3 else None))
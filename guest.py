@@ -0,0 +1,129 @@
+import subprocess
+import shlex
+import threading
+
+# Values from .vars.config the runner needs for its own ssh/scp calls.
+# cxl_test_tool parses the same file for tools.*
+VARS = {}
+
+SSH_OPTS = ['-o', 'StrictHostKeyChecking=no',
+            '-o', 'UserKnownHostsFile=/dev/null',
+            '-o', 'LogLevel=ERROR']
+
+def load_config(path):
+    VARS.clear()
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#') or '=' not in line:
+                continue
+            key, value = line.split('=', 1)
+            VARS[key.strip()] = value.strip().strip('"')
+
+def ssh_port():
+    return VARS.get('ssh_port', '2025')
+
+def ssh_target():
+    return f"{VARS.get('vm_usr', 'root')}@localhost"
+
+def control_opts():
+    """
+    Options that multiplex every ssh/scp call of the runner over one
+    connection to the VM. The first call starts the master in the
+    background and later calls skip the TCP and SSH handshakes. The socket
+    is per ssh port, so each --jobs instance has its own.
+    """
+    return ['-o', 'ControlMaster=auto',
+            '-o', f"ControlPath=/tmp/cxlmi-ssh-{ssh_port()}.sock",
+            '-o', 'ControlPersist=600']
+
+def ssh_cmd(*args):
+    return ['ssh', '-p', ssh_port()] + SSH_OPTS + control_opts() + list(args) + [ssh_target()]
+
+def disconnect():
+    # Close the master connection. Needed whenever the VM goes away or is
+    # restored from a snapshot, which drops the guest side of the connection
+    subprocess.run(ssh_cmd('-O', 'exit'), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def execute_batch(cmds, echo=False):
+    """
+    Run several commands in the VM over a single ssh call, one after another,
+    and return an (exit code, output) pair for each. Output is streamed and
+    printed as it arrives when echo is set.
+    """
+    marker = '@@CXLMI_RC'
+    script = ''.join(f"{{ {cmd}\n}} 2>&1; rc=$?; echo; echo {marker} $rc\n" for cmd in cmds)
+    proc = subprocess.Popen(ssh_cmd() + ['sh', '-c', shlex.quote(script)],
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    results = []
+    lines = []
+    for line in proc.stdout:
+        if line.startswith(marker + ' '):
+            # Drop the newline echoed to keep the marker on its own line
+            output = ''.join(lines)[:-1]
+            if echo and lines[-1] != '\n':
+                print(lines[-1], end='')
+            results.append((int(line.split()[1]), output))
+            lines = []
+            continue
+        # Lines are printed one behind, so the echoed newline is not
+        if echo and lines:
+            print(lines[-1], end='')
+        lines.append(line)
+    proc.wait()
+    # Commands the connection did not get to count as failed
+    results.extend((-1, ''.join(lines) if i == len(results) else '') for i in range(len(results), len(cmds)))
+    return results
+
+def stream(cmd, out, timeout=None, echo=True, signal='KILL'):
+    """
+    Run cmd in the VM, writing its output to the file object out (and the
+    terminal, with echo) line by line as it arrives. After timeout seconds
+    the command is sent signal in the guest, and killed 5 s later if it is
+    still running; if the VM does not answer either, the ssh call is killed
+    shortly after.
+    Returns (exit code, output), with exit code None if the host had to
+    give up on the VM.
+    """
+    if timeout and signal == 'KILL':
+        cmd = f"timeout -s KILL {timeout} {cmd}"
+    elif timeout:
+        cmd = f"timeout -k 5 -s {signal} {timeout} {cmd}"
+    proc = subprocess.Popen(ssh_cmd() + [cmd], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    gave_up = threading.Event()
+    def give_up():
+        gave_up.set()
+        proc.kill()
+    watchdog = threading.Timer(timeout + 30, give_up) if timeout else None
+    if watchdog:
+        watchdog.start()
+
+    lines = []
+    for line in proc.stdout:
+        out.write(line)
+        out.flush()
+        if echo:
+            print(line, end='', flush=True)
+        lines.append(line)
+    rc = proc.wait()
+    if watchdog:
+        watchdog.cancel()
+    return (None if gave_up.is_set() else rc), ''.join(lines)
+
+def execute(cmd, echo=False):
+    # Drop-in for tools.execute_on_vm over the shared connection
+    return execute_batch([cmd], echo)[0][1]
+
+def path_exists(path):
+    return execute_batch([f"test -e {path}"])[0][0] == 0
+
+def copy_to_remote(src, dst):
+    # Copy one or more files (a list) to dst in the VM over the shared connection
+    srcs = src if isinstance(src, list) else [src]
+    cmd = ['scp', '-q', '-r', '-P', ssh_port()] + SSH_OPTS + control_opts() + srcs + [f"{ssh_target()}:{dst}"]
+    return subprocess.run(cmd).returncode == 0
+
+def copy_from_remote(src, dst):
+    # Counterpart of tools.copy_to_remote: pull a file or directory from the VM
+    cmd = ['scp', '-q', '-r', '-P', ssh_port()] + SSH_OPTS + control_opts() + [f"{ssh_target()}:{src}", dst]
+    return subprocess.run(cmd).returncode == 0
@@ -0,0 +1,226 @@
+"""
+Results of every run, kept in a SQLite database in the cache so they
+survive the clearing of ./output. A run records the libcxlmi, QEMU and
+kernel revisions it ran against, the verdict and latency (with --latency) of
+every command and the wall-clock time of every phase.
+
+The regression report compares a run to a rolling baseline: the median of
+the previous runs of the same mode. An opcode is flagged when its command
+latency or its execute time grew by more than the threshold, and the run
+itself when its total time did (against runs of the same suites), so the
+harness can gate libcxlmi changes on performance.
+"""
+import os
+import time
+import sqlite3
+import statistics
+import cache
+
+HISTORY_DB = 'history.sqlite'
+REGRESSIONS_FILE = 'regressions.txt'
+
+# Previous runs the baseline is the median of, and how many of them must
+# have measured a value before it is compared at all
+BASELINE_RUNS = 5
+MIN_BASELINE_RUNS = 3
+# Relative growth over the baseline that counts as a regression
+THRESHOLD = 0.2
+# Execute phases shorter than this are too noisy to compare
+MIN_EXECUTE_S = 0.5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL,
+    seconds REAL,
+    mode TEXT,
+    libcxlmi_rev TEXT,
+    qemu_rev TEXT,
+    kernel_rev TEXT,
+    args TEXT
+);
+CREATE TABLE IF NOT EXISTS results (
+    run_id INTEGER REFERENCES runs(id),
+    suite TEXT,
+    opcode TEXT,
+    transport TEXT,
+    status TEXT,
+    function TEXT,
+    ns INTEGER
+);
+CREATE TABLE IF NOT EXISTS phases (
+    run_id INTEGER REFERENCES runs(id),
+    name TEXT,
+    suite TEXT,
+    opcode TEXT,
+    seconds REAL
+);
+CREATE INDEX IF NOT EXISTS results_run ON results(run_id);
+CREATE INDEX IF NOT EXISTS phases_run ON phases(run_id);
+"""
+
+def db_path(path=None):
+    return path or cache.cache_path(HISTORY_DB)
+
+def connect(path=None):
+    # Child runners under --jobs write to the same database, wait for each other
+    db = sqlite3.connect(db_path(path), timeout=60)
+    db.executescript(SCHEMA)
+    return db
+
+def kernel_revision(vars_config, kernel_img):
+    # Configured kernel branch and the image actually booted
+    image = cache.hash_file(kernel_img)[:12] if kernel_img and os.path.exists(kernel_img) else 'unknown'
+    return f"{vars_config.get('kernel_branch', 'unknown')}:{image}"
+
+def qemu_revision(vars_config):
+    return f"{vars_config.get('qemu_url', 'unknown')}@{vars_config.get('qemu_branch', 'unknown')}"
+
+def run_mode(kind, profile=False, tunnel=None, snapshot=False, use_async=False):
+    """
+    Mode a run is compared under: its kind ('qemu', 'sim', 'bench', ...) and
+    the options that change what is measured, e.g. "qemu+profile+tunnel=mld:1".
+    Runs under perf, tunneled, restored from a snapshot or overlapped with
+    --async are only compared to runs made the same way.
+    """
+    parts = [kind]
+    if profile:
+        parts.append('profile')
+    if tunnel is not None:
+        parts.append(f'tunnel={tunnel}')
+    if snapshot:
+        parts.append('snapshot')
+    if use_async:
+        parts.append('async')
+    return '+'.join(parts)
+
+def start_run(mode, libcxlmi_rev, qemu_rev, kernel_rev, args, path=None):
+    # Returns the id that this run's (and its child runners') records go under
+    with connect(path) as db:
+        cursor = db.execute("INSERT INTO runs (started, mode, libcxlmi_rev, qemu_rev, kernel_rev, args) "
+                            "VALUES (?, ?, ?, ?, ?, ?)",
+                            (time.time(), mode, libcxlmi_rev, qemu_rev, kernel_rev, args))
+        return cursor.lastrowid
+
+def finish_run(run_id, seconds, path=None):
+    with connect(path) as db:
+        db.execute("UPDATE runs SET seconds = ? WHERE id = ?", (seconds, run_id))
+
+def record(run_id, results, events, path=None):
+    """
+    Store the RESULT lines (see parse_results()) and the timing phases of one
+    runner under run_id.
+    """
+    rows = [(run_id, r.get('suite'), r.get('opcode'), r.get('transport'), r.get('status'),
+             r.get('function'), int(r['ns']) if 'ns' in r else None) for r in results]
+    phases = [(run_id, e['name'], e['args'].get('suite'), e['args'].get('opcode'), e['dur'] / 1e6)
+              for e in events if e['ph'] == 'X']
+    with connect(path) as db:
+        db.executemany("INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        db.executemany("INSERT INTO phases VALUES (?, ?, ?, ?, ?)", phases)
+
+def last_run(path=None):
+    with connect(path) as db:
+        row = db.execute("SELECT MAX(id) FROM runs").fetchone()
+    return row[0]
+
+def latencies(db, run_id):
+    # (suite, transport, opcode) -> mean ns of the passing commands of a run
+    rows = db.execute("SELECT suite, transport, opcode, AVG(ns) FROM results "
+                      "WHERE run_id = ? AND status = 'PASS' AND ns IS NOT NULL "
+                      "GROUP BY suite, transport, opcode", (run_id,))
+    return {(suite, transport, opcode): ns for suite, transport, opcode, ns in rows}
+
+def execute_times(db, run_id):
+    # opcode -> seconds its test binaries ran for in a run
+    rows = db.execute("SELECT opcode, SUM(seconds) FROM phases "
+                      "WHERE run_id = ? AND name = 'execute' AND opcode IS NOT NULL "
+                      "GROUP BY opcode", (run_id,))
+    return dict(rows.fetchall())
+
+def run_suites(db, run_id):
+    # Suites a run tested or timed, to tell apart runs of the same mode
+    rows = db.execute("SELECT suite FROM results WHERE run_id = ? AND suite IS NOT NULL "
+                      "UNION SELECT suite FROM phases WHERE run_id = ? AND suite IS NOT NULL",
+                      (run_id, run_id))
+    return frozenset(suite for suite, in rows)
+
+def total_times(db, run_id, mode, suites):
+    """
+    Total seconds of the BASELINE_RUNS finished runs before run_id of the same
+    mode and suites, as one-key maps for compare().
+    """
+    baselines = []
+    for baseline, seconds in db.execute("SELECT id, seconds FROM runs WHERE mode = ? AND id < ? "
+                                        "AND seconds IS NOT NULL ORDER BY id DESC", (mode, run_id)):
+        if run_suites(db, baseline) == suites:
+            baselines.append({'total': seconds})
+            if len(baselines) == BASELINE_RUNS:
+                break
+    return baselines
+
+def compare(current, baselines, minimum=0):
+    """
+    Compare one run's values to those of the baseline runs (all key -> value
+    maps). Returns (key, baseline median, current, growth) for each key that
+    regressed, worst first.
+    """
+    regressions = []
+    for key, value in current.items():
+        history = [baseline[key] for baseline in baselines if key in baseline]
+        if len(history) < MIN_BASELINE_RUNS:
+            continue
+        median = statistics.median(history)
+        if median <= 0 or max(median, value) < minimum:
+            continue
+        growth = value / median - 1
+        if growth > THRESHOLD:
+            regressions.append((key, median, value, growth))
+    return sorted(regressions, key=lambda regression: -regression[3])
+
+def regression_report(run_id=None, path=None):
+    """
+    Regressions of a run (default: the last one) against the median of the
+    BASELINE_RUNS previous runs of the same mode. Returns the report lines
+    and whether anything regressed.
+    """
+    run_id = run_id or last_run(path)
+    if run_id is None:
+        return ["No runs recorded yet\n"], False
+    with connect(path) as db:
+        run = db.execute("SELECT mode, libcxlmi_rev, seconds FROM runs WHERE id = ?", (run_id,)).fetchone()
+        if run is None:
+            return [f"No run {run_id} recorded\n"], False
+        mode, libcxlmi_rev, seconds = run
+        baseline_ids = [row[0] for row in db.execute(
+            "SELECT id FROM runs WHERE mode = ? AND id < ? ORDER BY id DESC LIMIT ?",
+            (mode, run_id, BASELINE_RUNS))]
+        latency = compare(latencies(db, run_id),
+                          [latencies(db, baseline) for baseline in baseline_ids])
+        runtime = compare(execute_times(db, run_id),
+                          [execute_times(db, baseline) for baseline in baseline_ids], MIN_EXECUTE_S)
+        total = compare({'total': seconds} if seconds is not None else {},
+                        total_times(db, run_id, mode, run_suites(db, run_id)), MIN_EXECUTE_S)
+
+    lines = [f"Run {run_id} ({mode}, libcxlmi {libcxlmi_rev}, "
+             f"{seconds or 0:.0f}s) against {len(baseline_ids)} previous run(s), "
+             f"threshold +{THRESHOLD:.0%}\n"]
+    for (suite, transport, opcode), median, value, growth in latency:
+        lines.append(f"  LATENCY {suite:<10} {transport:<9} {opcode:<6} "
+                     f"{median / 1000:>10.1f} us -> {value / 1000:>10.1f} us  (+{growth:.0%})\n")
+    for opcode, median, value, growth in runtime:
+        lines.append(f"  RUNTIME {opcode:<6} {median:>8.2f} s -> {value:>8.2f} s  (+{growth:.0%})\n")
+    for _, median, value, growth in total:
+        lines.append(f"  TOTAL   {median:>8.2f} s -> {value:>8.2f} s  (+{growth:.0%})\n")
+    if not latency and not runtime and not total:
+        lines.append("  No regressions\n")
+    return lines, bool(latency or runtime or total)
+
+def write_report(output_dir, run_id=None, path=None):
+    lines, regressed = regression_report(run_id, path)
+    report_path = os.path.join(output_dir, REGRESSIONS_FILE)
+    with open(report_path, 'w') as f:
+        f.writelines(lines)
+    print(''.join(lines), end='')
+    print(f"Regression report written to {report_path}")
+    return regressed
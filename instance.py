@@ -0,0 +1,69 @@
+"""
+Isolation for running several QEMU instances at once. Instance N gets:
+- ssh_port and QMP port offset by N
+- its own directory for memory-backend/LSA backing files
+- its own cxl_test_tool log dir and run_opts file
+- a qcow2 overlay on top of QEMU_IMG so guests never share a disk
+- its own output directory for generated tests and results
+"""
+import os
+import re
+import subprocess
+import cache
+import topo
+
+def output_dir(index):
+    return f"./output/instance-{index}"
+
+def backing_prefix(index):
+    # Subdirectory of the backing directory (see topo.backing_dir()) for the instance
+    return f"cxltest-{index}/"
+
+def write_config(base_path, index, dst):
+    """
+    Copy .vars.config to dst with every per-instance setting rewritten.
+    Returns dst so it can be handed to config.parse_config().
+    """
+    with open(base_path, 'r') as f:
+        lines = f.read().splitlines()
+
+    out = []
+    for line in lines:
+        key = line.split('=', 1)[0].strip() if '=' in line and not line.lstrip().startswith('#') else None
+        value = line.split('=', 1)[1] if key else None
+        if key == 'ssh_port':
+            line = f"ssh_port={int(value) + index}"
+        elif key in ('cxl_test_log_dir', 'cxl_host_dir'):
+            line = f'{key}="{value.strip().strip(chr(34)).rstrip("/")}/instance-{index}/"'
+        elif key in ('run_opts_file', 'json_tmp'):
+            line = f"{key}={value}.{index}"
+        out.append(line)
+
+    with open(dst, 'w') as f:
+        f.write('\n'.join(out) + '\n')
+    return dst
+
+def overlay_image(base_img, index):
+    """
+    qcow2 overlay of the shared guest image for this instance. It is kept in
+    the cache (so snapshots taken in it survive between runs) and recreated
+    whenever the base image is newer.
+    """
+    overlay = cache.cache_path(f"instance-{index}", 'disk.qcow2')
+    base_img = os.path.abspath(base_img)
+    if not os.path.exists(overlay) or os.path.getmtime(overlay) < os.path.getmtime(base_img):
+        fmt = subprocess.run(['qemu-img', 'info', '--output=json', base_img],
+                             capture_output=True, text=True, check=True).stdout
+        base_fmt = re.search(r'"format":\s*"(\w+)"', fmt).group(1)
+        if os.path.exists(overlay):
+            os.unlink(overlay)
+        subprocess.run(['qemu-img', 'create', '-q', '-f', 'qcow2',
+                        '-b', base_img, '-F', base_fmt, overlay], check=True)
+    return overlay
+
+def setup(index, base_config, backing='file'):
+    # Create the instance's directories and config. Returns the config path.
+    os.makedirs(output_dir(index), exist_ok=True)
+    for path in topo.backing_dirs(backing, backing_prefix(index)):
+        os.makedirs(path, exist_ok=True)
+    return write_config(base_config, index, os.path.join(output_dir(index), 'vars.config'))
@@ -1,89 +1,134 @@
 import re
 import os
+import cache
 
-def print_opcode_map(opcode_map):
-    with open('./output/opcode_map.txt', 'w') as f:
+DEFAULT_PATHS = ["../../docs/Generic-Component-Commands.md",
+                 "../../docs/Memory-Device-Commands.md",
+                 "../../docs/FM-API.md",
+                 "../../docs/Vendor-Specific-Commands.md"]
+
+SUITE_BY_DOC = {
+    "Generic-Component-Commands.md": "GENERIC",
+    "FM-API.md": "FMAPI",
+    # Memory device commands run on the GENERIC suite's type-3 device
+    "Memory-Device-Commands.md": "GENERIC",
+    "Vendor-Specific-Commands.md": "VENDOR",
+}
+
+# Match headers like ## Identify (0001h)
+HEADER_RE = re.compile(r'## .+\((\w{4})h\)')
+FUNC_RE = re.compile(r'int (\w+)\s*\(.*')
+STRUCT_RE = re.compile(r'struct\s+(\w+)\s*\*\s*(in|ret)')
+
+# How many lines of a C signature (starting at its first line) to search
+# for the request/response struct parameters
+SIGNATURE_LINES = 10
+
+# Parsed maps are cached per doc file, keyed by the file's content hash and
+# this module's, so a change to the parser invalidates them
+OPCODE_MAP_CACHE = 'opcode_map.json'
+PARSER_HASH = cache.hash_file(__file__)
+
+# Map already built by this process, so repeated calls are free
+_opcode_map = None
+
+def print_opcode_map(opcode_map, path='./output/opcode_map.txt'):
+    with open(path, 'w') as f:
         for opcode, info in opcode_map.items():
             f.write(f"Opcode: {opcode}\n")
             for key, value in info.items():
                 f.write(f"  {key}: {value}\n")
             f.write("\n")
 
-def generate_default_opcode_map():
-    # Default paths
+def generate_default_opcode_map(paths=DEFAULT_PATHS):
+    """
+    Build the opcode map from the docs. Each doc is only parsed if its
+    contents (or this parser) changed since the cached parse in
+    .cache/opcode_map.json.
+    """
+    global _opcode_map
+    if _opcode_map is not None and paths is DEFAULT_PATHS:
+        return _opcode_map
+
     print("Generating opcode map using default paths...")
-    paths = ["../../docs/Generic-Component-Commands.md",
-             "../../docs/Memory-Device-Commands.md",
-             "../../docs/FM-API.md"]
+    cached = cache.load_json(OPCODE_MAP_CACHE)
+    changed = False
     opcode_map = {}
 
     for path in paths:
-        opcode_map.update(parse_markdown_for_opcode_map(path))
+        if not os.path.exists(path):
+            print(f"WARN: {path} not found, skipping")
+            continue
+        with open(path, 'r') as f:
+            md_content = f.read()
+
+        content_hash = cache.hash_strings(md_content, PARSER_HASH)
+        entry = cached.get(path)
+        if entry is None or entry['hash'] != content_hash:
+            entry = {'hash': content_hash,
+                     'map': parse_markdown(md_content, SUITE_BY_DOC.get(os.path.basename(path), "UNKNOWN"))}
+            cached[path] = entry
+            changed = True
+        opcode_map.update(entry['map'])
 
+    if changed:
+        cache.save_json(OPCODE_MAP_CACHE, cached)
+    if paths is DEFAULT_PATHS:
+        _opcode_map = opcode_map
     return opcode_map
 
 def parse_markdown_for_opcode_map(file_path):
-
     with open(file_path, 'r') as f:
         md_content = f.read()
+    return parse_markdown(md_content, SUITE_BY_DOC.get(os.path.basename(file_path), "UNKNOWN"))
 
+def parse_markdown(md_content, suite):
+    """
+    Single pass over the doc: a header sets the current opcode, and a
+    `int cxlmi_cmd...` line starts a signature whose next SIGNATURE_LINES
+    lines are searched for `struct X *in` / `struct X *ret` parameters.
+    """
     opcode_map = {}
     current_opcode = None
-    current_function = None
     current_req = None
     current_rsp = None
+    entry = None
+    window = 0
 
-    # Normalize newlines
-    lines = md_content.splitlines()
-    for i, line in enumerate(lines):
-        # Match headers like ## Identify (0001h)
-        m = re.match(r'## .+\((\w{4})h\)', line)
+    for line in md_content.splitlines():
+        m = HEADER_RE.match(line)
         if m:
             current_opcode = m.group(1).lower()
-            current_function = None
             current_req = None
             current_rsp = None
+            entry = None
+            window = 0
             continue
 
-        # Match C function signature and extract function name and param types
-        if line.strip().startswith("int cxlmi_cmd"):
-            func_line = line.strip().strip('`').strip(';')
-            func_match = re.match(r'int (\w+)\s*\(.*', func_line)
+        stripped = line.strip()
+        # Match C function signature and extract function name
+        if stripped.startswith("int cxlmi_cmd"):
+            func_match = FUNC_RE.match(stripped.strip('`').strip(';'))
             if func_match:
-                current_function = func_match.group(1)
-
-                # Check next few lines for *in or *ret to determine req/rsp
-                for offset in range(0, 10):
-                    if i + offset >= len(lines):
-                        break
-                    l = lines[i + offset]
-                    struct_match = re.search(r'struct\s+(\w+)\s*\*\s*(in|ret)', l)
-                    if struct_match:
-                        struct_name = struct_match.group(1)
-                        direction = struct_match.group(2)
-                        if direction == 'in':
-                            current_req = f'struct {struct_name}'
-                        elif direction == 'ret':
-                            current_rsp = f'struct {struct_name}'
-
-                suite = ""
-                match os.path.basename(file_path):
-                    case "Generic-Component-Commands.md":
-                        suite = "GENERIC"
-                    case "FM-API.md":
-                        suite = 'FMAPI'
-                    case "Memory-Device-Commands.md":
-                        suite = "MEMDEV"
-                    case "Vendor-Specific-Commands.md":
-                        suite = "VENDOR"
-                    case _:
-                        suite = "UNKNOWN"
+                entry = {
+                    'function': func_match.group(1),
+                    'req': current_req,
+                    'rsp': current_rsp,
+                    'suite': suite
+                }
                 if current_opcode:
-                    opcode_map[current_opcode] = {
-                        'function': current_function,
-                        'req': current_req,
-                        'rsp': current_rsp,
-                        'suite': suite
-                    }
+                    opcode_map[current_opcode] = entry
+                window = SIGNATURE_LINES
+
+        # Check lines of the signature for *in or *ret to determine req/rsp
+        if window > 0:
+            window -= 1
+            struct_match = STRUCT_RE.search(line)
+            if struct_match:
+                struct_name, direction = struct_match.groups()
+                if direction == 'in':
+                    current_req = entry['req'] = f'struct {struct_name}'
+                else:
+                    current_rsp = entry['rsp'] = f'struct {struct_name}'
 
     return opcode_map
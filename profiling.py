@@ -0,0 +1,105 @@
+"""
+Guest-side profiling of the test binaries (--profile). Each binary runs
+under `perf record` with frame-pointer call graphs, against a libcxlmi built
+with debug info and frame pointers (see artifacts.PROFILE_MESON_OPTIONS).
+The samples are symbolized in the guest with `perf script`, copied back and
+folded on the host into one stack per line ("a;b;c count"), the input of
+flamegraph.pl, speedscope and similar tools. A flamegraph SVG is drawn too
+when flamegraph.pl is on the PATH.
+"""
+import os
+import shutil
+import subprocess
+from collections import Counter
+
+PROFILE_DIR = 'profile'
+# Sampling frequency (Hz); an odd value avoids sampling in lockstep with timers
+FREQUENCY = 999
+CFLAGS = ['-g', '-fno-omit-frame-pointer']
+
+# Where the time of a test goes: a sample counts towards every category one
+# of its frames matches (so they overlap), except kernel, which is only the
+# samples that were in the kernel when taken
+CATEGORIES = [
+    ('cxlmi_cmd_*', lambda frame: frame.startswith('cxlmi_cmd_')),
+    ('send_cmd_cci', lambda frame: frame.startswith('send_cmd_cci')),
+    ('mctp', lambda frame: 'mctp' in frame.lower()),
+    ('socket I/O', lambda frame: any(call in frame for call in ('sendmsg', 'recvmsg', 'sendto', 'recvfrom',
+                                                                  'poll'))),
+    ('ioctl', lambda frame: 'ioctl' in frame),
+]
+
+def data_path(binary):
+    return f"{binary}.perf.data"
+
+def record_cmd(binary):
+    return f"perf record -q -F {FREQUENCY} --call-graph fp -o {data_path(binary)} {binary}"
+
+def script_cmd(binary):
+    # Symbolize in the guest, where the binaries and libcxlmi.so are
+    return f"perf script -i {data_path(binary)} > {binary}.perf.script 2>/dev/null"
+
+def frame_name(line):
+    # "  7f12ab send_cmd_cci+0x1a (/root/libcxlmi/build/src/libcxlmi.so.1)"
+    parts = line.strip().split(None, 1)
+    if len(parts) < 2:
+        return None
+    symbol, _, dso = parts[1].rpartition(' (')
+    symbol = symbol.split('+0x')[0]
+    dso = dso.rstrip(')')
+    if not symbol or symbol == '[unknown]':
+        symbol = f"[{os.path.basename(dso)}]"
+    if dso.startswith('[kernel'):
+        symbol += '_[k]'
+    return symbol
+
+def fold(script_path):
+    # Count the samples of each call stack in `perf script` output
+    stacks = Counter()
+    comm, frames = None, []
+    with open(script_path, 'r', errors='replace') as f:
+        for line in f:
+            if not line.strip():
+                if comm is not None:
+                    stacks[';'.join([comm] + frames[::-1])] += 1
+                comm, frames = None, []
+            elif not line[0].isspace():
+                comm = line.split()[0]
+            else:
+                frame = frame_name(line)
+                if frame is not None:
+                    frames.append(frame)
+    if comm is not None:
+        stacks[';'.join([comm] + frames[::-1])] += 1
+    return stacks
+
+def write_folded(stacks, path):
+    with open(path, 'w') as f:
+        for stack, count in sorted(stacks.items()):
+            f.write(f"{stack} {count}\n")
+
+def flamegraph(folded_path, svg_path):
+    tool = shutil.which('flamegraph.pl')
+    if tool is None:
+        return False
+    with open(svg_path, 'w') as f:
+        return subprocess.run([tool, folded_path], stdout=f).returncode == 0
+
+def breakdown(stacks):
+    # Share of the samples in each category, and in the kernel
+    total = sum(stacks.values())
+    shares = {name: 0 for name, _ in CATEGORIES}
+    shares['kernel'] = 0
+    for stack, count in stacks.items():
+        frames = stack.split(';')[1:]
+        for name, matches in CATEGORIES:
+            if any(matches(frame) for frame in frames):
+                shares[name] += count
+        if frames and frames[-1].endswith('_[k]'):
+            shares['kernel'] += count
+    return total, {name: count / total if total else 0 for name, count in shares.items()}
+
+def summarize(name, stacks):
+    total, shares = breakdown(stacks)
+    return (f"{name}: {total} samples, " +
+            ', '.join(f"{category} {share:.0%}" for category, share in shares.items()) + "\n")
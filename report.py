@@ -0,0 +1,181 @@
+"""
+Per-run tables built from the RESULT lines the generated tests print.
+"""
+import statistics
+
+LATENCY_TABLE = "latency.txt"
+LATENCY_HEADER = f"{'SUITE':<10} {'TRANSPORT':<9} {'OPCODE':<6} {'STATUS':<6} {'LATENCY (us)':>12}  FUNCTION\n"
+
+def transport(suite_info):
+    return 'mctp' if suite_info['mctp'] is not None else 'ioctl'
+
+def latency_rows(results):
+    rows = []
+    for result in results:
+        if 'ns' not in result:
+            continue
+        latency_us = int(result['ns']) / 1000
+        rows.append(f"{result['suite']:<10} {result['transport']:<9} {result['opcode']:<6} "
+                    f"{result['status']:<6} {latency_us:>12.1f}  {result['function']}\n")
+    return rows
+
+def write_latency_table(results, path, extra_rows=()):
+    # extra_rows: rows already formatted by other runners (see merge_latency_tables)
+    rows = latency_rows(results) + list(extra_rows)
+    if not rows:
+        return False
+    with open(path, 'w') as f:
+        f.write(LATENCY_HEADER)
+        f.writelines(rows)
+    print(f"Latency table written to {path}")
+    print(LATENCY_HEADER + ''.join(rows), end='')
+    return True
+
+def merge_latency_tables(paths, dst):
+    rows = []
+    for path in paths:
+        with open(path, 'r') as f:
+            rows.extend(f.readlines()[1:])
+    return write_latency_table([], dst, rows)
+
+BENCH_TABLE = "bench.txt"
+BENCH_HEADER = (f"{'SUITE':<10} {'OPCODE':<6} {'TRANSPORT':<9} {'ITER':>6} {'ERR':>5} "
+                f"{'MIN (us)':>10} {'P50 (us)':>10} {'P99 (us)':>10} {'MAX (us)':>10} {'OPS/S':>10}  FUNCTION\n")
+
+def write_bench_table(results, path):
+    # Rows of the same opcode are adjacent so the transports can be compared
+    results = sorted(results, key=lambda r: (r['suite'], r['opcode'], r['transport']))
+    if not results:
+        return False
+    with open(path, 'w') as f:
+        f.write(BENCH_HEADER)
+        for r in results:
+            us = {key: int(r[key]) / 1000 for key in ('min_ns', 'p50_ns', 'p99_ns', 'max_ns')}
+            f.write(f"{r['suite']:<10} {r['opcode']:<6} {r['transport']:<9} {r['iterations']:>6} "
+                    f"{r['errors']:>5} {us['min_ns']:>10.1f} {us['p50_ns']:>10.1f} "
+                    f"{us['p99_ns']:>10.1f} {us['max_ns']:>10.1f} {float(r['ops_per_sec']):>10.1f}  "
+                    f"{r['function']}\n")
+    with open(path, 'r') as f:
+        print(f.read(), end='')
+    print(f"Benchmark results written to {path}")
+    return True
+
+STRESS_TABLE = "stress.txt"
+
+def write_stress_table(results, path):
+    # results: (suite, STRESS dict, [STRESS_CMD dicts]) per stress run
+    if not results:
+        return False
+    with open(path, 'w') as f:
+        for suite, summary, cmds in results:
+            us = {key: int(summary[key]) / 1000 for key in ('min_ns', 'p50_ns', 'p99_ns', 'max_ns')}
+            f.write(f"{suite}: {summary['threads']} threads, {summary['endpoints']} endpoints over "
+                    f"{summary['transports']} for {summary['duration_ms']} ms\n")
+            f.write(f"  ops={summary['ops']} ops/s={float(summary['ops_per_sec']):.1f} "
+                    f"errors={summary['errors']} mismatches={summary['mismatches']}\n")
+            f.write(f"  latency (us): min={us['min_ns']:.1f} p50={us['p50_ns']:.1f} "
+                    f"p99={us['p99_ns']:.1f} max={us['max_ns']:.1f} "
+                    f"({summary['samples']} samples, {summary['dropped']} ops not sampled)\n")
+            for cmd in cmds:
+                f.write(f"    {cmd['opcode']} {cmd['function']:<45} ops={cmd['ops']} "
+                        f"errors={cmd['errors']} mismatches={cmd['mismatches']}\n")
+    with open(path, 'r') as f:
+        print(f.read(), end='')
+    print(f"Stress results written to {path}")
+    return True
+
+TUNNEL_TABLE = "tunnel.txt"
+
+def write_tunnel_table(samples, path):
+    """
+    Median latency of each command at every tunnel level it ran at, and what
+    each level adds over the direct call. samples: (suite, opcode, function,
+    levels, ns), with tunneled variants under the suite they are a variant of.
+    """
+    by_cmd = {}
+    for suite, opcode, function, levels, ns in samples:
+        by_cmd.setdefault((suite, opcode, function), {}).setdefault(levels, []).append(ns)
+    all_levels = sorted({levels for *_, levels, _ in samples})
+    if len(all_levels) < 2:
+        return False
+
+    header = f"{'SUITE':<10} {'OPCODE':<6}"
+    for levels in all_levels:
+        header += f" {f'L{levels} (us)':>10}" + (f" {f'+L{levels} (us)':>11}" if levels else "")
+    lines = [header + "  FUNCTION\n"]
+    for (suite, opcode, function), latencies in sorted(by_cmd.items()):
+        if set(latencies) == {0}:
+            continue
+        medians = {levels: statistics.median(ns) / 1000 for levels, ns in latencies.items()}
+        line = f"{suite:<10} {opcode:<6}"
+        for levels in all_levels:
+            value = f"{medians[levels]:.1f}" if levels in medians else "-"
+            line += f" {value:>10}"
+            if levels:
+                overhead = f"{medians[levels] - medians[0]:+.1f}" if levels in medians and 0 in medians else "-"
+                line += f" {overhead:>11}"
+        lines.append(f"{line}  {function}\n")
+    with open(path, 'w') as f:
+        f.writelines(lines)
+    print(''.join(lines), end='')
+    print(f"Tunnel overhead table written to {path}")
+    return True
+
+TRANSFER_TABLE = "transfer.txt"
+TRANSFER_HEADER = (f"{'SUITE':<10} {'OPCODE':<6} {'TRANSPORT':<9} {'LIMIT (B)':>9} {'SIZE (B)':>9} "
+                   f"{'TRIPS':>6} {'ERR':>5} {'US/XFER':>10} {'MB/S':>8}  FUNCTION\n")
+
+def write_transfer_table(results, path):
+    # One row per limit and size; limits the device refused are noted as such
+    results = sorted(results, key=lambda r: (r['suite'], r['opcode'], r['transport'],
+                                             int(r['limit']), int(r.get('size', 0))))
+    if not results:
+        return False
+    with open(path, 'w') as f:
+        f.write(TRANSFER_HEADER)
+        for r in results:
+            line = f"{r['suite']:<10} {r['opcode']:<6} {r['transport']:<9} "
+            if 'set_rc' in r:
+                line += f"{1 << int(r['limit']):>9} limit refused (rc={r['set_rc']})"
+            else:
+                line += (f"{r['limit_bytes']:>9} {r['size']:>9} {r['round_trips']:>6} {r['errors']:>5} "
+                         f"{int(r['ns_per_transfer']) / 1000:>10.1f} "
+                         f"{float(r['bytes_per_sec']) / 1e6:>8.2f}")
+            f.write(f"{line}  {r['function']}\n")
+    with open(path, 'r') as f:
+        print(f.read(), end='')
+    print(f"Transfer results written to {path}")
+    return True
+
+SCALE_TABLE = "scale.txt"
+SCALE_EP_HEADER = (f"  {'MODE':<10} {'TRANSPORT':<9} {'TARGET':<8} {'CTX (us)':>9} {'OPEN (us)':>10} "
+                   f"{'IDENTIFY (us)':>13} {'RC':>4}\n")
+
+def write_scale_table(summaries, endpoints, path):
+    # summaries: the SCALE line of each phase; endpoints: the SCALE_EP lines
+    if not summaries:
+        return False
+    def us(r, key):
+        return int(r[key]) / 1000
+
+    lines = []
+    for s in summaries:
+        if s['mode'] == 'discovery':
+            lines.append(f"discovery: MCTP scan found {s['mctp_found']}/{s['mctp_expected']} endpoints "
+                         f"in {us(s, 'scan_ns'):.1f} us, identified in {us(s, 'scan_identify_ns'):.1f} us "
+                         f"({s['scan_errors']} errors); /dev/cxl has {s['ioctl_found']}/{s['ioctl_expected']} "
+                         f"memdevs ({us(s, 'readdir_ns'):.1f} us)\n")
+        else:
+            lines.append(f"{s['mode']}: {s['endpoints']} endpoints, {s['errors']} errors, "
+                         f"fan-out {us(s, 'fanout_ns'):.1f} us; context {us(s, 'ctx_ns'):.1f} us, "
+                         f"open {us(s, 'open_ns'):.1f} us (max {us(s, 'open_max_ns'):.1f}), "
+                         f"identify {us(s, 'identify_ns'):.1f} us (max {us(s, 'identify_max_ns'):.1f})\n")
+    lines.append(SCALE_EP_HEADER)
+    for r in endpoints:
+        lines.append(f"  {r['mode']:<10} {r['transport']:<9} {r['target']:<8} {us(r, 'ctx_ns'):>9.1f} "
+                     f"{us(r, 'open_ns'):>10.1f} {us(r, 'identify_ns'):>13.1f} {r['rc']:>4}\n")
+    with open(path, 'w') as f:
+        f.writelines(lines)
+    print(''.join(lines), end='')
+    print(f"Scale results written to {path}")
+    return True
@@ -1,11 +1,33 @@
 import sys
 import os
+import glob
 import shutil
+import asyncio
+import time
 import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 import xml.etree.ElementTree as ET
 from topo import SUITES
+import topo
 from parse_docs import generate_default_opcode_map, print_opcode_map
-from generate_tests import generate_test_file, load_xml
+from generate_tests import generate_test_file, generate_suite_file
+import generate_tests
+import cache
+import snapshot
+import artifacts
+import guest
+import instance
+import build
+import report
+import generate_stress
+import generate_transfer
+import generate_scale
+import sim
+import schedule
+import timing
+import history
+import profiling
 
 # Add cxl_test_tool to the module search path to import necessary packages
 subdir_path = os.path.join(os.path.dirname(__file__), 'cxl_test_tool')
@@ -13,190 +35,879 @@ sys.path.insert(0, subdir_path)
 from cxl_test_tool.utils import tools, mctp, cxl, config
 
 opcode_map = {}
+use_snapshots = False
+host_build = False
+
+# Cached libcxlmi build installed in the current VM (see install_libcxlmi())
+libcxlmi_artifact = None
+
+# Packed host libcxlmi checkout, if already prepared (see prepare_source())
+libcxlmi_source = None
+
+# Every RESULT line reported during this run, tagged with suite and transport
+run_results = []
+
+# Seconds a test binary may run before it is killed (--timeout)
+test_timeout = None
+profile = False
+
+# Phase events of the child runners, merged into this run's trace
+instance_events = []
+
+# Per-instance state, changed by --instance when running under --jobs
+instance_id = None
+output_dir = './output'
+qmp_port = snapshot.QMP_PORT
+
+# libcxlmi checkout this repo lives in (see the docs paths in parse_docs.py)
+LIBCXLMI_DIR = '../..'
+
+def prepare_source(name='libcxlmi'):
+    # Pack the host libcxlmi checkout for the VM. Returns None without a checkout
+    global libcxlmi_source
+    src_tar = cache.cache_path('libcxlmi-src.tar.gz')
+    if artifacts.pack_source(LIBCXLMI_DIR, src_tar, name):
+        libcxlmi_source = src_tar
+    return libcxlmi_source
+
+def build_libcxlmi(target_dir, key, libcxlmi_rev, toolchain):
+    # GH Runner clones libcxlmi on PR. Copy the runner's checkout to the VM and
+    # only fall back to cloning when there is no checkout on the host
+    src_tar = libcxlmi_source or prepare_source(os.path.basename(os.path.normpath(target_dir)))
+    if src_tar is not None:
+        guest.copy_to_remote(src_tar, dst="/tmp/libcxlmi-src.tar.gz")
+        guest.execute(artifacts.unpack_cmd("/tmp/libcxlmi-src.tar.gz", target_dir), echo=True)
+        tools.install_packages_on_vm("meson libdbus-1-dev cmake locales")
+    else:
+        tools.install_packages_on_vm("meson libdbus-1-dev git cmake locales")
+        branch, url = guest.VARS['libcxlmi_branch'], guest.VARS['libcxlmi_url']
+        cmd="git clone -b %s --single-branch %s %s"%(branch, url, target_dir)
+        guest.execute(cmd, echo=True)
+
+    cmd="cd %s; meson setup %s build; meson compile -C build;"%(target_dir, artifacts.MESON_OPTIONS)
+    guest.execute(cmd, echo=True)
+
+    remote_tar = "/tmp/libcxlmi-build.tar.gz"
+    guest.execute(artifacts.pack_build_cmd(target_dir, remote_tar), echo=True)
+    path = artifacts.fetch_build(key, remote_tar, libcxlmi_rev, toolchain)
+    guest.execute(f"rm -f {remote_tar}")
+    return path
+
+def libcxlmi_key():
+    # Cache key of the libcxlmi build for the running VM
+    libcxlmi_rev = cache.libcxlmi_revision(LIBCXLMI_DIR)
+    toolchain = artifacts.guest_toolchain(guest.execute)
+    return artifacts.artifact_key(libcxlmi_rev, artifacts.MESON_OPTIONS, toolchain), libcxlmi_rev, toolchain
 
-# GH Runner clones libcxlmi on PR. Copy from runner to VM
 def install_libcxlmi(target_dir="./libcxlmi"):
-    tools.copy_to_remote(src=".", dst=".")
+    """
+    Install a built libcxlmi in the VM. Builds are cached on the host keyed by
+    libcxlmi revision, meson options and guest toolchain, so with a warm cache
+    this is one copy and an untar, with no package installs or network access.
+    """
+    global libcxlmi_artifact
+    key, libcxlmi_rev, toolchain = libcxlmi_key()
 
-    tools.install_packages_on_vm("meson libdbus-1-dev git cmake locales")
-    cmd="git clone -b %s --single-branch %s %s"%(branch, url, target_dir)
-    tools.execute_on_vm(cmd, echo=True)
-    cmd="cd %s; meson setup -Dlibdbus=enabled build; meson compile -C build;"%target_dir
-    tools.execute_on_vm(cmd, echo=True)
+    cached = artifacts.lookup(key)
+    if cached is not None:
+        print(f"INFO: Using cached libcxlmi build {cached}")
+        guest.copy_to_remote(cached, dst="/tmp/libcxlmi-build.tar.gz")
+        guest.execute(artifacts.unpack_cmd("/tmp/libcxlmi-build.tar.gz", target_dir), echo=True)
+    else:
+        cached = build_libcxlmi(target_dir, key, libcxlmi_rev, toolchain)
+    libcxlmi_artifact = cached
 
-    if tools.path_exist_on_vm(target_dir):
+    if guest.path_exists(target_dir):
         print("INFO: Install libcxlmi succeeded")
         return 0
 
     print("ERROR: Install libcxlmi failed!")
     return -1
 
-def start_vm(suite, output_file):
+def setup_vm(qemu_str, has_mctp):
     # Start VM, set up MCTP (if applicable), load drivers, and clone libcxlmi
-    tools.run_qemu(topo=suite["qemu_str"], kernel=KERNEL_IMG, qemu=QEMU_IMG)
+    with timing.phase('run_qemu'):
+        tools.run_qemu(topo=qemu_str, kernel=KERNEL_IMG, qemu=QEMU_IMG)
     print('-------------------------------------------------')
-    if suite["mctp"] is not None:
-        mctp.mctp_setup(CXL_TEST_TOOL_DIR + "/test-workflows/mctp.sh")
+    if has_mctp:
+        with timing.phase('mctp_setup'):
+            mctp.mctp_setup(CXL_TEST_TOOL_DIR + "/test-workflows/mctp.sh")
         print('-------------------------------------------------')
 
-    cxl.load_driver()
+    with timing.phase('load_driver'):
+        cxl.load_driver()
     print('-------------------------------------------------')
-    install_libcxlmi(target_dir='./libcxlmi')
+    with timing.phase('install_libcxlmi'):
+        install_libcxlmi(target_dir='./libcxlmi')
     print('-------------------------------------------------')
-    tools.execute_on_vm('cxl list', echo=True)
+    with timing.phase('cxl_list'):
+        guest.execute('cxl list', echo=True)
     print('-------------------------------------------------')
 
-    # Copy test file to VM and compile
+# mctpd bus owner interface of the i2c bus the MCTP endpoints are on
+MCTP_BUS_OWNER = ("au.com.codeconstruct.MCTP1 /au/com/codeconstruct/mctp1/interfaces/mctpi2c0 "
+                  "au.com.codeconstruct.MCTP.BusOwner1")
+
+def setup_mctp_endpoints(addresses):
+    """
+    Have mctpd assign an EID to the MCTP endpoint at each i2c address, for
+    topologies with more endpoints than mctp.sh sets up. Returns the
+    "nid:eid" of each endpoint set up.
+    """
+    cmds = [f"busctl call {MCTP_BUS_OWNER} SetupEndpoint ay 1 {address}" for address in addresses]
+    endpoints = []
+    with timing.phase('mctp_setup', endpoints=len(addresses)):
+        for address, (rc, output) in zip(addresses, guest.execute_batch(cmds)):
+            # yisb 9 11 "/au/com/codeconstruct/mctp1/networks/11/endpoints/9" true
+            fields = output.split()
+            if rc != 0 or len(fields) < 3:
+                print(f"WARN: Failed to set up the MCTP endpoint at i2c address {address}: {output.strip()}")
+                continue
+            endpoints.append(f"{fields[2]}:{fields[1]}")
+    return endpoints
+
+def boot_from_snapshot(suite, suite_info):
+    """
+    Bring up the suite's VM from its saved snapshot, which was taken right
+    after setup_vm() finished. If there is no valid snapshot for the current
+    topology, kernel, libcxlmi revision and meson options, cold boot and
+    take one.
+    Returns the snapshot tag to restore between tests, or None.
+    """
+    key = snapshot.snapshot_key(suite_info['qemu_str'], KERNEL_IMG,
+                                cache.libcxlmi_revision(LIBCXLMI_DIR), artifacts.MESON_OPTIONS)
+    qemu_str = suite_info['qemu_str'] + snapshot.qmp_args(qmp_port)
+    # Each instance has its own disk overlay, so its own set of snapshots
+    if instance_id is not None:
+        suite = f"{suite}@{instance_id}"
+
+    tag = snapshot.lookup(suite, key)
+    if tag is not None:
+        print(f"Restoring suite {suite} from snapshot {tag}")
+        with timing.phase('run_qemu', snapshot=tag):
+            tools.run_qemu(topo=qemu_str + f" -loadvm {tag}", kernel=KERNEL_IMG, qemu=QEMU_IMG)
+        if guest.path_exists('./libcxlmi/build'):
+            global libcxlmi_artifact
+            libcxlmi_artifact = artifacts.lookup(libcxlmi_key()[0])
+            return tag
+        print(f"WARN: Snapshot {tag} did not restore, rebuilding it")
+        snapshot.forget(suite)
+        guest.disconnect()
+        try:
+            tools.shutdown_vm()
+        except Exception as e:
+            print(f"Failed to shut down VM. Reason: {e}")
+
+    setup_vm(qemu_str, suite_info["mctp"] is not None)
+    with timing.phase('snapshot_save', suite=suite):
+        return snapshot.save(suite, key, qmp_port)
+
+def boot_vm(suite_info, suite=None):
+    # Returns the snapshot tag to restore between tests (snapshot mode only)
+    # A master connection left by an earlier VM on this port would be stale
+    guest.disconnect()
+    if use_snapshots and suite is not None:
+        return boot_from_snapshot(suite, suite_info)
+
+    setup_vm(suite_info["qemu_str"], suite_info["mctp"] is not None)
+    return None
+
+def compile_tests(output_files):
+    # Copy the test files to the VM in one transfer and compile them in one batch
     libcxlmi_incl = './libcxlmi/src'
     libcxlmi_bin = './libcxlmi/build/src'
-    compile_str = f'gcc /tmp/{output_file} -I{libcxlmi_incl} -L{libcxlmi_bin} -lcxlmi -o /tmp/{output_file[:-2]}'
-    tools.copy_to_remote(output_file, dst=f"/tmp/{output_file}")
+    cflags = ' '.join(profiling.CFLAGS) + ' ' if profile else ''
+    compile_strs = [f'gcc {cflags}/tmp/{output_file} -I{libcxlmi_incl} -L{libcxlmi_bin} -lcxlmi -pthread -o /tmp/{output_file[:-2]}'
+                    for output_file in output_files]
+    with timing.phase('copy_test', tests=len(output_files)):
+        guest.copy_to_remote([f"{output_dir}/{output_file}" for output_file in output_files], dst="/tmp/")
     print('-------------------------------------------------')
-    print(tools.execute_on_vm(compile_str, echo=True))
+    with timing.phase('compile', tests=len(output_files)):
+        for output_file, (rc, output) in zip(output_files, guest.execute_batch(compile_strs, echo=True)):
+            if rc != 0:
+                print(f"ERROR: Compiling {output_file} failed (rc={rc})")
     print('-------------------------------------------------')
 
+def deploy_tests(test_files):
+    """
+    Compile the tests on the host against the cached libcxlmi build and copy
+    them, with libcxlmi.so, to the VM's /tmp in a single transfer.
+    Returns False if there is nothing to build against.
+    """
+    if libcxlmi_artifact is None:
+        print("WARN: No cached libcxlmi build to compile against, compiling in the VM")
+        return False
+
+    copy_tests(build_tests(test_files, libcxlmi_artifact))
+    return True
+
+def build_tests(test_files, artifact):
+    # Compile the tests on the host against a cached libcxlmi build and pack them
+    with timing.phase('host_build', tests=len(test_files)):
+        libcxlmi_dir = build.extract_artifact(artifact)
+        binaries = build.build_tests([f"{output_dir}/{test_file}" for test_file in test_files],
+                                     libcxlmi_dir,
+                                     cc=guest.VARS.get('host_cc', 'gcc'),
+                                     sysroot=guest.VARS.get('host_sysroot'),
+                                     cflags=profiling.CFLAGS if profile else ())
+        archive = build.pack_tests(binaries, libcxlmi_dir, f"{output_dir}/tests.tar.gz")
+    print(f"Built {len(binaries)} of {len(test_files)} test(s) on the host")
+    return archive
+
+def copy_tests(archive):
+    with timing.phase('copy_tests'):
+        guest.copy_to_remote(archive, dst="/tmp/tests.tar.gz")
+        guest.execute("tar -C /tmp -xzf /tmp/tests.tar.gz && rm -f /tmp/tests.tar.gz", echo=True)
+    print('-------------------------------------------------')
+
+def install_tests(test_files):
+    # Get the test binaries into the VM: built on the host with --host-build,
+    # otherwise copied and compiled in the guest
+    if host_build and deploy_tests(test_files):
+        return
+    compile_tests(test_files)
+
+def start_vm(suite_info, output_file, suite=None):
+    boot_vm(suite_info, suite)
+    install_tests([output_file])
+
+def stop_vm():
+    # Shut down VM and clean up
+    print('Shutting down VM...')
+    with timing.phase('shutdown_vm'):
+        guest.execute('rm -rf libcxlmi')
+        guest.disconnect()
+        tools.shutdown_vm()
+
+def record_results(suite, output):
+    results = parse_results(output)
+    for result in results:
+        result.update(suite=suite, transport=report.transport(SUITES[suite]))
+    run_results.extend(results)
+    return results
+
+def run_binary(output_file, header="", args="", timeout=None):
+    """
+    Run a test binary in the VM, streaming its output into its results file
+    and the terminal as it arrives, and kill it after timeout (by default
+    --timeout) seconds.
+    Returns its exit code (None if the VM stopped answering) and output.
+    """
+    results_file = f"{output_dir}/{output_file[:-2]}-results.txt"
+    binary = f'/tmp/{output_file[:-2]}'
+    if profile:
+        ensure_perf()
+    cmd = profiling.record_cmd(binary) if profile else binary
+    with open(results_file, 'w') as f:
+        f.write(header)
+        # perf only writes its samples out when it is stopped with a signal it can catch
+        rc, output = guest.stream(f"{cmd} {args}" if args else cmd, f, timeout or test_timeout,
+                                  signal='INT' if profile else 'KILL')
+    if profile and rc is not None:
+        collect_profile(binary)
+    return rc, output
+
+def ensure_perf():
+    # perf is not part of the guest image, install it the first time it is needed
+    if guest.execute_batch(["command -v perf"])[0][0] != 0:
+        with timing.phase('install_perf'):
+            tools.install_packages_on_vm("linux-perf")
+
+def collect_profile(binary):
+    """
+    Symbolize a test's perf samples in the VM, fold them on the host and
+    write output/profile/<test>.folded (and .svg with flamegraph.pl).
+    """
+    name = os.path.basename(binary)
+    profile_dir = os.path.join(output_dir, profiling.PROFILE_DIR)
+    os.makedirs(profile_dir, exist_ok=True)
+    script = os.path.join(profile_dir, f"{name}.perf.script")
+    with timing.phase('profile', test=name):
+        rc, _ = guest.execute_batch([profiling.script_cmd(binary)])[0]
+        if rc != 0:
+            print(f"WARN: perf script failed for {name}, no profile")
+            return
+        guest.copy_from_remote(f"{binary}.perf.script", script)
+        guest.execute(f"rm -f {profiling.data_path(binary)} {binary}.perf.script")
+        stacks = profiling.fold(script)
+    folded = os.path.join(profile_dir, f"{name}.folded")
+    profiling.write_folded(stacks, folded)
+    profiling.flamegraph(folded, os.path.join(profile_dir, f"{name}.svg"))
+    print(profiling.summarize(name, stacks), end='')
+    print(f"Profile written to {folded}")
+
+def timed_out(rc, results):
+    # Killed by `timeout -s KILL` (137), stopped by `timeout -s INT` under
+    # --profile or by its own command watchdog (124), or given up on by the
+    # host (None)
+    return rc in (None, 124, 137) or any(result['status'] == 'TIMEOUT' for result in results)
+
+def execute_program(output_file, args="", timeout=None):
+    # Run a --bench, --stress, --transfer or --scale program like a test
+    # binary. Returns its output, up to where it was killed if it timed out
+    with timing.phase('execute', file=output_file):
+        rc, output = run_binary(output_file, args=args, timeout=timeout)
+    if timed_out(rc, []):
+        print(f"{output_file[:-2]} timed out. Check {output_dir}/{output_file[:-2]}-results.txt for details.")
+    return output
+
+def report_verdict(opcode, output_file, results, rc=0, suite=None):
+    results_file = f"{output_dir}/{output_file[:-2]}-results.txt"
+    lines = results.splitlines()
+    if timed_out(rc, record_results(suite or opcode_map[opcode]['suite'], results)):
+        print(f"Test {opcode} timed out. Check {results_file} for details.")
+    elif rc == 0 and lines and lines[-1] == "All tests passed":
+        print(f"Test {opcode} passed.")
+    else:
+        print(f"Test {opcode} failed. Check {results_file} for details.")
+
 def execute_test(opcode, output_file):
     # Execute tests and capture output
-    results_file = f"./output/{output_file[:-2]}-results.txt"
-    with open(results_file, 'w') as f:
-        results = tools.execute_on_vm(f'/tmp/{output_file[:-2]}', echo=False)
+    with timing.phase('execute', opcode=opcode):
+        rc, results = run_binary(output_file)
+    report_verdict(opcode, output_file, results, rc)
+
+def collect_results(opcode, output_file, results, rc=0, suite=None):
+    # For output that was not streamed into the results file
+    with open(f"{output_dir}/{output_file[:-2]}-results.txt", 'w') as f:
         f.write(results)
-        if results.splitlines()[:-1] == "All tests passed":
-            print(f"Test {opcode} passed.")
-        else:
-            print(f"Test {opcode} failed. Check {results_file} for details.")
+    report_verdict(opcode, output_file, results, rc, suite)
+
+def generate_test(opcode, suite=None):
+    # Generate the C test file for one opcode (of its own suite, or of a
+    # tunneled variant of it) and return its name
+    suite = suite or opcode_map[opcode]['suite']
+    suite_info = SUITES[suite]
+    test_file = 'test-' + opcode + '.c'
+    if suite_info.get('variant_of'):
+        test_file = f"test-{opcode}-{suite.lower().replace('_', '-')}.c"
+
+    command_xml = generate_tests.find_command(suite_info['input'], opcode)
+    print(ET.tostring(command_xml).decode())
+
+    with timing.phase('generate', opcode=opcode):
+        changed = generate_tests.generate_if_changed(
+            test_file, [command_xml], suite_info, opcode_map,
+            lambda: generate_test_file(test_file, command_xml, suite_info, opcode_map))
+    if changed:
+        print(f"Code has been written to {output_dir}/{test_file}")
+    return test_file
 
 def run_test(opcode):
     suite = opcode_map[opcode]['suite']
     print(f"Opcode {opcode} belongs to suite {suite}")
 
-    suite_info = SUITES[suite]
-    input_file = suite_info['input']
-    test_file = 'test-' + opcode + '.c'
-    results_file = test_file[:-2] + '-results.txt'
+    with timing.phase('test', opcode=opcode, suite=suite):
+        test_file = generate_test(opcode)
 
-    root = load_xml(input_file)
-    command_xml = next((child for child in root if child.attrib.get('opcode') == opcode), None)
-    print(ET.tostring(command_xml).decode())
+        start_vm(SUITES[suite], test_file, suite)
+        execute_test(opcode, test_file)
+        stop_vm()
 
-    generate_test_file(test_file, command_xml, suite_info, opcode_map)
-    print(f"Code has been written to ./output/{test_file}")
+def suite_opcodes(suite):
+    # Opcodes with a <command> in the suite's XML input, in file order
+    return [child.attrib['opcode'] for child in generate_tests.iter_commands(SUITES[suite]['input'])
+            if 'opcode' in child.attrib]
 
-    start_vm(suite_info, test_file)
-    execute_test(opcode, results_file)
+def group_by_suite(opcodes):
+    # Map suite -> opcodes, dropping opcodes that have no topology to run on
+    sessions = {}
+    for opcode in opcodes:
+        if opcode not in opcode_map:
+            print(f"Opcode {opcode} not found in opcode map, skipping")
+            continue
+        suite = opcode_map[opcode]['suite']
+        if suite not in SUITES:
+            print(f"Opcode {opcode} belongs to suite {suite} which has no topology, skipping")
+            continue
+        sessions.setdefault(suite, []).append(opcode)
+    return sessions
 
-    # Shut down VM and clean up
-    print('Shutting down VM...')
-    tools.execute_on_vm('rm -rf libcxlmi')
-    tools.shutdown_vm()
+def direct_suites():
+    # Suites that are not tunneled variants of another (see topo.SUITES)
+    return [suite for suite, suite_info in SUITES.items() if not suite_info.get('variant_of')]
 
+def tunnel_samples(results, key):
+    # Latencies (key: 'ns' or 'p50_ns') for report.write_tunnel_table()
+    return [(SUITES[r['suite']].get('variant_of') or r['suite'], r['opcode'], r['function'],
+             int(r.get('tunnel', 0)), int(r[key]))
+            for r in results if key in r and r.get('status', 'PASS') == 'PASS']
 
-def run_suite(suite):
-    # Generate C test code
-    input_file = suite['input']
-    output_file = 'test-' + suite.lower().replace('_', '-') + '.c'
-    root = load_xml(input_file)
+def run_session(opcodes):
+    """
+    Run the given opcodes with one VM per topology instead of one per opcode.
 
-    generate_test_file(output_file, root, suite, opcode_map)
+    Opcodes are grouped by the suite they belong to (from the opcode map), so
+    the VM for each topology in SUITES is booted, set up and shut down once,
+    and every test binary of that suite is compiled and executed in it.
+    """
+    for suite, session_opcodes in group_by_suite(opcodes).items():
+        with timing.phase('suite', suite=suite, tests=len(session_opcodes)):
+            run_suite_session(suite, session_opcodes)
 
-    print(f"Code has been written to {output_file}")
+def run_suite_session(suite, session_opcodes):
+    print(f"Running {len(session_opcodes)} test(s) for suite {suite} on one VM")
+    test_files = {opcode: generate_test(opcode) for opcode in session_opcodes}
 
-    # Start VM, set up MCTP (if applicable), load drivers, and clone libcxlmi
-    tools.run_qemu(topo=suite["qemu_str"], kernel=KERNEL_IMG, qemu=QEMU_IMG)
-    print('-------------------------------------------------')
-    if suite["mctp"] is not None:
-        mctp.mctp_setup(CXL_TEST_TOOL_DIR + "/test-workflows/mctp.sh")
-        print('-------------------------------------------------')
+    session_start = time.monotonic()
+    tests_s = 0.0
+    tag = boot_vm(SUITES[suite], suite)
+    files = list(test_files.values())
+    installed = set()
+    for i, (opcode, test_file) in enumerate(test_files.items()):
+        # Start every test after the first from the clean, set-up VM
+        if tag is not None and i > 0:
+            with timing.phase('snapshot_restore', opcode=opcode):
+                restored = snapshot.restore(tag, qmp_port)
+                # The guest side of the shared connection is gone after loadvm
+                guest.disconnect()
+            if restored:
+                # Restoring also drops the tests installed since the snapshot
+                installed.clear()
+            else:
+                tag = None
+
+        test_start = time.monotonic()
+        with timing.phase('test', opcode=opcode, suite=suite):
+            # All remaining tests go over in one transfer, unless the next
+            # snapshot restore would drop those compiled in the guest
+            if test_file not in installed:
+                pending = [test_file] if tag is not None and not host_build else files[i:]
+                install_tests(pending)
+                installed.update(pending)
+            execute_test(opcode, test_file)
+        schedule.record('opcode', opcode, time.monotonic() - test_start)
+        tests_s += time.monotonic() - test_start
+    stop_vm()
+    # What the scheduler counts once per slot running the suite
+    schedule.record('suite', suite, time.monotonic() - session_start - tests_s)
+
+async def in_thread(name, func, *args, phase_args=None, **kwargs):
+    # Run a blocking step in a worker thread, timed as its own phase (unless
+    # name is None because func times itself) with phase_args as its args
+    if name is None:
+        return await asyncio.to_thread(func, *args, **kwargs)
+    def timed():
+        with timing.phase(name, **(phase_args or {})):
+            return func(*args, **kwargs)
+    return await asyncio.to_thread(timed)
+
+def prepare_host(suite, opcodes):
+    """
+    Host side of a suite run, none of which needs the VM: parse the docs,
+    generate the tests and, with --host-build, compile them against the
+    latest cached libcxlmi build of this revision.
+    Returns the generated test files by opcode and the packed binaries (or None).
+    """
+    global opcode_map
+    if not opcode_map:
+        opcode_map = generate_default_opcode_map()
+        print_opcode_map(opcode_map, f'{output_dir}/opcode_map.txt')
+    if opcodes is None:
+        opcodes = [opcode for opcode in suite_opcodes(suite) if opcode in opcode_map]
+    test_files = {opcode: generate_test(opcode, suite) for opcode in opcodes}
+
+    predicted = artifacts.latest(cache.libcxlmi_revision(LIBCXLMI_DIR), artifacts.MESON_OPTIONS)
+    if not host_build or predicted is None:
+        return test_files, None, None
+    return test_files, predicted, build_tests(list(test_files.values()), predicted)
 
-    cxl.load_driver()
+async def setup_vm_async(suite, suite_info):
+    # setup_vm() with the guest steps that do not depend on each other run at once
+    guest.disconnect()
+    if use_snapshots:
+        # A restored snapshot is already set up; a cold boot runs setup_vm()
+        await in_thread('boot_vm', boot_vm, suite_info, suite)
+        return
+
+    source = asyncio.create_task(in_thread('prepare_source', prepare_source))
+    await in_thread('run_qemu', tools.run_qemu, topo=suite_info['qemu_str'],
+                    kernel=KERNEL_IMG, qemu=QEMU_IMG)
     print('-------------------------------------------------')
-    install_libcxlmi(target_dir='./libcxlmi')
+    # The host checkout is packed while QEMU boots; wait for it before installing
+    await source
+    steps = [in_thread('load_driver', cxl.load_driver),
+             in_thread('install_libcxlmi', install_libcxlmi, './libcxlmi')]
+    if suite_info['mctp'] is not None:
+        steps.append(in_thread('mctp_setup', mctp.mctp_setup, CXL_TEST_TOOL_DIR + "/test-workflows/mctp.sh"))
+    await asyncio.gather(*steps)
     print('-------------------------------------------------')
-    tools.execute_on_vm('cxl list', echo=True)
+    await in_thread('cxl_list', guest.execute, 'cxl list', echo=True)
     print('-------------------------------------------------')
 
-    # Copy test file to VM and compile
-    libcxlmi_incl = './libcxlmi/src'
-    libcxlmi_bin = './libcxlmi/build/src'
-    compile_str = f'gcc /tmp/{output_file} -I{libcxlmi_incl} -L{libcxlmi_bin} -lcxlmi -o /tmp/{output_file[:-2]}'
-    tools.copy_to_remote(output_file, dst=f"/tmp/{output_file}")
-    print('-------------------------------------------------')
-    print(tools.execute_on_vm(compile_str, echo=True))
-    print('-------------------------------------------------')
+async def run_suite_async(suite, opcodes=None):
+    """
+    Run a suite's tests on one VM with independent work overlapped: the docs
+    are parsed, the tests generated (and with --host-build compiled) and the
+    libcxlmi checkout packed while QEMU boots; libcxlmi install, driver load
+    and MCTP setup run together; and each test's results are written out
+    while the next one runs. Snapshots are not restored between tests here.
+    """
+    suite_info = SUITES[suite]
+    with timing.phase('suite', suite=suite):
+        host = asyncio.create_task(in_thread('prepare_host', prepare_host, suite, opcodes))
+        await setup_vm_async(suite, suite_info)
+        test_files, predicted, archive = await host
+        files = list(test_files.values())
 
-    # Execute tests and capture output
-    results_file = f"./{output_file[:-2]}-results.txt"
-    with open(results_file, 'w') as f:
-        f.write(f"Test results for {topo}:\n")
-        f.write("------------------------------------\n")
-        results = tools.execute_on_vm(f'/tmp/{output_file[:-2]}', echo=False)
-        f.write(results)
-        if results.splitlines()[:-1] == "All tests passed":
-            print("All tests passed successfully.\n")
+        if archive is not None and predicted == libcxlmi_artifact:
+            await in_thread(None, copy_tests, archive)
+            install = None
+        elif host_build:
+            # The guest toolchain did not match the prediction: build against the real one
+            await in_thread('install_tests', install_tests, files)
+            install = None
         else:
-            print("Some tests failed. Check the output for details.\n")
-            print('Results for %s written to %s' % (topo, f.name))
+            install = asyncio.create_task(in_thread('install_tests', install_tests, files[:1]))
 
-    # Shut down VM and clean up
-    print('Shutting down VM...')
-    tools.execute_on_vm('rm -rf libcxlmi')
-    tools.shutdown_vm()
+        collecting = []
+        for i, (opcode, test_file) in enumerate(test_files.items()):
+            if install is not None:
+                await install
+                install = None
+            # Compile the next test in the guest while this one runs, unless
+            # that would skew the latencies measured with --latency
+            if not host_build and i + 1 < len(files):
+                install = asyncio.create_task(in_thread('install_tests', install_tests, files[i + 1:i + 2]))
+                if generate_tests.TIMED:
+                    await install
+                    install = None
+            rc, output = await in_thread('execute', run_binary, test_file, phase_args={'opcode': opcode})
+            collecting.append(asyncio.create_task(
+                in_thread('collect_results', report_verdict, opcode, test_file, output, rc, suite)))
+        await asyncio.gather(*collecting)
+        await in_thread(None, stop_vm)
 
+async def run_async(sessions):
+    # Suites (suite -> opcodes, None for all of them) run one after another
+    # (they share this runner's QEMU instance)
+    for suite, opcodes in sessions.items():
+        await run_suite_async(suite, opcodes)
 
-def run_all():
-    for suite, topo_info in SUITES.items():
-        # Generate C test code
-        input_file = topo_info['input']
-        output_file = 'test-' + topo.lower().replace('_', '-') + '.c'
-        root = load_xml(input_file)
-
-        generate_test_file(output_file, root, topo_info)
-        if topo_info["mctp"] and not args.ioctl:
-            generate_test_file(output_file, root, topo_info)
+def run_parallel(opcodes, jobs, child_args, durations):
+    """
+    Run the selected tests in `jobs` child runners (and so QEMU instances) at
+    once. Tests are packed onto the slots by their past durations (see
+    schedule.py), so a suite can be split over several slots. Every child
+    gets an instance slot that isolates its ports, backing files, disk and
+    output directory (see instance.py); results are merged into ./output
+    when all are done.
+    """
+    slot_sessions, loads = schedule.pack(group_by_suite(opcodes), jobs, durations)
+
+    def run_child(slot, sessions):
+        log_file = f"./output/instance-{slot}.log"
+        slot_opcodes = [opcode for suite_opcodes in sessions.values() for opcode in suite_opcodes]
+        cmd = [sys.executable, os.path.abspath(__file__), '-t', ','.join(slot_opcodes),
+               '--session', '--instance', str(slot)] + child_args
+        print(f"Starting {', '.join(sessions)} on instance {slot} (estimated {loads[slot]:.0f}s), log: {log_file}")
+        with open(log_file, 'w') as log, timing.phase('instance', suites=list(sessions), instance=slot):
+            rc = subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT).returncode
+        print(f"Instance {slot} finished (rc={rc})")
+        return log_file
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(run_child, slot, sessions)
+                   for slot, sessions in enumerate(slot_sessions) if sessions]
+        logs = [f.result() for f in futures]
+
+    merge_results(logs)
+
+def merge_results(logs):
+    # Collect every instance's results files and verdicts into ./output
+    for path in glob.glob('./output/instance-*/*-results.txt'):
+        shutil.copy(path, './output/')
+    report.merge_latency_tables(sorted(glob.glob(f'./output/instance-*/{report.LATENCY_TABLE}')),
+                                f'./output/{report.LATENCY_TABLE}')
+    # Every instance's phases become a track of their own in the run's trace
+    instance_events.extend(event for path in sorted(glob.glob(f'./output/instance-*/{timing.TRACE_FILE}'))
+                           for event in timing.load_events(path))
+
+    # A suite can be split over several instances: group verdicts by the
+    # suite session they were printed in (see run_suite_session())
+    verdicts = {}
+    for log_file in logs:
+        with open(log_file, 'r') as log:
+            suite = None
+            for line in log:
+                if line.startswith('Running ') and ' for suite ' in line:
+                    suite = line.split(' for suite ')[1].split()[0]
+                elif line.startswith('Test '):
+                    verdicts.setdefault(suite, []).append(line)
+
+    with open('./output/summary.txt', 'w') as summary:
+        for suite, suite_verdicts in verdicts.items():
+            summary.write(f"{suite}:\n")
+            summary.writelines(suite_verdicts)
+            print(f"{suite}:")
+            print(''.join(suite_verdicts), end='')
+    print("Summary written to ./output/summary.txt")
+
+
+def parse_results(output, kind='RESULT'):
+    # Turn the RESULT (or BENCH) lines printed by the tests into dicts
+    results = []
+    for line in output.splitlines():
+        if line.startswith(kind + ' '):
+            results.append(dict(field.split('=', 1) for field in line.split()[1:]))
+    return results
+
+def execute_suite(suite, opcodes, output_file):
+    # Execute the suite binary once and report a verdict per command
+    results_file = f"{output_dir}/{output_file[:-2]}-results.txt"
+    with timing.phase('execute', suite=suite):
+        rc, results = run_binary(output_file, f"Test results for {suite}:\n"
+                                              "------------------------------------\n")
+
+    reported = {result['opcode']: result for result in record_results(suite, results)}
+    # A timeout ends the whole program, the commands after it never ran
+    stopped = timed_out(rc, reported.values())
+    for opcode in opcodes:
+        if opcode not in reported and stopped:
+            run_results.append({'opcode': opcode, 'function': opcode_map[opcode]['function'],
+                                'status': 'SKIPPED', 'suite': suite,
+                                'transport': report.transport(SUITES[suite])})
+            print(f"Test {opcode} skipped: the suite timed out before it ran. Check {results_file} for details.")
+        elif opcode not in reported:
+            print(f"Test {opcode} did not report a result (rc={rc}). Check {results_file} for details.")
+        elif reported[opcode]['status'] == 'TIMEOUT':
+            print(f"Test {opcode} timed out. Check {results_file} for details.")
+        elif reported[opcode]['status'] == 'PASS':
+            print(f"Test {opcode} passed.")
         else:
-            devname = topo_info['ioctl']
-            generate_test_file(output_file, root, t)
-        print(f"Code has been written to {output_file}")
+            print(f"Test {opcode} failed. Check {results_file} for details.")
 
-        # Start VM, set up MCTP (if applicable), load drivers, and clone libcxlmi
-        tools.run_qemu(topo=topo_info["topo_str"], kernel=KERNEL_IMG, qemu=QEMU_IMG)
-        print('-------------------------------------------------')
-        if topo_info["has_mctp"]:
-            mctp.mctp_setup(CXL_TEST_TOOL_DIR + "/test-workflows/mctp.sh")
-            print('-------------------------------------------------')
-        cxl.load_driver()
-        print('-------------------------------------------------')
-        install_libcxlmi(target_dir='./libcxlmi')
-        print('-------------------------------------------------')
-        tools.execute_on_vm('cxl list', echo=True)
-        print('-------------------------------------------------')
+def run_suite(suite):
+    # Generate one C program for the whole suite, then compile and run it once
+    suite = suite.upper()
+    suite_info = SUITES[suite]
+    output_file = 'test-' + suite.lower().replace('_', '-') + '.c'
+    # The input is streamed twice (hash, then generation) instead of being held in memory
+    def commands():
+        return (child for child in generate_tests.iter_commands(suite_info['input'])
+                if child.attrib.get('opcode') in opcode_map)
+    opcodes = [opcode for opcode in suite_opcodes(suite) if opcode in opcode_map]
 
-        # Copy test file to VM and compile
-        libcxlmi_incl = './libcxlmi/src'
-        libcxlmi_bin = './libcxlmi/build/src'
-        compile_str = f'gcc /tmp/{output_file} -I{libcxlmi_incl} -L{libcxlmi_bin} -lcxlmi -o /tmp/{output_file[:-2]}'
-        tools.copy_to_remote(output_file, dst=f"/tmp/{output_file}")
-        print('-------------------------------------------------')
-        print(tools.execute_on_vm(compile_str, echo=True))
-        print('-------------------------------------------------')
+    with timing.phase('suite', suite=suite, tests=len(opcodes)):
+        with timing.phase('generate', suite=suite):
+            changed = generate_tests.generate_if_changed(
+                output_file, commands(), suite_info, opcode_map,
+                lambda: generate_suite_file(output_file, commands(), suite_info, opcode_map))
+        if changed:
+            print(f"Code has been written to {output_dir}/{output_file}")
 
-        # Execute tests and capture output
-        results_file = f"./{output_file[:-2]}-results.txt"
-        with open(results_file, 'w') as f:
-            f.write(f"Test results for {topo}:\n")
-            f.write("------------------------------------\n")
-            results = tools.execute_on_vm(f'/tmp/{output_file[:-2]}', echo=False)
-            f.write(results)
-            if results.splitlines()[:-1] == "All tests passed":
-                print("All tests passed successfully.\n")
-            else:
-                print("Some tests failed. Check the output for details.\n")
-            print('Results for %s written to %s' % (topo, f.name))
+        start_vm(suite_info, output_file, suite)
+        execute_suite(suite, opcodes, output_file)
+        stop_vm()
 
-        # Shut down VM and clean up
-        print('Shutting down VM...')
-        tools.execute_on_vm('rm -rf libcxlmi')
-        tools.shutdown_vm()
+
+def run_bench(suites, iterations, warmup):
+    """
+    Benchmark every idempotent command of each suite over each transport the
+    suite defines (MCTP and/or ioctl), in one VM per suite, and write a
+    table of latency percentiles and throughput per opcode and transport.
+    """
+    bench_results = []
+    for suite in suites:
+        suite_info = SUITES[suite]
+        # Streamed once per pass (hash, generation) instead of held in memory
+        def commands():
+            return (child for child in generate_tests.iter_commands(suite_info['input'])
+                    if generate_tests.is_idempotent(child) and child.attrib['opcode'] in opcode_map)
+        if next(commands(), None) is None:
+            print(f"Suite {suite} has no idempotent commands to benchmark")
+            continue
+
+        bench_files = []
+        for transport in ('mctp', 'ioctl'):
+            if suite_info[transport] is None:
+                continue
+            output_file = f"bench-{suite.lower()}-{transport}.c"
+            generate_tests.generate_if_changed(
+                output_file, commands(), suite_info, opcode_map,
+                lambda: generate_tests.generate_bench_file(output_file, commands(), suite_info, opcode_map,
+                                                           transport, iterations, warmup),
+                extra=(transport, iterations, warmup))
+            bench_files.append(output_file)
+
+        boot_vm(suite_info, suite)
+        install_tests(bench_files)
+        for output_file in bench_files:
+            output = execute_program(output_file)
+            for result in parse_results(output, 'BENCH'):
+                result['suite'] = suite
+                bench_results.append(result)
+        stop_vm()
+
+    report.write_bench_table(bench_results, f"{output_dir}/{report.BENCH_TABLE}")
+    report.write_tunnel_table(tunnel_samples(bench_results, 'p50_ns'), f"{output_dir}/{report.TUNNEL_TABLE}")
+
+
+def run_stress(suites, threads, duration, shared, mix):
+    """
+    Run every suite's stress program (see generate_stress.py) in its VM,
+    spreading the threads over all transports the suite defines.
+    """
+    stress_results = []
+    for suite in suites:
+        suite_info = SUITES[suite]
+        def commands():
+            return generate_tests.iter_commands(suite_info['input'])
+        transports = [t for t in ('mctp', 'ioctl') if suite_info[t] is not None]
+        output_file = f"stress-{suite.lower()}.c"
+        try:
+            generate_tests.generate_if_changed(
+                output_file, commands(), suite_info, opcode_map,
+                lambda: generate_stress.generate_stress_file(output_file, commands(), suite_info, opcode_map,
+                                                             transports, threads, duration, shared, mix),
+                extra=(transports, threads, duration, shared, sorted((mix or {}).items()),
+                       generate_stress.GENERATOR_HASH))
+        except ValueError as e:
+            print(f"Suite {suite}: {e}, skipping")
+            continue
+
+        boot_vm(suite_info, suite)
+        install_tests([output_file])
+        # The limit counts from the end of the run's --duration
+        output = execute_program(output_file, timeout=test_timeout and test_timeout + duration)
+        summary = parse_results(output, 'STRESS')
+        if summary:
+            stress_results.append((suite, summary[0], parse_results(output, 'STRESS_CMD')))
+        else:
+            print(f"Stress run for suite {suite} did not report results")
+        stop_vm()
+
+    report.write_stress_table(stress_results, f"{output_dir}/{report.STRESS_TABLE}")
+
+
+def run_transfer(suites, iterations, warmup, limits):
+    """
+    Run every suite's transfer benchmark (see generate_transfer.py) over each
+    transport the suite defines, sweeping the response message limit, and
+    write a table of throughput and round trips per limit and size.
+    """
+    transfer_results = []
+    for suite in suites:
+        suite_info = SUITES[suite]
+        def commands():
+            return (child for child in generate_tests.iter_commands(suite_info['input'])
+                    if generate_transfer.is_transfer(child) and child.attrib['opcode'] in opcode_map)
+        if next(commands(), None) is None:
+            print(f"Suite {suite} has no transfer commands to benchmark")
+            continue
+
+        transfer_files = []
+        for transport in ('mctp', 'ioctl'):
+            if suite_info[transport] is None:
+                continue
+            output_file = f"transfer-{suite.lower()}-{transport}.c"
+            generate_tests.generate_if_changed(
+                output_file, commands(), suite_info, opcode_map,
+                lambda: generate_transfer.generate_transfer_file(output_file, commands(), suite_info, opcode_map,
+                                                                 transport, limits, iterations, warmup),
+                extra=(transport, limits, iterations, warmup, generate_transfer.GENERATOR_HASH))
+            transfer_files.append(output_file)
+
+        boot_vm(suite_info, suite)
+        install_tests(transfer_files)
+        for output_file in transfer_files:
+            output = execute_program(output_file)
+            for result in parse_results(output, 'TRANSFER'):
+                result['suite'] = suite
+                transfer_results.append(result)
+        stop_vm()
+
+    report.write_transfer_table(transfer_results, f"{output_dir}/{report.TRANSFER_TABLE}")
+
+
+def run_scale():
+    """
+    Boot the scaled topology (topo.SCALE), set up all of its MCTP endpoints
+    and run the scale program (see generate_scale.py) once, then write the
+    discovery, open and fan-out costs to a table.
+    """
+    suite_info = topo.SCALE
+    output_file = "scale.c"
+    identify = generate_tests.find_command(suite_info['input'], generate_scale.IDENTIFY_OPCODE)
+    generate_tests.generate_if_changed(
+        output_file, [identify] if identify is not None else [], suite_info, opcode_map,
+        lambda: generate_scale.generate_scale_file(output_file, suite_info, opcode_map),
+        extra=('scale', generate_scale.expected_endpoints(suite_info), generate_scale.GENERATOR_HASH))
+
+    boot_vm(suite_info, 'SCALE')
+    nid, eid = suite_info['mctp']
+    endpoints = [f"{nid}:{eid}"] + setup_mctp_endpoints(generate_scale.mctp_addresses(suite_info)[1:])
+    install_tests([output_file])
+    output = execute_program(output_file, ' '.join(endpoints))
+    stop_vm()
+
+    if not report.write_scale_table(parse_results(output, 'SCALE'), parse_results(output, 'SCALE_EP'),
+                                    f"{output_dir}/{report.SCALE_TABLE}"):
+        print("Scale run did not report results")
+
+
+def run_sim(sessions):
+    """
+    Run the tests of each suite (suite -> opcodes, None for all of them)
+    natively on the host, linked against the real libcxlmi, with the
+    simulated device (see sim.py) answering at the transport instead of a VM.
+    """
+    libcxlmi_dir = sim.libcxlmi_dir([LIBCXLMI_DIR, guest.VARS.get('sim_libcxlmi')])
+    if libcxlmi_dir is None:
+        artifact = artifacts.latest(cache.libcxlmi_revision(LIBCXLMI_DIR), artifacts.MESON_OPTIONS)
+        libcxlmi_dir = artifact and build.extract_artifact(artifact)
+    if libcxlmi_dir is None:
+        print("ERROR: No libcxlmi build to run the simulated device against, build the checkout or set sim_libcxlmi")
+        return
+
+    for suite, session_opcodes in sessions.items():
+        suite_info = SUITES[suite]
+        def commands():
+            return (child for child in generate_tests.iter_commands(suite_info['input'])
+                    if child.attrib.get('opcode') in opcode_map)
+        if session_opcodes is None:
+            session_opcodes = [opcode for opcode in suite_opcodes(suite) if opcode in opcode_map]
+        test_files = {opcode: generate_test(opcode, suite) for opcode in session_opcodes}
+
+        sim_file = f"sim-{suite.lower()}.c"
+        sim_dir = os.path.abspath(f"{output_dir}/sim-{suite.lower()}")
+        with timing.phase('generate', suite=suite, sim=True):
+            generate_tests.generate_if_changed(
+                sim_file, commands(), suite_info, opcode_map,
+                lambda: sim.generate_sim_file(sim_file, commands(), suite_info, opcode_map),
+                extra=('sim', sim.GENERATOR_HASH))
+        with timing.phase('host_build', suite=suite, sim=True):
+            if not sim.build_shim(f"{output_dir}/{sim_file}", sim_dir, libcxlmi_dir):
+                continue
+            build.build_tests([f"{output_dir}/{test_file}" for test_file in test_files.values()], libcxlmi_dir)
+
+        for opcode, test_file in test_files.items():
+            with timing.phase('execute', opcode=opcode, sim=True):
+                rc, output = sim.run(f"{output_dir}/{test_file[:-2]}", sim_dir, libcxlmi_dir, test_timeout)
+            collect_results(opcode, test_file, output, rc, suite)
+
+
+def selected_sessions(opcodes, selected_suite=None, shard=None, durations=None):
+    """
+    Suite -> opcodes (None for all of the suite's) selected by -t or -s, or
+    every suite, for the modes that take suites as they are. With --shard,
+    only this runner's part of them.
+    """
+    if opcodes:
+        sessions = group_by_suite(opcodes)
+    else:
+        sessions = {suite: None for suite in ([selected_suite.upper()] if selected_suite else list(SUITES))}
+    if not shard:
+        return sessions
+    sessions = {suite: [opcode for opcode in suite_opcodes(suite) if opcode in opcode_map]
+                if suite_ops is None else suite_ops
+                for suite, suite_ops in sessions.items()}
+    return schedule.shard(sessions, *shard, schedule.load(durations))
+
+
+def run_all():
+    for suite in SUITES:
+        run_suite(suite)
 
 
 def clear_subdir(path):
@@ -210,32 +921,261 @@ def clear_subdir(path):
         except Exception as e:
             print(f'Failed to delete {full_path}. Reason: {e}')
 
+def clear_results(path):
+    # Remove results of the previous run but keep generated tests, binaries
+    # and the manifest so unchanged opcodes are not regenerated or rebuilt
+    for pattern in ('*-results.txt', '*.log', 'summary.txt', report.LATENCY_TABLE, report.BENCH_TABLE,
+                    report.STRESS_TABLE, report.TUNNEL_TABLE, report.TRANSFER_TABLE, report.SCALE_TABLE,
+                    history.REGRESSIONS_FILE, timing.TRACE_FILE, timing.SUMMARY_FILE, schedule.MEASURED_FILE):
+        for full_path in glob.glob(os.path.join(path, '**', pattern), recursive=True):
+            os.unlink(full_path)
+    for full_path in glob.glob(os.path.join(path, '**', profiling.PROFILE_DIR), recursive=True):
+        shutil.rmtree(full_path)
+
+def positive_int(value):
+    # argparse type for counts that size arrays or divide a total, like --iterations
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+def positive_float(value):
+    # argparse type for lengths of time, like --duration
+    number = float(value)
+    if not 0 < number < float('inf'):
+        raise argparse.ArgumentTypeError(f"must be a finite number above 0, got {value}")
+    return number
+
 def add_args(parser):
-    parser.add_argument('-t', '--test', type=str, required=False, help='opcode of the test')
+    parser.add_argument('-t', '--test', type=str, required=False,
+                        help='opcode of the test (comma-separated list runs a session)')
     parser.add_argument('-s', '--suite', type=str, required=False, help='test suite (defined in topo.py)')
+    parser.add_argument('--session', action='store_true',
+                        help='boot one VM per suite and run every selected opcode in it')
+    parser.add_argument('--snapshot', action='store_true',
+                        help='boot from a cached QEMU snapshot and restore it before every test')
+    parser.add_argument('--clean', action='store_true',
+                        help='delete everything in ./output, forcing all tests to be regenerated')
+    parser.add_argument('--host-build', action='store_true',
+                        help='compile tests on the host in parallel and copy them to the VM at once')
+    parser.add_argument('--latency', action='store_true',
+                        help='time every command call and write a latency table for the run')
+    parser.add_argument('--verify', choices=['table', 'assert'], default='table',
+                        help='check responses with one field table and compare loop (default) or one ASSERT_EQUAL per field')
+    parser.add_argument('--timeout', type=int, default=300,
+                        help='seconds a test binary may run before it is killed and reported as timed out (0: no limit)')
+    parser.add_argument('--cmd-timeout', type=int, default=30,
+                        help='seconds a single command may take before its test gives up on it (0: no limit)')
+    parser.add_argument('--backing', choices=topo.BACKINGS, default='file',
+                        help='where device memory and LSAs live: sparse files in /tmp (default), tmpfs, hugepages or anonymous RAM')
+    parser.add_argument('--topo', action='append', metavar='NAME=VALUE',
+                        help='override a topology builder parameter (e.g. devices=4, mem_size=1G) for every suite that takes it')
+    parser.add_argument('--profile', action='store_true',
+                        help='run every test binary under perf record against a debug libcxlmi and fold the stacks')
+    parser.add_argument('--tunnel', type=str, required=False,
+                        help='tunnel every command: switch-local, switch:PORT, mld:LD, switch-mld:PORT:LD or none')
+    parser.add_argument('--bench', action='store_true',
+                        help='benchmark the idempotent commands of the selected suite(s) over MCTP and ioctl')
+    parser.add_argument('--iterations', type=positive_int, default=1000, help='timed iterations per command for --bench')
+    parser.add_argument('--warmup', type=positive_int, default=10, help='untimed warm-up iterations per command for --bench')
+    parser.add_argument('--stress', action='store_true',
+                        help='run a multi-threaded stress mix of the selected suite(s)')
+    parser.add_argument('--threads', type=positive_int, default=4, help='worker threads for --stress')
+    parser.add_argument('--duration', type=positive_float, default=10, help='seconds each --stress run lasts')
+    parser.add_argument('--per-thread-ep', action='store_true',
+                        help='give every --stress thread its own context and endpoint instead of sharing one')
+    parser.add_argument('--mix', type=str, required=False,
+                        help='--stress command mix as opcode[:weight],... (default: idempotent commands)')
+    parser.add_argument('--transfer', action='store_true',
+                        help='benchmark chunked large-payload reads across response message limits over MCTP and ioctl')
+    parser.add_argument('--limits', type=str, required=False,
+                        help='--transfer response message limits as log2 of bytes, comma-separated (default: 8,9,10,11,12)')
+    parser.add_argument('--transfer-iterations', type=positive_int, default=50,
+                        help='timed transfers per limit and size for --transfer')
+    parser.add_argument('--scale', action='store_true',
+                        help='boot the scaled multi-endpoint topology and time endpoint discovery, open and Identify fan-out')
+    parser.add_argument('--sim', action='store_true',
+                        help='run the tests on the host against the real libcxlmi, with a shim answering at the MCTP '
+                             'socket and CXL ioctl from the same XML (no device or kernel driver is tested)')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='overlap test generation, builds and VM setup steps with the VM boot')
+    parser.add_argument('-j', '--jobs', type=positive_int, default=1,
+                        help='run up to N suites at once, each on its own QEMU instance')
+    parser.add_argument('--shard', type=str, required=False,
+                        help='run only shard INDEX/COUNT of the selected tests, split by past durations')
+    parser.add_argument('--durations', type=str, required=False,
+                        help='durations file used and updated by the scheduler (default: .cache/durations.json)')
+    parser.add_argument('--history', type=str, required=False,
+                        help='results database every run is appended to (default: .cache/history.sqlite)')
+    parser.add_argument('--report', action='store_true',
+                        help='only print the regression report of the last recorded run')
+    parser.add_argument('--gate', action='store_true',
+                        help='exit non-zero if the run regressed against its baseline')
+    parser.add_argument('--threshold', type=float, default=history.THRESHOLD * 100,
+                        help='percent of latency or runtime growth over the baseline that is a regression (default 20)')
+    parser.add_argument('--baseline', type=int, default=history.BASELINE_RUNS,
+                        help='previous runs whose median is the baseline (default 5)')
+    parser.add_argument('--instance', type=int, required=False, help=argparse.SUPPRESS)
+    parser.add_argument('--run-id', type=int, required=False, help=argparse.SUPPRESS)
+
+def child_args(args):
+    # Options forwarded to the child runners started by --jobs
+    forwarded = []
+    if args.snapshot:
+        forwarded.append('--snapshot')
+    if args.host_build:
+        forwarded.append('--host-build')
+    if args.latency:
+        forwarded.append('--latency')
+    if args.profile:
+        forwarded.append('--profile')
+    if args.tunnel is not None:
+        forwarded += ['--tunnel', args.tunnel]
+    if args.use_async:
+        forwarded.append('--async')
+    forwarded += ['--timeout', str(args.timeout), '--cmd-timeout', str(args.cmd_timeout),
+                  '--verify', args.verify, '--backing', args.backing]
+    for param in args.topo or []:
+        forwarded += ['--topo', param]
+    if args.history:
+        forwarded += ['--history', args.history]
+    if args.run_id is not None:
+        forwarded += ['--run-id', str(args.run_id)]
+    return forwarded
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     add_args(parser)
     args = parser.parse_args()
+    use_snapshots = args.snapshot
+    host_build = args.host_build
+    generate_tests.TIMED = args.latency
+    generate_tests.CMD_TIMEOUT = args.cmd_timeout
+    generate_tests.VERIFY = args.verify
+    test_timeout = args.timeout or None
+    profile = args.profile
+    if profile:
+        artifacts.MESON_OPTIONS += ' ' + artifacts.PROFILE_MESON_OPTIONS
+    history.THRESHOLD = args.threshold / 100
+    history.BASELINE_RUNS = args.baseline
+    if args.report:
+        sys.exit(1 if history.write_report(output_dir, path=args.history) and args.gate else 0)
+    run_start = time.monotonic()
+    try:
+        topo_params = topo.parse_params(args.topo)
+        limits = generate_transfer.parse_limits(args.limits)
+        mix = generate_stress.parse_mix(args.mix)
+        shard = schedule.parse_shard(args.shard) if args.shard else None
+        if args.tunnel is not None:
+            generate_tests.parse_tunnel(args.tunnel)
+        if shard and (args.bench or args.transfer or args.stress or args.scale):
+            raise ValueError("--shard splits the tests and cannot be used with --bench, --transfer, "
+                             "--stress or --scale, which run whole suites")
+    except ValueError as e:
+        print(f"ERROR: {e}")
+        sys.exit(1)
+    if args.tunnel is not None:
+        for suite_info in SUITES.values():
+            suite_info['tunnel'] = args.tunnel
 
-    # Set up cxl-test-tool
-    config.parse_config('./.vars.config')
+    vars_config = './.vars.config'
+    if args.instance is not None:
+        # Child runner started by --jobs: isolate everything this run touches.
+        # The parent has already cleared ./output
+        instance_id = args.instance
+        output_dir = instance.output_dir(instance_id)
+        qmp_port = snapshot.QMP_PORT + instance_id
+        generate_tests.OUTPUT_DIR = output_dir
+        vars_config = instance.setup(instance_id, vars_config, args.backing)
+        timing.set_track(instance_id + 1, f"instance-{instance_id}")
+        topo_params['prefix'] = instance.backing_prefix(instance_id)
+    elif args.clean:
+        # Clear output dir from prev. run
+        clear_subdir('./output')
+    else:
+        clear_results('./output')
+    if instance_id is None:
+        timing.set_track(0, "runner")
+    topo.rebuild(backing=args.backing, **topo_params)
 
-    # Clear output dir from prev. run
-    clear_subdir('./output')
+    # Set up cxl-test-tool
+    config.parse_config(vars_config)
+    guest.load_config(vars_config)
 
-    # Parse opcode map
-    opcode_map = generate_default_opcode_map()
-    print_opcode_map(opcode_map)
+    # Parse opcode map. Without -t, --async parses it while the first VM boots
+    opcodes = args.test.split(',') if args.test else []
+    if opcodes or not args.use_async or args.jobs > 1 or shard:
+        with timing.phase('parse_docs'):
+            opcode_map = generate_default_opcode_map()
+        print_opcode_map(opcode_map, f'{output_dir}/opcode_map.txt')
 
     QEMU_IMG=tools.system_path("QEMU_IMG")
     KERNEL_IMG=tools.system_path("KERNEL_IMG")
     CXL_TEST_TOOL_DIR=tools.system_path("cxl_test_tool_dir")
+    if instance_id is not None:
+        QEMU_IMG = instance.overlay_image(QEMU_IMG, instance_id)
+    else:
+        # Children started by --jobs record under their parent's run
+        kind = 'sim' if args.sim else 'bench' if args.bench else 'stress' if args.stress else \
+            'transfer' if args.transfer else 'scale' if args.scale else 'qemu'
+        mode = history.run_mode(kind, args.profile, args.tunnel, args.snapshot, args.use_async)
+        args.run_id = history.start_run(mode, cache.libcxlmi_revision(LIBCXLMI_DIR),
+                                        history.qemu_revision(guest.VARS),
+                                        history.kernel_revision(guest.VARS, KERNEL_IMG),
+                                        ' '.join(sys.argv[1:]), args.history)
 
-    if args.test:
+    if args.sim:
+        run_sim(selected_sessions(opcodes, args.suite, shard, args.durations))
+    elif args.bench:
+        run_bench([args.suite.upper()] if args.suite else list(SUITES), args.iterations, args.warmup)
+    elif args.transfer:
+        run_transfer([args.suite.upper()] if args.suite else list(SUITES), args.transfer_iterations,
+                     args.warmup, limits)
+    elif args.scale:
+        run_scale()
+    elif args.stress:
+        run_stress([args.suite.upper()] if args.suite else list(SUITES), args.threads, args.duration,
+                   not args.per_thread_ep, mix)
+    elif args.use_async and args.jobs <= 1:
+        asyncio.run(run_async(selected_sessions(opcodes, args.suite, shard, args.durations)))
+    elif args.jobs > 1 or args.session or args.shard or len(opcodes) > 1:
+        if args.suite and SUITES[args.suite.upper()].get('variant_of'):
+            print(f"ERROR: {args.suite.upper()} runs the commands of {SUITES[args.suite.upper()]['variant_of']} "
+                  "tunneled and can only be run by suite (-s without --session, --jobs or --shard)")
+            sys.exit(1)
+        if not opcodes:
+            suites = [args.suite.upper()] if args.suite else direct_suites()
+            opcodes = [op for suite in suites for op in suite_opcodes(suite)]
+        if shard:
+            sessions = schedule.shard(group_by_suite(opcodes), *shard, schedule.load(args.durations))
+            opcodes = [opcode for suite_opcodes in sessions.values() for opcode in suite_opcodes]
+        if args.jobs > 1:
+            run_parallel(opcodes, args.jobs, child_args(args), schedule.load(args.durations))
+        else:
+            run_session(opcodes)
+    elif args.test:
         run_test(args.test)
     elif args.suite:
         run_suite(args.suite)
     else:
-        run_all()
\ No newline at end of file
+        run_all()
+
+    if generate_tests.TIMED:
+        report.write_latency_table(run_results, f'{output_dir}/{report.LATENCY_TABLE}')
+        report.write_tunnel_table(tunnel_samples(run_results, 'ns'), f'{output_dir}/{report.TUNNEL_TABLE}')
+    timing.write(output_dir, instance_events)
+    if args.run_id is not None:
+        history.record(args.run_id, run_results, timing.events(), args.history)
+
+    # Children leave their measured durations for the parent to fold in.
+    # A shard leaves them in its output too instead of updating the
+    # durations file: every shard must split with the same durations, and
+    # one that finishes first would change them for those that start later
+    if instance_id is not None:
+        schedule.save_measured(f'{output_dir}/{schedule.MEASURED_FILE}')
+    else:
+        schedule.update(sorted(glob.glob(f'./output/instance-*/{schedule.MEASURED_FILE}')),
+                        f'{output_dir}/{schedule.MEASURED_FILE}' if shard else args.durations)
+        history.finish_run(args.run_id, time.monotonic() - run_start, args.history)
+        if history.write_report(output_dir, args.run_id, args.history) and args.gate:
+            sys.exit(1)
@@ -0,0 +1,127 @@
+"""
+Duration-aware scheduling of tests onto VM slots. The measured run time of
+every opcode and the VM overhead (boot, setup and shutdown) of every suite
+are kept across runs. Tests are packed longest first onto the slot where
+they would finish earliest, counting a suite's VM overhead once for each
+slot that runs any of its tests. The same packing splits a selection into
+CI shards: with the same durations file, every runner computes the same
+split and runs only its own part. The packing only depends on the
+durations, the selection and the shard count (ties are broken by suite and
+opcode), so runners agree as long as they read identical durations. Shards
+therefore never update the file; each leaves what it measured in its
+output/durations.json, to be folded in once all shards are done:
+
+    python schedule.py .cache/durations.json shard-*/durations.json
+
+Without a durations file every test gets the same estimate and the split
+falls back to a stable order.
+"""
+import os
+import sys
+import json
+import cache
+
+DURATIONS = 'durations.json'
+# Durations measured by one runner, for its parent (or, for a shard, CI) to
+# merge (see update())
+MEASURED_FILE = 'durations.json'
+
+# Estimates for opcodes and suites that have not been measured yet
+DEFAULT_TEST_S = 30.0
+DEFAULT_SUITE_S = 120.0
+# Weight of the newest measurement in the stored average
+SMOOTHING = 0.5
+
+_measured = {'opcode': {}, 'suite': {}}
+
+def record(kind, name, seconds):
+    # kind is 'opcode' (one test) or 'suite' (VM overhead of a suite session)
+    _measured[kind][name] = seconds
+
+def durations_path(path=None):
+    return path or cache.cache_path(DURATIONS)
+
+def load(path=None):
+    path = durations_path(path)
+    if not os.path.exists(path):
+        return {'opcode': {}, 'suite': {}}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def save_measured(path):
+    with open(path, 'w') as f:
+        json.dump(_measured, f, indent=2, sort_keys=True)
+
+def update(measured_files=(), path=None):
+    # Fold this run's measurements, and those of its child runners, into the durations file
+    durations = load(path)
+    runs = [_measured]
+    for measured_file in measured_files:
+        with open(measured_file, 'r') as f:
+            runs.append(json.load(f))
+    for run in runs:
+        for kind, measured in run.items():
+            stored = durations.setdefault(kind, {})
+            for name, seconds in measured.items():
+                old = stored.get(name)
+                stored[name] = seconds if old is None else SMOOTHING * seconds + (1 - SMOOTHING) * old
+    path = durations_path(path)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(durations, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+def estimate_test(durations, opcode):
+    return durations['opcode'].get(opcode, DEFAULT_TEST_S)
+
+def estimate_suite(durations, suite):
+    return durations['suite'].get(suite, DEFAULT_SUITE_S)
+
+def pack(sessions, slots, durations):
+    """
+    Pack the tests of sessions (suite -> opcodes) onto `slots` VM slots.
+    Returns one suite -> opcodes map per slot (some may be empty, opcodes
+    keep their order within a suite) and each slot's estimated run time.
+    Ties are broken by suite and opcode, so the result only depends on the
+    arguments.
+    """
+    tests = sorted(((estimate_test(durations, opcode), suite, opcode)
+                    for suite, opcodes in sessions.items() for opcode in opcodes),
+                   key=lambda test: (-test[0], test[1], test[2]))
+    loads = [0.0] * slots
+    assigned = [{} for _ in range(slots)]
+
+    for seconds, suite, opcode in tests:
+        def finish(slot):
+            overhead = 0 if suite in assigned[slot] else estimate_suite(durations, suite)
+            return loads[slot] + overhead + seconds
+        slot = min(range(slots), key=lambda slot: (finish(slot), slot))
+        loads[slot] = finish(slot)
+        assigned[slot].setdefault(suite, []).append(opcode)
+
+    for slot_sessions in assigned:
+        for suite, opcodes in slot_sessions.items():
+            order = sessions[suite]
+            opcodes.sort(key=order.index)
+    return assigned, loads
+
+def parse_shard(shard):
+    # "I/N": the I-th (from 0) of N shards
+    try:
+        index, count = (int(part) for part in shard.split('/'))
+    except ValueError:
+        raise ValueError(f"Invalid shard {shard}, expected INDEX/COUNT") from None
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Invalid shard {shard}, INDEX must be in [0, COUNT)")
+    return index, count
+
+def shard(sessions, index, count, durations):
+    assigned, loads = pack(sessions, count, durations)
+    print(f"Shard {index}/{count}: estimated {loads[index]:.0f}s "
+          f"(all shards: {', '.join(f'{load:.0f}s' for load in loads)})")
+    return assigned[index]
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: python schedule.py <durations file> <measured durations file>...")
+        sys.exit(1)
+    update(sys.argv[2:], sys.argv[1])
@@ -0,0 +1,619 @@
+"""
+Host-only simulated device. The generated tests are linked against the real
+libcxlmi and run natively on the host, with a generated LD_PRELOAD shim
+standing in for the device at the transport: AF_MCTP sockets and the CXL
+mailbox ioctl() of /dev/cxl/* devices. The shim decodes each CCI message
+libcxlmi sends (unwrapping Tunnel Management commands), checks the request
+payload field by field against the suite's XML and answers with the XML's
+canned response, packed with the same libcxlmi structs the tests use.
+
+So a passing run shows that the tests compile against the real headers and
+build their requests as the XML says, and that libcxlmi marshals those
+requests onto the wire and unmarshals the responses back. It says nothing
+about the device or the kernel's MCTP and CXL drivers, and as the answers
+and the expected values come from the same XML, a wrong expected value in
+the XML still passes. The full QEMU path is needed for that.
+
+The shim and the tests are built against a libcxlmi tree with a host build
+(build/src/libcxlmi.so): the checkout, sim_libcxlmi in .vars.config or a
+cached libcxlmi build.
+"""
+import os
+import glob
+import textwrap
+import subprocess
+import cache
+import generate_tests
+from generate_tests import generate_struct_body, array_sizes, response_size
+
+# Part of the sim file's manifest hash, so editing sim.py regenerates it
+GENERATOR_HASH = cache.hash_file(__file__)
+
+SHIM = "libcxlmi-sim.so"
+
+SIM_PREFIX = """#define _GNU_SOURCE
+#include <dlfcn.h>
+#include <endian.h>
+#include <errno.h>
+#include <fcntl.h>
+#include <stdarg.h>
+#include <stddef.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+#include <sys/ioctl.h>
+#include <sys/socket.h>
+#include <sys/uio.h>
+#include <linux/netdevice.h>
+#include <linux/sockios.h>
+#include <linux/mctp.h>
+#include <linux/cxl_mem.h>
+#include <libcxlmi.h>
+
+/* Generated by sim.py: transport shim answering from {input} */
+
+#ifndef AF_MCTP
+#define AF_MCTP 45
+#endif
+#ifndef MAX_SIZE
+#define MAX_SIZE(a, b) ((a) > (b) ? (a) : (b))
+#endif
+#ifndef ARRAY_SIZE
+#define ARRAY_SIZE(a) (sizeof(a) / sizeof((a)[0]))
+#endif
+
+/* CCI return codes (CXL r3.1 Table 8-34) */
+#define SIM_RC_SUCCESS 0x0000
+#define SIM_RC_INVALID_INPUT 0x0002
+#define SIM_RC_UNSUPPORTED 0x0015
+#define SIM_TUNNEL_OPCODE 0x5300
+
+/* Largest CCI message: header, 1 MiB payload and two tunnel headers */
+#define SIM_MAX_MSG ((1 << 20) + 64)
+
+/* memcmp so array fields (e.g. feature IDs) work like scalars */
+#define SIM_CHECK(canned, in, field) \\
+    if (memcmp(&(canned).field, &(in)->field, sizeof((in)->field))) { \\
+        fprintf(stdout, "sim: %s: request field %s does not match the XML\\n", \\
+                sim_func, #field); \\
+        rc = -1; \\
+    }
+
+/* CCI message as on the wire (CXL r3.1 Figure 7-19) */
+struct sim_cci_msg {
+	uint8_t category;
+	uint8_t tag;
+	uint8_t rsvd;
+	uint8_t command;
+	uint8_t command_set;
+	uint8_t pl_length[3];
+	uint16_t return_code;
+	uint16_t vendor_ext_status;
+	uint8_t payload[];
+} __attribute__((packed));
+
+/* Checks a request payload and writes the response payload and its size */
+typedef uint16_t (*sim_fn)(const uint8_t *req, size_t req_len, uint8_t *rsp, size_t cap,
+			   size_t *rsp_len);
+
+struct sim_cmd {
+	uint16_t opcode;
+	sim_fn fn;
+};
+"""
+
+SIM_ENGINE = """
+/* Answer one CCI request, and those tunneled in it. Returns the response size */
+static size_t sim_answer(const uint8_t *msg, size_t len, uint8_t *out, size_t cap)
+{
+	const struct sim_cci_msg *req = (const void *)msg;
+	struct sim_cci_msg *rsp = (void *)out;
+	uint16_t opcode, rc = SIM_RC_UNSUPPORTED;
+	size_t req_len, rsp_len = 0, i;
+
+	if (len < sizeof(*req) || cap < sizeof(*rsp) + 4)
+		return 0;
+	cap -= sizeof(*rsp);
+	opcode = req->command_set << 8 | req->command;
+	req_len = req->pl_length[0] | req->pl_length[1] << 8 | (req->pl_length[2] & 0xf) << 16;
+
+	if (req_len != len - sizeof(*req)) {
+		fprintf(stdout, "sim: %04x: payload length %zu does not match the %zu bytes sent\\n",
+			opcode, req_len, len - sizeof(*req));
+		rc = SIM_RC_INVALID_INPUT;
+	} else if (opcode == SIM_TUNNEL_OPCODE) {
+		/* Port or LD ID, target type, command size, then the tunneled message */
+		size_t inner_len = req_len >= 4 ? (size_t)(req->payload[2] | req->payload[3] << 8) : 0;
+		size_t n = inner_len && inner_len <= req_len - 4 ?
+			sim_answer(req->payload + 4, inner_len, rsp->payload + 4, cap - 4) : 0;
+
+		if (n == 0) {
+			fprintf(stdout, "sim: %04x: malformed tunneled message\\n", opcode);
+			rc = SIM_RC_INVALID_INPUT;
+		} else {
+			rsp->payload[0] = n & 0xff;
+			rsp->payload[1] = n >> 8;
+			rsp->payload[2] = rsp->payload[3] = 0;
+			rsp_len = n + 4;
+			rc = SIM_RC_SUCCESS;
+		}
+	} else {
+		for (i = 0; i < ARRAY_SIZE(sim_cmds); i++)
+			if (sim_cmds[i].opcode == opcode)
+				break;
+		if (i < ARRAY_SIZE(sim_cmds))
+			rc = sim_cmds[i].fn(req->payload, req_len, rsp->payload, cap, &rsp_len);
+		else
+			fprintf(stdout, "sim: %04x: not in the XML, answering Unsupported\\n", opcode);
+	}
+
+	rsp->category = 1; /* response */
+	rsp->tag = req->tag;
+	rsp->rsvd = 0;
+	rsp->command = req->command;
+	rsp->command_set = req->command_set;
+	rsp->pl_length[0] = rsp_len & 0xff;
+	rsp->pl_length[1] = (rsp_len >> 8) & 0xff;
+	rsp->pl_length[2] = (rsp_len >> 16) & 0xf;
+	rsp->return_code = htole16(rc);
+	rsp->vendor_ext_status = 0;
+	return sizeof(*rsp) + rsp_len;
+}
+
+/*
+ * Descriptors handed out for AF_MCTP sockets are one end of an AF_UNIX
+ * datagram pair, so poll() and blocking reads work on them as they are. The
+ * shim queues each response on the other end, behind the sockaddr_mctp it
+ * came from. /dev/cxl/ devices are /dev/null with their ioctl()s answered
+ */
+#define SIM_MAX_FDS 1024
+enum { SIM_NONE, SIM_MCTP, SIM_MEMDEV };
+static int sim_kind[SIM_MAX_FDS];
+static int sim_peer[SIM_MAX_FDS];
+
+#define SIM_REAL(name) \\
+	static __typeof__(name) *real_##name; \\
+	if (!real_##name) \\
+		real_##name = (__typeof__(name) *)dlsym(RTLD_NEXT, #name)
+
+static int sim_is(int fd, int kind)
+{
+	return fd >= 0 && fd < SIM_MAX_FDS && sim_kind[fd] == kind;
+}
+
+static int sim_track(int fd, int kind, int peer)
+{
+	if (fd >= SIM_MAX_FDS) {
+		fprintf(stdout, "sim: descriptor %d is past the shim's table\\n", fd);
+		close(fd);
+		if (peer >= 0)
+			close(peer);
+		errno = EMFILE;
+		return -1;
+	}
+	if (fd >= 0) {
+		sim_kind[fd] = kind;
+		sim_peer[fd] = peer;
+	}
+	return fd;
+}
+
+int socket(int domain, int type, int protocol)
+{
+	int sv[2];
+
+	SIM_REAL(socket);
+	if (domain != AF_MCTP)
+		return real_socket(domain, type, protocol);
+	if (socketpair(AF_UNIX, SOCK_DGRAM | (type & (SOCK_NONBLOCK | SOCK_CLOEXEC)), 0, sv) != 0)
+		return -1;
+	return sim_track(sv[0], SIM_MCTP, sv[1]);
+}
+
+int setsockopt(int fd, int level, int name, const void *value, socklen_t len)
+{
+	SIM_REAL(setsockopt);
+	if (sim_is(fd, SIM_MCTP))
+		return 0;
+	return real_setsockopt(fd, level, name, value, len);
+}
+
+static ssize_t sim_mctp_send(int fd, const uint8_t *msg, size_t len, const void *addr, socklen_t addrlen)
+{
+	const struct sockaddr_mctp *dst = addr;
+	struct sockaddr_mctp src;
+	uint8_t *out;
+	size_t n;
+
+	if (!dst || addrlen < sizeof(*dst) || dst->smctp_family != AF_MCTP) {
+		errno = EDESTADDRREQ;
+		return -1;
+	}
+	/* The response comes from the endpoint with our tag, TO bit cleared */
+	memset(&src, 0, sizeof(src));
+	src.smctp_family = AF_MCTP;
+	src.smctp_network = dst->smctp_network;
+	src.smctp_addr = dst->smctp_addr;
+	src.smctp_type = dst->smctp_type;
+	src.smctp_tag = dst->smctp_tag & MCTP_TAG_MASK;
+
+	out = malloc(sizeof(src) + SIM_MAX_MSG);
+	if (!out)
+		return -1;
+	memcpy(out, &src, sizeof(src));
+	n = sim_answer(msg, len, out + sizeof(src), SIM_MAX_MSG);
+	if (n > 0 && send(sim_peer[fd], out, sizeof(src) + n, 0) < 0) {
+		free(out);
+		return -1;
+	}
+	free(out);
+	return len;
+}
+
+ssize_t sendto(int fd, const void *buf, size_t len, int flags, const struct sockaddr *addr, socklen_t addrlen)
+{
+	SIM_REAL(sendto);
+	if (!sim_is(fd, SIM_MCTP))
+		return real_sendto(fd, buf, len, flags, addr, addrlen);
+	return sim_mctp_send(fd, buf, len, addr, addrlen);
+}
+
+ssize_t sendmsg(int fd, const struct msghdr *msg, int flags)
+{
+	uint8_t *buf;
+	size_t len = 0, i;
+	ssize_t rc;
+
+	SIM_REAL(sendmsg);
+	if (!sim_is(fd, SIM_MCTP))
+		return real_sendmsg(fd, msg, flags);
+	buf = malloc(SIM_MAX_MSG);
+	if (!buf)
+		return -1;
+	for (i = 0; i < msg->msg_iovlen; i++) {
+		size_t n = msg->msg_iov[i].iov_len;
+
+		if (n > SIM_MAX_MSG - len)
+			n = SIM_MAX_MSG - len;
+		memcpy(buf + len, msg->msg_iov[i].iov_base, n);
+		len += n;
+	}
+	rc = sim_mctp_send(fd, buf, len, msg->msg_name, msg->msg_namelen);
+	free(buf);
+	return rc;
+}
+
+static ssize_t sim_mctp_recv(int fd, struct msghdr *msg, int flags)
+{
+	struct sockaddr_mctp src;
+	uint8_t *buf = malloc(sizeof(src) + SIM_MAX_MSG);
+	size_t copied = 0, i;
+	ssize_t n;
+
+	SIM_REAL(recv);
+	if (!buf)
+		return -1;
+	n = real_recv(fd, buf, sizeof(src) + SIM_MAX_MSG, flags & (MSG_PEEK | MSG_DONTWAIT));
+	if (n < (ssize_t)sizeof(src)) {
+		free(buf);
+		return n < 0 ? -1 : 0;
+	}
+	memcpy(&src, buf, sizeof(src));
+	n -= sizeof(src);
+	if (msg->msg_name) {
+		memcpy(msg->msg_name, &src, msg->msg_namelen < sizeof(src) ? msg->msg_namelen : sizeof(src));
+		msg->msg_namelen = sizeof(src);
+	}
+	for (i = 0; i < msg->msg_iovlen && copied < (size_t)n; i++) {
+		size_t len = msg->msg_iov[i].iov_len;
+
+		if (len > n - copied)
+			len = n - copied;
+		memcpy(msg->msg_iov[i].iov_base, buf + sizeof(src) + copied, len);
+		copied += len;
+	}
+	msg->msg_flags = copied < (size_t)n ? MSG_TRUNC : 0;
+	free(buf);
+	/* Like AF_MCTP, MSG_TRUNC returns the full message length */
+	return (flags & MSG_TRUNC) ? n : (ssize_t)copied;
+}
+
+ssize_t recvmsg(int fd, struct msghdr *msg, int flags)
+{
+	SIM_REAL(recvmsg);
+	if (!sim_is(fd, SIM_MCTP))
+		return real_recvmsg(fd, msg, flags);
+	return sim_mctp_recv(fd, msg, flags);
+}
+
+ssize_t recv(int fd, void *buf, size_t len, int flags)
+{
+	struct iovec iov = { .iov_base = buf, .iov_len = len };
+	struct msghdr msg = { .msg_iov = &iov, .msg_iovlen = 1 };
+
+	SIM_REAL(recv);
+	if (!sim_is(fd, SIM_MCTP))
+		return real_recv(fd, buf, len, flags);
+	return sim_mctp_recv(fd, &msg, flags);
+}
+
+ssize_t recvfrom(int fd, void *buf, size_t len, int flags, struct sockaddr *addr, socklen_t *addrlen)
+{
+	struct iovec iov = { .iov_base = buf, .iov_len = len };
+	struct msghdr msg = { .msg_name = addr, .msg_namelen = addrlen ? *addrlen : 0,
+			      .msg_iov = &iov, .msg_iovlen = 1 };
+	ssize_t n;
+
+	SIM_REAL(recvfrom);
+	if (!sim_is(fd, SIM_MCTP))
+		return real_recvfrom(fd, buf, len, flags, addr, addrlen);
+	n = sim_mctp_recv(fd, &msg, flags);
+	if (addrlen)
+		*addrlen = msg.msg_namelen;
+	return n;
+}
+
+/* Opcodes of the kernel's named mailbox commands, for non-RAW ioctls */
+static const uint16_t sim_memdev_opcodes[CXL_MEM_COMMAND_ID_MAX] = {
+	[CXL_MEM_COMMAND_ID_IDENTIFY] = 0x4000,
+	[CXL_MEM_COMMAND_ID_GET_SUPPORTED_LOGS] = 0x0400,
+	[CXL_MEM_COMMAND_ID_GET_FW_INFO] = 0x0200,
+	[CXL_MEM_COMMAND_ID_GET_PARTITION_INFO] = 0x4100,
+	[CXL_MEM_COMMAND_ID_GET_LSA] = 0x4102,
+	[CXL_MEM_COMMAND_ID_GET_HEALTH_INFO] = 0x4200,
+	[CXL_MEM_COMMAND_ID_GET_LOG] = 0x0401,
+	[CXL_MEM_COMMAND_ID_SET_PARTITION_INFO] = 0x4101,
+	[CXL_MEM_COMMAND_ID_SET_LSA] = 0x4103,
+	[CXL_MEM_COMMAND_ID_GET_ALERT_CONFIG] = 0x4201,
+	[CXL_MEM_COMMAND_ID_SET_ALERT_CONFIG] = 0x4202,
+	[CXL_MEM_COMMAND_ID_GET_SHUTDOWN_STATE] = 0x4203,
+	[CXL_MEM_COMMAND_ID_SET_SHUTDOWN_STATE] = 0x4204,
+	[CXL_MEM_COMMAND_ID_GET_POISON] = 0x4300,
+	[CXL_MEM_COMMAND_ID_INJECT_POISON] = 0x4301,
+	[CXL_MEM_COMMAND_ID_CLEAR_POISON] = 0x4302,
+	[CXL_MEM_COMMAND_ID_GET_SCAN_MEDIA_CAPS] = 0x4303,
+	[CXL_MEM_COMMAND_ID_SCAN_MEDIA] = 0x4304,
+	[CXL_MEM_COMMAND_ID_GET_SCAN_MEDIA] = 0x4305,
+};
+
+static int sim_memdev_ioctl(unsigned long request, void *arg)
+{
+	if (request == CXL_MEM_QUERY_COMMANDS) {
+		/* Every command the kernel knows is enabled */
+		struct cxl_mem_query_commands *query = arg;
+		uint32_t count = CXL_MEM_COMMAND_ID_MAX - 1, i;
+
+		for (i = 0; i < query->n_commands && i < count; i++) {
+			memset(&query->commands[i], 0, sizeof(query->commands[i]));
+			query->commands[i].id = i + 1;
+			query->commands[i].size_in = ~0U;
+			query->commands[i].size_out = ~0U;
+		}
+		query->n_commands = count;
+		return 0;
+	}
+	if (request == CXL_MEM_SEND_COMMAND) {
+		struct cxl_send_command *cmd = arg;
+		uint16_t opcode = cmd->id == CXL_MEM_COMMAND_ID_RAW ? cmd->raw.opcode :
+			cmd->id < CXL_MEM_COMMAND_ID_MAX ? sim_memdev_opcodes[cmd->id] : 0;
+		struct sim_cci_msg *req, *rsp;
+		size_t rsp_len;
+
+		if (opcode == 0 || cmd->in.size > SIM_MAX_MSG - sizeof(*req)) {
+			errno = EINVAL;
+			return -1;
+		}
+		/* Wrap the payload as a CCI message so both transports share sim_answer() */
+		req = calloc(1, sizeof(*req) + cmd->in.size);
+		rsp = malloc(SIM_MAX_MSG);
+		if (!req || !rsp) {
+			free(req);
+			free(rsp);
+			return -1;
+		}
+		req->command = opcode & 0xff;
+		req->command_set = opcode >> 8;
+		req->pl_length[0] = cmd->in.size & 0xff;
+		req->pl_length[1] = (cmd->in.size >> 8) & 0xff;
+		req->pl_length[2] = (cmd->in.size >> 16) & 0xf;
+		if (cmd->in.size)
+			memcpy(req->payload, (void *)(uintptr_t)cmd->in.payload, cmd->in.size);
+		rsp_len = sim_answer((uint8_t *)req, sizeof(*req) + cmd->in.size, (uint8_t *)rsp, SIM_MAX_MSG)
+			- sizeof(*rsp);
+		cmd->retval = le16toh(rsp->return_code);
+		if (rsp_len > cmd->out.size)
+			rsp_len = cmd->out.size;
+		if (rsp_len)
+			memcpy((void *)(uintptr_t)cmd->out.payload, rsp->payload, rsp_len);
+		cmd->out.size = rsp_len;
+		free(req);
+		free(rsp);
+		return 0;
+	}
+	errno = ENOTTY;
+	return -1;
+}
+
+int ioctl(int fd, unsigned long request, ...)
+{
+	va_list ap;
+	void *arg;
+
+	va_start(ap, request);
+	arg = va_arg(ap, void *);
+	va_end(ap);
+
+	SIM_REAL(ioctl);
+#ifdef SIOCMCTPALLOCTAG
+	if (sim_is(fd, SIM_MCTP) && (request == SIOCMCTPALLOCTAG || request == SIOCMCTPDROPTAG)) {
+		struct mctp_ioc_tag_ctl *ctl = arg;
+
+		if (request == SIOCMCTPALLOCTAG)
+			ctl->tag = MCTP_TAG_OWNER | MCTP_TAG_PREALLOC;
+		return 0;
+	}
+#endif
+	if (sim_is(fd, SIM_MEMDEV))
+		return sim_memdev_ioctl(request, arg);
+	return real_ioctl(fd, request, arg);
+}
+
+static int sim_memdev_path(const char *path)
+{
+	return path && strncmp(path, "/dev/cxl/", strlen("/dev/cxl/")) == 0;
+}
+
+int open(const char *path, int flags, ...)
+{
+	mode_t mode = 0;
+	va_list ap;
+
+	va_start(ap, flags);
+	if (flags & (O_CREAT | O_TMPFILE))
+		mode = va_arg(ap, mode_t);
+	va_end(ap);
+
+	SIM_REAL(open);
+	if (sim_memdev_path(path))
+		return sim_track(real_open("/dev/null", O_RDWR | O_CLOEXEC), SIM_MEMDEV, -1);
+	return real_open(path, flags, mode);
+}
+
+int open64(const char *path, int flags, ...)
+{
+	mode_t mode = 0;
+	va_list ap;
+
+	va_start(ap, flags);
+	if (flags & (O_CREAT | O_TMPFILE))
+		mode = va_arg(ap, mode_t);
+	va_end(ap);
+
+	SIM_REAL(open64);
+	if (sim_memdev_path(path))
+		return sim_track(real_open64("/dev/null", O_RDWR | O_CLOEXEC), SIM_MEMDEV, -1);
+	return real_open64(path, flags, mode);
+}
+
+int close(int fd)
+{
+	SIM_REAL(close);
+	if (sim_is(fd, SIM_MCTP))
+		real_close(sim_peer[fd]);
+	if (fd >= 0 && fd < SIM_MAX_FDS)
+		sim_kind[fd] = SIM_NONE;
+	return real_close(fd);
+}
+"""
+
+def struct_size(element, struct_name):
+    # C constant expression for the bytes the XML initializes: the struct and
+    # every array of structs it lists (see generate_tests.array_sizes())
+    size = f"sizeof({struct_name})"
+    for term in array_sizes(element, struct_name):
+        size = f"MAX_SIZE({size}, {term})"
+    return size
+
+def generate_sim_cmd(n, command, mapping):
+    # Check one command's request payload and answer with its canned response
+    request = command.find("request")
+    response = command.find("response")
+    func = mapping['function']
+
+    canned, body = f'    static const char sim_func[] = "{func}";\n', ""
+    if request is not None and mapping['req']:
+        req_body, checks = generate_struct_body(request, 1, "canned_req", "in", "SIM_CHECK")
+        canned += (f"    static const {mapping['req']} canned_req = {req_body};\n"
+                   f"    const {mapping['req']} *in = (const void *)req;\n")
+        body += f"""
+    if (req_len < sizeof(canned_req)) {{
+        fprintf(stdout, "sim: %s: request is %zu bytes, expected %zu\\n", sim_func, req_len, sizeof(canned_req));
+        return SIM_RC_INVALID_INPUT;
+    }}
+{textwrap.indent(textwrap.dedent(checks), "    ")}\
+    if (rc != 0)
+        return SIM_RC_INVALID_INPUT;
+"""
+    if response is not None and mapping['rsp']:
+        rsp_body, _ = generate_struct_body(response, 1, "canned_rsp", "ret", "SIM_CHECK")
+        canned += f"    static const {mapping['rsp']} canned_rsp = {rsp_body};\n"
+        # Bytes past what the XML initializes (e.g. payload="count") are zero
+        body += f"""
+    *rsp_len = {response_size(command, mapping)};
+    if (*rsp_len > cap) {{
+        fprintf(stdout, "sim: %s: response of %zu bytes does not fit\\n", sim_func, *rsp_len);
+        *rsp_len = 0;
+        return SIM_RC_INVALID_INPUT;
+    }}
+    memset(rsp, 0, *rsp_len);
+    memcpy(rsp, &canned_rsp, {struct_size(response, mapping['rsp'])});
+"""
+
+    return f"""
+/* {command.attrib['opcode']}h {func} */
+static uint16_t sim_cmd_{n}(const uint8_t *req, size_t req_len, uint8_t *rsp, size_t cap, size_t *rsp_len)
+{{
+{canned}\
+    int rc = 0;
+{body}\
+    return rc == 0 ? SIM_RC_SUCCESS : SIM_RC_INVALID_INPUT;
+}}
+"""
+
+def generate_sim_file(output_name, commands, suite_info, opcode_map):
+    # Write the transport shim for the given commands to OUTPUT_DIR
+    functions = {}
+    for command in commands:
+        opcode = command.attrib.get('opcode')
+        if opcode not in opcode_map:
+            continue
+        if opcode in functions:
+            print(f"WARN: sim answers {opcode} with its first entry in {suite_info['input']}")
+            continue
+        functions[opcode] = generate_sim_cmd(len(functions) + 1, command, opcode_map[opcode])
+
+    with open(f"{generate_tests.OUTPUT_DIR}/{output_name}", 'w') as f:
+        f.write(SIM_PREFIX.replace('{input}', suite_info['input']))
+        f.writelines(functions.values())
+        f.write("\nstatic const struct sim_cmd sim_cmds[] = {\n")
+        f.writelines(f"\t{{ 0x{opcode}, sim_cmd_{n} }},\n" for n, opcode in enumerate(functions, 1))
+        f.write("};\n")
+        f.write(SIM_ENGINE)
+
+def libcxlmi_dir(candidates):
+    # First candidate that is a libcxlmi tree with a build (headers under
+    # src/, libcxlmi.so under build/src/)
+    for path in candidates:
+        if (path and os.path.exists(os.path.join(path, 'src', 'libcxlmi.h'))
+                and glob.glob(os.path.join(path, 'build', 'src', 'libcxlmi.so*'))):
+            return os.path.abspath(path)
+    return None
+
+def build_shim(c_file, sim_dir, libcxlmi, cc='gcc'):
+    os.makedirs(sim_dir, exist_ok=True)
+    cmd = [cc, '-shared', '-fPIC', c_file, f'-I{libcxlmi}/src', f'-I{libcxlmi}',
+           '-ldl', '-o', os.path.join(sim_dir, SHIM)]
+    proc = subprocess.run(cmd, capture_output=True, text=True)
+    if proc.returncode != 0:
+        print(f"ERROR: Failed to compile {c_file}:\n{proc.stderr}")
+        return False
+    return True
+
+def run(binary, sim_dir, libcxlmi, timeout=60):
+    # Run a test binary natively against the real libcxlmi and the shim.
+    # Returns its exit code (None if it timed out) and output
+    if not os.path.exists(binary):
+        return 1, f"sim: {binary} was not built\n"
+    env = dict(os.environ, LD_LIBRARY_PATH=os.path.join(libcxlmi, 'build', 'src'),
+               LD_PRELOAD=os.path.join(sim_dir, SHIM))
+    try:
+        proc = subprocess.run([binary], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              text=True, env=env, timeout=timeout)
+    except subprocess.TimeoutExpired as e:
+        output = e.stdout or ''
+        if isinstance(output, bytes):
+            output = output.decode(errors='replace')
+        return None, output + f"\nsim: {binary} timed out\n"
+    return proc.returncode, proc.stdout
@@ -0,0 +1,112 @@
+import json
+import socket
+import time
+import cache
+
+# QMP socket added to every QEMU command line in snapshot mode so the runner
+# can drive savevm/loadvm itself
+QMP_HOST = '127.0.0.1'
+QMP_PORT = 4445
+SNAPSHOT_STATE = 'snapshots.json'
+
+class QMP:
+    """
+    Minimal QMP client: connects, negotiates capabilities and runs HMP
+    commands through human-monitor-command.
+    """
+    def __init__(self, port=QMP_PORT, host=QMP_HOST, timeout=30):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.sock = socket.create_connection((host, port), timeout=timeout)
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.5)
+        self.file = self.sock.makefile('rw')
+        self._read()  # greeting
+        self.command('qmp_capabilities')
+
+    def _read(self):
+        while True:
+            msg = json.loads(self.file.readline())
+            if 'event' not in msg:
+                return msg
+
+    def command(self, name, **arguments):
+        self.file.write(json.dumps({'execute': name, 'arguments': arguments}) + '\n')
+        self.file.flush()
+        rsp = self._read()
+        if 'error' in rsp:
+            raise RuntimeError(f"QMP {name} failed: {rsp['error'].get('desc')}")
+        return rsp.get('return')
+
+    def hmp(self, cmd):
+        return self.command('human-monitor-command', **{'command-line': cmd})
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+def qmp_args(port=QMP_PORT):
+    return f" -qmp tcp:{QMP_HOST}:{port},server=on,wait=off"
+
+def snapshot_key(qemu_str, kernel_img, libcxlmi_rev, meson_options):
+    # A snapshot is only valid for the exact topology, kernel and libcxlmi
+    # build (revision and meson options, e.g. --profile's) it was taken with
+    return cache.hash_strings(' '.join(qemu_str.split()), cache.hash_file(kernel_img), libcxlmi_rev,
+                              ' '.join(meson_options.split()))
+
+def snapshot_tag(key):
+    return 'libcxlmi-' + key[:16]
+
+def lookup(suite, key):
+    # Tag of a previously saved snapshot for this suite, if it is still valid
+    state = cache.load_json(SNAPSHOT_STATE)
+    entry = state.get(suite)
+    if entry and entry['key'] == key:
+        return entry['tag']
+    return None
+
+def save(suite, key, port=QMP_PORT):
+    """
+    Take an internal snapshot of the running VM and record it for the suite.
+    Any older snapshot of the same suite is deleted from the disk image.
+    Returns the snapshot tag, or None if QEMU refused to save.
+    """
+    tag = snapshot_tag(key)
+    qmp = QMP(port)
+    try:
+        old = cache.load_json(SNAPSHOT_STATE).get(suite)
+        if old and old['tag'] != tag:
+            qmp.hmp(f"delvm {old['tag']}")
+        out = qmp.hmp(f"savevm {tag}")
+    finally:
+        qmp.close()
+    if out and 'Error' in out:
+        print(f"WARN: savevm failed: {out.strip()}")
+        return None
+
+    with cache.update_json(SNAPSHOT_STATE) as state:
+        state[suite] = {'key': key, 'tag': tag}
+    print(f"INFO: Saved snapshot {tag} for suite {suite}")
+    return tag
+
+def restore(tag, port=QMP_PORT):
+    # Roll the running VM back to the snapshot. Returns False if loadvm failed.
+    start = time.monotonic()
+    qmp = QMP(port)
+    try:
+        out = qmp.hmp(f"loadvm {tag}")
+    finally:
+        qmp.close()
+    if out and 'Error' in out:
+        print(f"WARN: loadvm {tag} failed: {out.strip()}")
+        return False
+    print(f"INFO: Restored snapshot {tag} in {time.monotonic() - start:.2f}s")
+    return True
+
+def forget(suite):
+    with cache.update_json(SNAPSHOT_STATE) as state:
+        state.pop(suite, None)
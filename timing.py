@@ -0,0 +1,80 @@
+"""
+Phase timing for the runner. Every phase is recorded as a Chrome trace-event
+"complete" event (load trace.json in chrome://tracing or Perfetto). Each VM
+instance is its own process track, so concurrent runs under --jobs show up
+side by side; timestamps are wall-clock so traces of several runners merge.
+"""
+import os
+import json
+import time
+import threading
+import contextlib
+
+TRACE_FILE = "trace.json"
+SUMMARY_FILE = "phases.txt"
+
+_events = []
+_lock = threading.Lock()
+_track = 0
+
+def set_track(track, name):
+    # All following events go to this process track (one per VM instance)
+    global _track
+    _track = track
+    with _lock:
+        _events.append({'name': 'process_name', 'ph': 'M', 'pid': track,
+                        'args': {'name': name}})
+
+@contextlib.contextmanager
+def phase(name, **args):
+    start = time.time()
+    try:
+        yield
+    finally:
+        end = time.time()
+        with _lock:
+            _events.append({'name': name, 'cat': 'phase', 'ph': 'X',
+                            'ts': int(start * 1e6), 'dur': int((end - start) * 1e6),
+                            'pid': _track, 'tid': threading.get_ident() % 100000,
+                            'args': args})
+
+def events():
+    with _lock:
+        return list(_events)
+
+def load_events(path):
+    with open(path, 'r') as f:
+        return json.load(f)['traceEvents']
+
+def write_trace(path, extra_events=()):
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events() + list(extra_events),
+                   'displayTimeUnit': 'ms'}, f)
+    print(f"Trace written to {path}")
+
+def write_summary(path, all_events=None):
+    # Total/mean/max wall-clock time per phase name, longest total first
+    stats = {}
+    for event in events() if all_events is None else all_events:
+        if event['ph'] != 'X':
+            continue
+        entry = stats.setdefault(event['name'], [0, 0, 0])
+        entry[0] += 1
+        entry[1] += event['dur']
+        entry[2] = max(entry[2], event['dur'])
+    if not stats:
+        return False
+
+    lines = [f"{'PHASE':<32} {'COUNT':>5} {'TOTAL (s)':>10} {'MEAN (s)':>10} {'MAX (s)':>10}\n"]
+    for name, (count, total, longest) in sorted(stats.items(), key=lambda item: -item[1][1]):
+        lines.append(f"{name:<32} {count:>5} {total / 1e6:>10.2f} {total / count / 1e6:>10.2f} "
+                     f"{longest / 1e6:>10.2f}\n")
+    with open(path, 'w') as f:
+        f.writelines(lines)
+    print(''.join(lines), end='')
+    print(f"Phase timings written to {path}")
+    return True
+
+def write(output_dir, extra_events=()):
+    write_trace(os.path.join(output_dir, TRACE_FILE), extra_events)
+    write_summary(os.path.join(output_dir, SUMMARY_FILE), events() + list(extra_events))
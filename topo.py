@@ -1,44 +1,312 @@
+import inspect
+
 # <--------------- XML files defining input ------------------------------>
 GENERIC_COMMANDS = "./inputs/generic-commands.xml"
 FMAPI_COMMANDS = "./inputs/fmapi-commands.xml"
 
+# <--------------- Topology builder ------------------------------>
+"""
+Topologies are built from parameters instead of hand-written QEMU strings.
+Every backing file lives under the directory of its backing kind plus an
+optional per-instance prefix:
+- file: sparse files under /tmp/ (QEMU only truncates them to size, blocks
+  are allocated when the guest touches them)
+- tmpfs: under /dev/shm/, nothing ever reaches the disk
+- hugepage: under /dev/hugepages/ (needs preallocated hugepages); the LSA is
+  too small for a hugepage and stays on tmpfs
+- ram: anonymous memory-backend-ram, no files at all
+"""
+BACKINGS = ('file', 'tmpfs', 'hugepage', 'ram')
+BACKING_DIRS = {
+    'file': '/tmp/',
+    'tmpfs': '/dev/shm/',
+    'hugepage': '/dev/hugepages/',
+}
+
+def backing_dir(backing='file', prefix=''):
+    # Directory the backing files of a topology go to (None for ram)
+    if backing == 'ram':
+        return None
+    return BACKING_DIRS[backing] + prefix
+
+def backing_dirs(backing='file', prefix=''):
+    # Every directory that has to exist before QEMU starts
+    if backing == 'ram':
+        return []
+    dirs = [backing_dir(backing, prefix)]
+    if backing == 'hugepage':
+        dirs.append(backing_dir('tmpfs', prefix))
+    return dirs
+
+def memory_backend(obj_id, size, file_name, backing='file', prefix='', share=False):
+    if backing not in BACKINGS:
+        raise ValueError(f"Unknown backing {backing}, expected one of {', '.join(BACKINGS)}")
+    share_opt = ",share=on" if share else ""
+    if backing == 'ram':
+        return f"-object memory-backend-ram,id={obj_id}{share_opt},size={size}"
+    return (f"-object memory-backend-file,id={obj_id}{share_opt},"
+            f"mem-path={backing_dir(backing, prefix)}{file_name},size={size}")
+
+def host_bridge(bus_nr=12, bridge_id="cxl.1"):
+    return f"-device pxb-cxl,bus_nr={bus_nr},bus=pcie.0,id={bridge_id},hdm_for_passthrough=true"
+
+def root_port(port, port_id, bridge_id="cxl.1", chassis=0):
+    return f"-device cxl-rp,port={port},bus={bridge_id},id={port_id},chassis={chassis},slot={2 + port}"
+
+def fixed_window(size, granularity, bridge_id="cxl.1", flag="-M"):
+    return (f"{flag} cxl-fmw.0.targets.0={bridge_id},cxl-fmw.0.size={size},"
+            f"cxl-fmw.0.interleave-granularity={granularity}")
+
+def dcd_backends(devices, mem_size, backing, prefix):
+    return [memory_backend(f"cxl-mem{i + 1}", mem_size, f"t3_cxl{i + 1}.raw", backing, prefix)
+            for i in range(devices)]
+
+def dcd(index, bus, dc_regions):
+    return (f"-device cxl-type3,bus={bus},volatile-dc-memdev=cxl-mem{index + 1},"
+            f"id=cxl-dcd{index},num-dc-regions={dc_regions},sn={99 + index}")
+
+def mctp_i2c(address, target):
+    return f"-device i2c_mctp_cxl,bus=aspeed.i2c.bus.0,address={address},target={target}"
+
+def direct_t3(devices=1, mem_size="512M", lsa_size="1M", window_size="4G",
+              backing='file', prefix=''):
+    """
+    `devices` persistent type-3 devices, each on its own root port of one
+    host bridge. NO MCTP.
+    """
+    lsa_backing = 'tmpfs' if backing == 'hugepage' else backing
+    args = []
+    for i in range(devices):
+        suffix = "" if i == 0 else str(i)
+        args.append(memory_backend(f"cxl-mem{i + 1}", mem_size, f"cxltest{suffix}.raw",
+                                   backing, prefix, share=True))
+        args.append(memory_backend(f"cxl-lsa{i + 1}", lsa_size, f"lsa{suffix}.raw",
+                                   lsa_backing, prefix, share=True))
+    args.append(host_bridge())
+    for i in range(devices):
+        args.append(root_port(i, f"root_port{13 + i}"))
+        args.append(f"-device cxl-type3,bus=root_port{13 + i},memdev=cxl-mem{i + 1},"
+                    f"lsa=cxl-lsa{i + 1},id=cxl-pmem{i},sn={0xabcd + i:#x}")
+    args.append(fixed_window(window_size, "8k"))
+    return " ".join(args)
+
+def fm_dcd(devices=1, dc_regions=2, mem_size="4G", i2c_address=4, window_size="4G",
+           backing='file', prefix=''):
+    """
+    `devices` DCDs with `dc_regions` DC regions each, direct attached to the
+    host, and reachable over MCTP on i2c bus 0 from i2c_address upwards.
+    """
+    args = dcd_backends(devices, mem_size, backing, prefix)
+    args.append(host_bridge())
+    for i in range(devices):
+        args.append(root_port(i, f"cxl_rp_port{i}"))
+        args.append(dcd(i, f"cxl_rp_port{i}", dc_regions))
+    args.append(fixed_window(window_size, "1k", flag="-machine"))
+    for i in range(devices):
+        args.append(mctp_i2c(i2c_address + i, f"cxl-dcd{i}"))
+    return " ".join(args)
+
+def switch_dcd(devices=1, dc_regions=2, mem_size="4G", i2c_address=4, window_size="4G",
+               backing='file', prefix=''):
+    """
+    A switch below one root port with `devices` DCDs on its downstream ports.
+    The FM reaches the switch CCI over MCTP on i2c bus 0 and the DCDs only by
+    tunneling through it (to downstream port i, see SUITES).
+    """
+    args = dcd_backends(devices, mem_size, backing, prefix)
+    args.append(host_bridge())
+    args.append(root_port(0, "cxl_rp_port0"))
+    args.append("-device cxl-upstream,port=33,bus=cxl_rp_port0,id=us0,multifunction=on,addr=0.0,sn=33")
+    args.append("-device cxl-switch-mailbox-cci,bus=cxl_rp_port0,addr=0.1,target=us0")
+    for i in range(devices):
+        args.append(f"-device cxl-downstream,port={i},bus=us0,id=swport{i},chassis=0,slot={4 + i}")
+        args.append(dcd(i, f"swport{i}", dc_regions))
+    args.append(fixed_window(window_size, "1k", flag="-machine"))
+    args.append(mctp_i2c(i2c_address, "us0"))
+    return " ".join(args)
+
+# Root ports per host bridge in scaled(); each bridge gets its own chassis
+PORTS_PER_BRIDGE = 8
+# Host bridge bus numbers are this far apart, leaving room for their ports
+BRIDGE_BUS_STRIDE = 20
+
+def scaled(type3=16, dcds=8, mctp_endpoints=4, mem_size="256M", lsa_size="1M", dcd_mem_size="512M",
+           dc_regions=2, i2c_address=4, window_size="4G", backing='file', prefix=''):
+    """
+    Many endpoints: `type3` persistent type-3 devices and `dcds` DCDs, spread
+    over as many host bridges as PORTS_PER_BRIDGE requires, and
+    `mctp_endpoints` MCTP endpoints on i2c bus 0 (from i2c_address upwards),
+    on the DCDs first and then on the type-3 devices. The fixed window only
+    covers the first host bridge: the devices are there to be enumerated and
+    opened, not to back regions.
+    """
+    devices = type3 + dcds
+    if mctp_endpoints > devices:
+        raise ValueError(f"{mctp_endpoints} MCTP endpoints need as many devices, got {devices}")
+    lsa_backing = 'tmpfs' if backing == 'hugepage' else backing
+    args = []
+    for i in range(type3):
+        args.append(memory_backend(f"cxl-mem{i + 1}", mem_size, f"cxltest{i}.raw", backing, prefix, share=True))
+        args.append(memory_backend(f"cxl-lsa{i + 1}", lsa_size, f"lsa{i}.raw", lsa_backing, prefix, share=True))
+    # DCD memdevs are numbered after the type-3 ones (see dcd())
+    args += [memory_backend(f"cxl-mem{type3 + i + 1}", dcd_mem_size, f"t3_cxl{type3 + i + 1}.raw", backing, prefix)
+             for i in range(dcds)]
+    for bridge in range((devices + PORTS_PER_BRIDGE - 1) // PORTS_PER_BRIDGE):
+        args.append(host_bridge(12 + bridge * BRIDGE_BUS_STRIDE, f"cxl.{bridge + 1}"))
+
+    targets = []
+    for i in range(devices):
+        bridge, port = divmod(i, PORTS_PER_BRIDGE)
+        port_id = f"cxl_rp{bridge}_port{port}"
+        args.append(root_port(port, port_id, f"cxl.{bridge + 1}", chassis=bridge))
+        if i < type3:
+            args.append(f"-device cxl-type3,bus={port_id},memdev=cxl-mem{i + 1},"
+                        f"lsa=cxl-lsa{i + 1},id=cxl-pmem{i},sn={0xabcd + i:#x}")
+            targets.append(f"cxl-pmem{i}")
+        else:
+            args.append(dcd(i, port_id, dc_regions))
+            targets.insert(i - type3, f"cxl-dcd{i}")
+    args.append(fixed_window(window_size, "8k"))
+    for i, target in enumerate(targets[:mctp_endpoints]):
+        args.append(mctp_i2c(i2c_address + i, target))
+    return " ".join(args)
+
 # <--------------- Supported Topologies ------------------------------>
 
 # 1 direct-attached T3 device
 # NO MCTP
-DIRECT_T3 = "-object memory-backend-file,id=cxl-mem1,share=on,mem-path=/tmp/cxltest.raw,size=512M \
-     -object memory-backend-file,id=cxl-lsa1,share=on,mem-path=/tmp/lsa.raw,size=1M \
-     -device pxb-cxl,bus_nr=12,bus=pcie.0,id=cxl.1,hdm_for_passthrough=true \
-     -device cxl-rp,port=0,bus=cxl.1,id=root_port13,chassis=0,slot=2 \
-     -device cxl-type3,bus=root_port13,memdev=cxl-mem1,lsa=cxl-lsa1,id=cxl-pmem0,sn=0xabcd \
-     -M cxl-fmw.0.targets.0=cxl.1,cxl-fmw.0.size=4G,cxl-fmw.0.interleave-granularity=8k"
+DIRECT_T3 = direct_t3()
 
 # 1 DCD with 2 DC regions direct attached to the host
 # and with 1 i2c bus for MCTP
-FM_DCD = "-object memory-backend-file,id=cxl-mem1,mem-path=/tmp/t3_cxl1.raw,size=4G \
- -device pxb-cxl,bus_nr=12,bus=pcie.0,id=cxl.1,hdm_for_passthrough=true \
- -device cxl-rp,port=0,bus=cxl.1,id=cxl_rp_port0,chassis=0,slot=2 \
- -device cxl-type3,bus=cxl_rp_port0,volatile-dc-memdev=cxl-mem1,id=cxl-dcd0,num-dc-regions=2,sn=99 \
- -machine cxl-fmw.0.targets.0=cxl.1,cxl-fmw.0.size=4G,cxl-fmw.0.interleave-granularity=1k \
- -device i2c_mctp_cxl,bus=aspeed.i2c.bus.0,address=4,target=cxl-dcd0"
+FM_DCD = fm_dcd()
+
+# 1 switch with 1 DCD (2 DC regions) on downstream port 0, the switch CCI
+# on 1 i2c bus for MCTP
+SWITCH_DCD = switch_dcd()
+
+# 16 type-3 devices and 8 DCDs over 3 host bridges, 4 of the DCDs on i2c
+# bus 0 for MCTP
+SCALED = scaled()
 
 # <--------------- Topo Map ------------------------------>
 """
 Map of topology to:
 - input: path to XML file defining commands to test on it
-- qemu_str: its QEMU string
+- topo: builder and parameters of its topology
+- qemu_str: its QEMU string, built from topo
 - mctp: nid:eid tuple of EP to open
 - ioctl: name of device if ioctl EP opened
+- tunnel: how commands reach the device from the EP, a tunnel spec (see
+  generate_tests.parse_tunnel()) or None for direct. A <command tunnel="...">
+  in the XML overrides it
+- variant_of: for suites that run another suite's commands tunneled, that
+  suite. Only run with -s, by default or with --async, --bench, --stress and
+  --sim; selections by opcode always run the direct suite
 """
 SUITES = {
     "GENERIC" : {
         "input": GENERIC_COMMANDS,
+        "topo" : (direct_t3, {}),
         "qemu_str" : DIRECT_T3,
         "mctp" : None,
-        "ioctl" : "mem0"},
+        "ioctl" : "mem0",
+        "tunnel" : None},
     "FMAPI" : {
         "input": FMAPI_COMMANDS,
+        "topo" : (fm_dcd, {}),
         "qemu_str" : FM_DCD,
         "mctp" : (11, 8),
-        "ioctl" : "mem0"},
-}
\ No newline at end of file
+        "ioctl" : "mem0",
+        "tunnel" : None},
+    # FMAPI commands tunneled to the FM-owned LD of the DCD (1 level)
+    "FMAPI_MLD" : {
+        "input": FMAPI_COMMANDS,
+        "topo" : (fm_dcd, {}),
+        "qemu_str" : FM_DCD,
+        "mctp" : (11, 8),
+        "ioctl" : None,
+        "tunnel" : "mld:0",
+        "variant_of" : "FMAPI"},
+    # ... through the switch CCI to the DCD on downstream port 0 (1 level)
+    "FMAPI_SWITCH" : {
+        "input": FMAPI_COMMANDS,
+        "topo" : (switch_dcd, {}),
+        "qemu_str" : SWITCH_DCD,
+        "mctp" : (11, 8),
+        "ioctl" : None,
+        "tunnel" : "switch:0",
+        "variant_of" : "FMAPI"},
+    # ... and on to its FM-owned LD (2 levels)
+    "FMAPI_SWITCH_MLD" : {
+        "input": FMAPI_COMMANDS,
+        "topo" : (switch_dcd, {}),
+        "qemu_str" : SWITCH_DCD,
+        "mctp" : (11, 8),
+        "ioctl" : None,
+        "tunnel" : "switch-mld:0:0",
+        "variant_of" : "FMAPI"},
+}
+
+# Scaled topology, only run by --scale (see generate_scale.py). mctp is its
+# first MCTP endpoint, the one mctp.sh sets up; run_tests.py sets up the
+# others on i2c_address + 1 onwards
+SCALE = {
+    "input": GENERIC_COMMANDS,
+    "topo" : (scaled, {}),
+    "qemu_str" : SCALED,
+    "mctp" : (11, 8),
+    "ioctl" : "mem0",
+    "tunnel" : None}
+
+def topologies():
+    # Every suite, and SCALE, for what applies to all topologies alike
+    return list(SUITES.values()) + [SCALE]
+
+def params(suite_info):
+    # Every parameter of a suite's topology, defaults included
+    builder, values = suite_info['topo']
+    defaults = {name: p.default for name, p in inspect.signature(builder).parameters.items()}
+    return {**defaults, **values}
+
+def build(suite_info, **overrides):
+    """
+    QEMU string of a suite's topology, with some parameters overridden.
+    Overrides its builder does not take are ignored, so one set of overrides
+    can be applied to every suite.
+    """
+    builder, params = suite_info['topo']
+    accepted = inspect.signature(builder).parameters
+    params = {**params, **{k: v for k, v in overrides.items() if k in accepted}}
+    return builder(**params)
+
+def rebuild(**overrides):
+    # Rebuild every suite's qemu_str, e.g. with another backing or prefix.
+    # The overrides are kept, so params() returns what was built
+    for suite_info in topologies():
+        builder, params = suite_info['topo']
+        accepted = inspect.signature(builder).parameters
+        suite_info['topo'] = (builder, {**params, **{k: v for k, v in overrides.items() if k in accepted}})
+        suite_info['qemu_str'] = builder(**suite_info['topo'][1])
+
+def parse_params(items):
+    """
+    Parse ["devices=2", "mem_size=1G", ...] into builder overrides. Integer
+    values (also 0x...) are converted, the rest are kept as strings (e.g.
+    sizes).
+    """
+    known = {name for suite_info in topologies()
+             for name in inspect.signature(suite_info['topo'][0]).parameters} - {'backing', 'prefix'}
+    params = {}
+    for item in items or []:
+        name, sep, value = item.partition('=')
+        name = name.strip()
+        if not sep or name not in known:
+            raise ValueError(f"Invalid topology parameter {item}, expected NAME=VALUE "
+                             f"with NAME one of {', '.join(sorted(known))}")
+        value = value.strip()
+        try:
+            params[name] = int(value, 0)
+        except ValueError:
+            params[name] = value
+    return params